@@ -0,0 +1,87 @@
+# compare reading plain and compressed PizzaBox files when the disk, not
+# the cpu, is the limit. Raw reads are slowed down to BANDWIDTH bytes/s
+# to stand in for a busy GPFS
+import gzip
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+
+from qastools import fileindex
+from qastools.handlers import PizzaBoxAnHandlerTxt
+
+NROWS = 1000000
+CHUNK_SIZE = 1024
+BANDWIDTH = 100 * 2**20
+
+_read_at = fileindex._read_at
+
+
+def throttled_read_at(f, offset, nbytes):
+    data = _read_at(f, offset, nbytes)
+    time.sleep(len(data) / BANDWIDTH)
+    return data
+
+
+def write_file(fpath, nrows):
+    rng = np.random.default_rng(0)
+    ts = 1500000000 + np.arange(nrows) // 100000
+    ns = (np.arange(nrows) % 100000) * 10000
+    # a slowly varying signal compresses like the real ones, not like noise
+    adc = (np.cumsum(rng.integers(-50, 51, nrows)) % 2**18) << 8
+    with open(fpath, 'w') as f:
+        for row in zip(ts, ns, np.arange(nrows), adc):
+            f.write('%d %d %d %08x\n' % row)
+
+
+def timed(func):
+    t0 = time.perf_counter()
+    result = func()
+    return time.perf_counter() - t0, result
+
+
+fileindex._read_at = throttled_read_at
+PizzaBoxAnHandlerTxt.memory_cache = None
+with tempfile.TemporaryDirectory() as tmpdir:
+    plain_path = os.path.join(tmpdir, 'plain.txt')
+    write_file(plain_path, NROWS)
+    paths = {'plain': plain_path}
+    with open(plain_path, 'rb') as f:
+        text = f.read()
+    paths['gzip'] = os.path.join(tmpdir, 'gz.txt')
+    with open(paths['gzip'] + '.gz', 'wb') as f:
+        f.write(gzip.compress(text, compresslevel=6))
+    try:
+        import zstandard
+    except ImportError:
+        pass
+    else:
+        # written as several frames, zstd can only seek to frame starts
+        compressor = zstandard.ZstdCompressor(level=3)
+        frame = 4 * 2**20
+        paths['zstd'] = os.path.join(tmpdir, 'zst.txt')
+        with open(paths['zstd'] + '.zst', 'wb') as f:
+            for start in range(0, len(text), frame):
+                f.write(compressor.compress(text[start:start + frame]))
+
+    print("{} rows, {:.0f} MB of text, reads throttled to "
+          "{:.0f} MB/s".format(NROWS, len(text) / 1e6, BANDWIDTH / 1e6))
+    reference = None
+    for name, fpath in paths.items():
+        size = os.path.getsize(fileindex.resolve_path(fpath))
+        t_open, handler = timed(lambda: PizzaBoxAnHandlerTxt(fpath,
+                                                             CHUNK_SIZE))
+        nchunks = len(handler._index)
+        t_all, data = timed(handler.read_all)
+        if reference is None:
+            reference = data
+        assert np.array_equal(data, reference)
+        chunks = random.Random(0).sample(range(nchunks), 50)
+        t_random, _ = timed(lambda: [handler(k) for k in chunks])
+        t_seq, _ = timed(lambda: [handler(k) for k in range(nchunks)])
+        print("{:6s} {:5.1f} MB  index {:.2f} s  read_all {:.2f} s  "
+              "random chunk {:.1f} ms  all chunks in order {:.2f} s".format(
+                  name, size / 1e6, t_open, t_all, t_random / 50 * 1e3,
+                  t_seq))
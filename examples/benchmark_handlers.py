@@ -0,0 +1,206 @@
+# benchmark suite of the PizzaBox text handlers on synthetic files (see
+# qastools.synthetic): parse throughput, peak memory and chunk latency of
+# each handler in each access mode.
+#
+#   python benchmark_handlers.py --rows 1000000 --json today.json
+#   python benchmark_handlers.py --compare today.json
+#
+# With --compare the results are checked against an earlier --json run, and
+# the script exits with 1 when a mode got slower (or bigger) by more than
+# --tolerance.
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from qastools.synthetic import HANDLERS, write_file
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# random chunks read for the latency of the chunk access modes
+NSAMPLES = 200
+
+
+def bulk(handler, **kwargs):
+    ''' A whole file read.'''
+    def run():
+        handler.read_all(**kwargs)
+        return []
+    return run
+
+
+def chunks(handler, order):
+    ''' Chunk reads in order, the latency of each timed.'''
+    def run():
+        latencies = []
+        for chunk_num in order:
+            t0 = time.perf_counter()
+            handler(chunk_num)
+            latencies.append(time.perf_counter() - t0)
+        return latencies
+    return run
+
+
+def time_ranges(handler, data, nranges):
+    ''' Reads of 10 ms windows at random times.'''
+    rng = np.random.default_rng(1)
+    t_first = data.ts_s[0] + data.ts_ns[0] * 1e-9
+    t_last = data.ts_s[-1] + data.ts_ns[-1] * 1e-9
+    starts = rng.uniform(t_first, t_last, nranges)
+
+    def run():
+        latencies = []
+        for t in starts:
+            t0 = time.perf_counter()
+            handler.read_time_range(t, t + 0.01)
+            latencies.append(time.perf_counter() - t0)
+        return latencies
+    return run
+
+
+def measure(run, nrows, nbytes, repeat):
+    ''' The best of repeat runs, and the peak memory of one.'''
+    best, latencies = np.inf, []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        latencies = run()
+        best = min(best, time.perf_counter() - t0)
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result = {'seconds': best, 'rows_per_s': nrows / best,
+              'mb_per_s': nbytes / best / 2**20, 'peak_mb': peak / 2**20}
+    if latencies:
+        result['p50_ms'] = float(np.percentile(latencies, 50)) * 1e3
+        result['p95_ms'] = float(np.percentile(latencies, 95)) * 1e3
+    return result
+
+
+def modes(handler_class, paths, data, chunk_size):
+    ''' (name, handler, run, rows read) of each access mode.'''
+    nrows = len(data)
+    nchunks = -(-nrows // chunk_size)
+    nsamples = min(NSAMPLES, nchunks)
+    rng = np.random.default_rng(0)
+    random_order = rng.integers(0, nchunks, nsamples)
+    in_order = np.arange(nchunks)
+
+    handler = handler_class(paths['txt'], chunk_size)
+    yield 'read_all', handler, bulk(handler), nrows
+    if (os.cpu_count() or 1) > 1:
+        yield ('read_all_p{}'.format(os.cpu_count()), handler,
+               bulk(handler, processes=None), nrows)
+    yield ('chunks_in_order', handler, chunks(handler, in_order), nrows)
+    yield ('chunks_random', handler, chunks(handler, random_order),
+           nsamples * chunk_size)
+    prefetching = handler_class(paths['txt'], chunk_size, prefetch=4)
+    yield ('chunks_prefetch', prefetching, chunks(prefetching, in_order),
+           nrows)
+    yield ('time_range', handler, time_ranges(handler, data, nsamples),
+           nsamples * 1000)
+    if pyarrow is not None:
+        arrow = handler_class(paths['txt'], chunk_size, output='arrow')
+        yield 'read_all_arrow', arrow, bulk(arrow), nrows
+    for suffix in ('gz', 'zst'):
+        if suffix not in paths:
+            continue
+        compressed = handler_class(paths[suffix], chunk_size)
+        yield 'read_all_' + suffix, compressed, bulk(compressed), nrows
+        yield ('chunks_random_' + suffix, compressed,
+               chunks(compressed, random_order), nsamples * chunk_size)
+
+
+def run_suite(nrows, chunk_size, repeat, kinds, tmpdir):
+    results = {}
+    for kind in kinds:
+        handler_class = HANDLERS[kind]
+        # every read parses, nothing is shared between runs
+        handler_class.memory_cache = None
+        handler_class.use_converted = False
+        paths = {'txt': os.path.join(tmpdir, kind + '.txt'),
+                 'gz': os.path.join(tmpdir, kind + '.txt.gz')}
+        if zstandard is not None:
+            paths['zst'] = os.path.join(tmpdir, kind + '.txt.zst')
+        for path in paths.values():
+            data = write_file(path, kind, nrows)
+        nbytes = os.path.getsize(paths['txt'])
+
+        t0 = time.perf_counter()
+        handler_class(paths['txt'], chunk_size)
+        results[kind + '/open'] = {'seconds': time.perf_counter() - t0}
+        for name, handler, run, rows_read in modes(handler_class, paths,
+                                                   data, chunk_size):
+            result = measure(run, rows_read, nbytes * rows_read / nrows,
+                             repeat)
+            handler.close()
+            results['{}/{}'.format(kind, name)] = result
+            print_result(kind + '/' + name, result)
+    return results
+
+
+def print_result(name, result):
+    line = '{:28s} {:8.3f} s'.format(name, result['seconds'])
+    if 'rows_per_s' in result:
+        line += ' {:7.1f} Mrows/s {:7.1f} MB/s {:8.1f} MB peak'.format(
+            result['rows_per_s'] / 1e6, result['mb_per_s'],
+            result['peak_mb'])
+    if 'p50_ms' in result:
+        line += '  latency {:.3f} / {:.3f} ms'.format(result['p50_ms'],
+                                                      result['p95_ms'])
+    print(line)
+
+
+def compare(results, baseline, tolerance):
+    ''' The names of the modes that got worse than baseline.'''
+    worse = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        for key in ('seconds', 'peak_mb', 'p95_ms'):
+            if key in result and key in old and \
+                    result[key] > old[key] * (1 + tolerance):
+                worse.append('{} {}: {:.4g} -> {:.4g}'.format(
+                    name, key, old[key], result[key]))
+    return worse
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--rows', type=int, default=10**6)
+parser.add_argument('--chunk-size', type=int, default=1024)
+parser.add_argument('--repeat', type=int, default=3)
+parser.add_argument('--kinds', nargs='+', default=sorted(HANDLERS),
+                    choices=sorted(HANDLERS))
+parser.add_argument('--json', help="write the results to this file")
+parser.add_argument('--compare', help="a --json file of an earlier run")
+parser.add_argument('--tolerance', type=float, default=0.2)
+args = parser.parse_args()
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    results = run_suite(args.rows, args.chunk_size, args.repeat, args.kinds,
+                        tmpdir)
+if args.json:
+    with open(args.json, 'w') as f:
+        json.dump({'rows': args.rows, 'chunk_size': args.chunk_size,
+                   'results': results}, f, indent=1)
+if args.compare:
+    with open(args.compare) as f:
+        baseline = json.load(f)['results']
+    worse = compare(results, baseline, args.tolerance)
+    for line in worse:
+        print('slower: ' + line)
+    if worse:
+        sys.exit(1)
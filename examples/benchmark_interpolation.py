@@ -0,0 +1,116 @@
+# compare qastools.engine.interpolate against the interpolation of isstools'
+# XASdataGeneric (copied below, as interp_df is computed there) on
+# synthetic traces shaped like a QAS fly scan: a 2 kHz mono encoder and
+# four 100 kHz ADC channels
+import time
+
+import numpy as np
+
+from qastools.engine import (encoder2energy, group_traces, interpolate,
+                             to_dataframe)
+from qastools.parsing import decode_adc, timestamps_ns
+from qastools.synthetic import generate
+
+NSECONDS = 20
+PPD = 23600 * 400 / 360
+
+
+def legacy_interpolate(arrays):
+    ''' XASdataGeneric.interpolate, arrays is {name: (n, 2) [time, value]}.'''
+    import pandas as pd
+    interp_arrays = {}
+    min_timestamp = max([arrays.get(key)[0, 0] for key in arrays])
+    max_timestamp = min([arrays.get(key)[len(arrays.get(key)) - 1, 0]
+                         for key in arrays
+                         if len(arrays.get(key)[:, 0]) > 5])
+    timestamps = arrays['energy'][:, 0]
+    condition = timestamps < min_timestamp
+    timestamps = timestamps[np.sum(condition):]
+    condition = timestamps > max_timestamp
+    timestamps = timestamps[: len(timestamps) - np.sum(condition)]
+    for key in arrays.keys():
+        if len(arrays.get(key)[:, 0]) > 5 * len(timestamps):
+            time = [np.mean(array) for array in
+                    np.array_split(arrays.get(key)[:, 0], len(timestamps))]
+            val = [np.mean(array) for array in
+                   np.array_split(arrays.get(key)[:, 1], len(timestamps))]
+            interp_arrays[key] = np.array(
+                [timestamps, np.interp(timestamps, time, val)]).transpose()
+        else:
+            interp_arrays[key] = np.array(
+                [timestamps, np.interp(timestamps, arrays.get(key)[:, 0],
+                                       arrays.get(key)[:, 1])]).transpose()
+    interp_df = pd.DataFrame(np.vstack(
+        (timestamps, np.array([interp_arrays[array][:, 1]
+                               for array in interp_arrays]))).transpose())
+    keys = ['timestamp']
+    keys.extend(interp_arrays.keys())
+    interp_df.columns = keys
+    return interp_df
+
+
+def best_of(func, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+enc = generate('enc', NSECONDS * 2000, rate_hz=2e3, jitter_ns=1000,
+               counts=20000)
+an = generate('an', NSECONDS * 100000, rate_hz=100e3, seed=1)
+enc_time = timestamps_ns(enc.ts_s, enc.ts_ns)
+# the ADC starts a little after the encoder
+an_time = timestamps_ns(an.ts_s, an.ts_ns) + 3000000
+energy = encoder2energy(enc.encoder - 14 * PPD, PPD)
+volts = decode_adc(an.adc, volts_per_count=10 / 2**17)
+traces = [('energy', enc_time, energy)]
+for k, name in enumerate(('i0', 'it', 'ir', 'iff')):
+    traces.append((name, an_time, volts * (k + 1) + 0.1 * k))
+
+# isstools has float seconds since the epoch
+arrays = {name: np.column_stack([t * 1e-9, values])
+          for name, t, values in traces}
+t_old, old = best_of(lambda: legacy_interpolate(arrays), repeat=1)
+t_new, new = best_of(lambda: to_dataframe(interpolate(group_traces(traces))))
+assert list(old.columns) == list(new.columns)
+# the old one averages float epoch seconds, its timestamps are off by
+# up to a few 1e-7 s
+assert np.allclose(old.values, new.values, rtol=1e-5, atol=0)
+print("interpolate {} s of scan: isstools {:.3f} s, engine {:.3f} s, "
+      "{:.0f}x faster".format(NSECONDS, t_old, t_new, t_old / t_new))
+
+# binning all the channels at once through the sparse matrix, against the
+# same gaussian windows as a dense matrix, one channel at a time. This only
+# checks the sparse matrix: the grid and window widths are those of
+# qastools.binning on both sides, not those of gen_parser.bin, which were
+# never compared (see rebin)
+from qastools.binning import BinMatrix, energy_grid, window_width
+
+
+def dense_bin(grid, energy, channels):
+    fwhm = window_width(grid)
+    sigma = fwhm / (2 * (2 * np.log(2))**.5)
+    mat = np.exp(-.5 * ((energy[None, :] - grid[:, None])
+                        / sigma[:, None])**2)
+    mat /= sigma[:, None] * np.sqrt(2 * np.pi)
+    mat *= window_width(energy)[None, :]
+    mat /= np.sum(mat, axis=1)[:, None]
+    return np.column_stack([mat @ channel for channel in channels.T])
+
+
+e0 = 7900
+energy = new['energy'].values
+order = np.argsort(energy, kind='stable')
+channels = new[['i0', 'it', 'ir', 'iff']].values
+grid = energy_grid(e0, e0 - 30, e0 + 30, 4, 0.2, 0.04, energy.min(),
+                   energy.max())
+t_old, old = best_of(lambda: dense_bin(grid, energy[order],
+                                        channels[order]), repeat=1)
+t_new, binned = best_of(lambda: BinMatrix(grid, energy).apply(channels))
+assert np.allclose(old, binned, rtol=1e-6, atol=1e-9)
+print("bin {} points onto {}: dense {:.3f} s, sparse {:.4f} s, "
+      "{:.0f}x faster".format(len(energy), len(grid), t_old, t_new,
+                              t_old / t_new))
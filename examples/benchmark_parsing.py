@@ -0,0 +1,132 @@
+# compare the vectorized PizzaBox parsing against the old per line
+# namedtuple parsing, on synthetic files shaped like the beamline ones.
+# Measured ratios, not a target: over a few runs on one machine the
+# encoder and DI files parsed 9-11x faster per 1M line chunk, the analog
+# file 8-9x, less because its hex column is decoded apart from the
+# decimal ones. The ratios are printed as measured, so check them on
+# the machine you care about.
+from collections import namedtuple
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from qastools.handlers import (PizzaBoxAnHandlerTxt, PizzaBoxEncHandlerTxt,
+                               PizzaBoxDIHandlerTxt)
+from qastools.parsing import decode_adc
+
+NROWS = 1000000
+
+
+def write_file(fpath, nrows, hex_adc=False):
+    rng = np.random.default_rng(0)
+    ts = 1500000000 + np.arange(nrows) // 100000
+    ns = (np.arange(nrows) % 100000) * 10000
+    index = np.arange(nrows)
+    with open(fpath, 'w') as f:
+        if hex_adc:
+            adc = rng.integers(0, 2**32, nrows)
+            for row in zip(ts, ns, index, adc):
+                f.write('%d %d %d %08x\n' % row)
+        else:
+            enc = np.cumsum(rng.integers(-3, 4, nrows)) - 5000
+            state = rng.integers(0, 2, nrows)
+            for row in zip(ts, ns, enc, index, state):
+                f.write('%d %d %d %d %d\n' % row)
+
+
+# the handlers as they were: all lines read up front, then one namedtuple
+# per line in __call__
+class LegacyHandler:
+    def __init__(self, fpath, chunk_size, columns, bases):
+        self.row = namedtuple('row', columns)
+        self.bases = bases
+        self.chunk_size = chunk_size
+        with open(fpath, 'r') as f:
+            self.lines = list(f)
+
+    def __call__(self, chunk_num):
+        cs = self.chunk_size
+        return [self.row(*(int(v, base=b)
+                           for v, b in zip(ln.split(), self.bases)))
+                for ln in self.lines[chunk_num*cs:(chunk_num+1)*cs]]
+
+
+def best_of(func, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    for handler_class in (PizzaBoxEncHandlerTxt, PizzaBoxDIHandlerTxt,
+                          PizzaBoxAnHandlerTxt):
+        bases = handler_class.bases or (10,) * len(handler_class.columns)
+        fpath = os.path.join(tmpdir, handler_class.__name__ + '.txt')
+        write_file(fpath, NROWS, hex_adc=16 in bases)
+
+        # time the parsing only (__call__), both read the file up front.
+        # No sharing of parsed chunks between calls
+        handler_class.memory_cache = None
+        legacy = LegacyHandler(fpath, NROWS, handler_class.columns, bases)
+        handler = handler_class(fpath, NROWS)
+        t_old, old = best_of(lambda: legacy(0), repeat=1)
+        t_new, new = best_of(lambda: handler(0))
+        assert np.array_equal(np.array(old), np.array(new.tolist()))
+        print("{:24s} {} rows: old {:.2f} s, new {:.3f} s, "
+              "{:.0f}x faster".format(handler_class.__name__, NROWS,
+                                      t_old, t_new, t_old / t_new))
+
+    # adc words to volts, against the per line conversion done in isstools
+    # (checked to give the same volts in tests/test_parsing.py)
+    def legacy_volts(hex_words):
+        volts = []
+        for word in hex_words:
+            value = int(word, 16) >> 8
+            value = value - 0x40000 if value > 0x1FFFF else value
+            volts.append(value * 7.62939453125e-05)
+        return volts
+
+    fpath = os.path.join(tmpdir, PizzaBoxAnHandlerTxt.__name__ + '.txt')
+    with open(fpath) as f:
+        hex_words = [ln.split()[3] for ln in f]
+    adc = PizzaBoxAnHandlerTxt(fpath, NROWS)(0).adc
+    # the synthetic words use all 32 bits, the ADC only fills 26
+    hex_words = ['%x' % (int(w, 16) & 0x3ffffff) for w in hex_words]
+    adc = adc & 0x3ffffff
+    t_old, old = best_of(lambda: legacy_volts(hex_words), repeat=1)
+    t_new, new = best_of(lambda: decode_adc(adc, volts_per_count=10 / 2**17))
+    print("{:24s} {} words: old {:.2f} s, new {:.3f} s, "
+          "{:.0f}x faster".format('decode_adc', NROWS, t_old, t_new,
+                                  t_old / t_new))
+
+    # whole file reads, parsing byte ranges on several cores
+    fpath = os.path.join(tmpdir, PizzaBoxAnHandlerTxt.__name__ + '.txt')
+    handler = PizzaBoxAnHandlerTxt(fpath, 1024)
+    t_serial, serial = best_of(lambda: handler.read_all())
+    for processes in (2, 4, 8, 16, 32):
+        if processes > (os.cpu_count() or 1):
+            break
+        t_par, par = best_of(lambda: handler.read_all(processes=processes))
+        assert np.array_equal(serial, par)
+        print("read_all, {:2d} processes     {:.3f} s ({:.3f} s serial), "
+              "{:.1f}x".format(processes, t_par, t_serial,
+                               t_serial / t_par))
+
+    # walking the chunks in order while working on each, e.g. live plots,
+    # with the next chunks read in the background
+    def walk(handler, work=0.002):
+        for chunk_num in range(len(handler._index)):
+            handler(chunk_num)
+            time.sleep(work)
+
+    for prefetch in (0, 2, 8):
+        handler = PizzaBoxAnHandlerTxt(fpath, 4096, prefetch=prefetch)
+        t_walk, _ = best_of(lambda: walk(handler), repeat=1)
+        handler.close()
+        print("chunks in order, prefetch {}   {:.3f} s".format(prefetch,
+                                                               t_walk))
@@ -2,6 +2,7 @@ from databroker import Broker
 import numpy as np
 from qastools.handlers import (PizzaBoxEncHandlerTxt, PizzaBoxAnHandlerTxt,
                       PizzaBoxDIHandlerTxt)
+from qastools.fill import read_stream
 import os
 import matplotlib.pyplot as plt
 
@@ -36,6 +37,9 @@ file_list = handler.get_file_list(datum_kwargs)
 
 gg=np.loadtxt(file_list[0])
 
+# or the whole stream at once, one registry query and one file read
+enc = read_stream(db, hdr, dataset_name)
+
 
 plt.ion()
 plt.figure()
@@ -0,0 +1,86 @@
+# hammer one PizzaBox handler from many threads at once: every chunk read
+# must come back as in a serial read, whatever the mix of cache hits,
+# evictions, read ahead and compressed seeks
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+
+from qastools.cache import MemoryCache
+from qastools.handlers import PizzaBoxAnHandlerTxt
+
+NROWS = 500000
+CHUNK_SIZE = 1024
+NTHREADS = 32
+CALLS_PER_THREAD = 100
+
+
+def write_file(fpath, nrows):
+    rng = np.random.default_rng(0)
+    ts = 1500000000 + np.arange(nrows) // 100000
+    ns = (np.arange(nrows) % 100000) * 10000
+    adc = rng.integers(0, 2**32, nrows)
+    with open(fpath, 'w') as f:
+        for row in zip(ts, ns, np.arange(nrows), adc):
+            f.write('%d %d %d %08x\n' % row)
+
+
+def hammer(handler, reference, seed):
+    rng = random.Random(seed)
+    nchunks = len(reference)
+    # runs of consecutive chunks from random places, to mix read ahead,
+    # cursor reuse and seeks
+    calls = 0
+    while calls < CALLS_PER_THREAD:
+        start = rng.randrange(nchunks)
+        for chunk_num in range(start, min(start + rng.randint(1, 8),
+                                          nchunks)):
+            if not np.array_equal(handler(chunk_num), reference[chunk_num]):
+                raise AssertionError("chunk {} differs".format(chunk_num))
+            calls += 1
+    return calls
+
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    fpath = os.path.join(tmpdir, 'an.txt')
+    write_file(fpath, NROWS)
+    gz_path = os.path.join(tmpdir, 'an_gz.txt')
+    with open(fpath, 'rb') as f, open(gz_path + '.gz', 'wb') as out:
+        out.write(gzip.compress(f.read()))
+
+    PizzaBoxAnHandlerTxt.memory_cache = None
+    serial = PizzaBoxAnHandlerTxt(fpath, CHUNK_SIZE)
+    reference = [serial(k) for k in range(len(serial._index))]
+
+    # a cache too small for the file, so threads evict each other's chunks
+    chunk_nbytes = reference[0].nbytes
+    setups = [('plain, no cache', fpath, None, 0),
+              ('plain, small cache', fpath, MemoryCache(50 * chunk_nbytes), 0),
+              ('plain, prefetch', fpath, None, 4),
+              ('gzip, no cache', gz_path, None, 0),
+              ('gzip, small cache', gz_path, MemoryCache(50 * chunk_nbytes),
+               4)]
+    for name, path, memory_cache, prefetch in setups:
+        PizzaBoxAnHandlerTxt.memory_cache = memory_cache
+        handler = PizzaBoxAnHandlerTxt(path, CHUNK_SIZE, prefetch=prefetch,
+                                       prefetch_workers=4)
+        t0 = time.perf_counter()
+        calls = hammer(handler, reference, -1)
+        t_serial = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(NTHREADS) as pool:
+            calls = sum(pool.map(lambda seed: hammer(handler, reference,
+                                                     seed),
+                                 range(NTHREADS)))
+        t_threads = time.perf_counter() - t0
+        handler.close()
+        if memory_cache is not None:
+            assert memory_cache.nbytes <= memory_cache.max_bytes
+        print("{:20s} serial {:6.0f} chunks/s, {} threads {:6.0f} "
+              "chunks/s".format(name, CALLS_PER_THREAD / t_serial,
+                                NTHREADS, calls / t_threads))
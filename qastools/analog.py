@@ -0,0 +1,176 @@
+''' All the analog channels of a run as one block.
+
+    A QAS run has one PIZZABOX_AN_FILE_TXT resource per ADC channel (I0,
+    It, Ir, If, ...). read_analog reads them all at once, a thread per
+    channel, and joins them on their timestamps into a single
+    (n_samples, n_channels) array, so the channels are aligned and
+    interpolated together rather than one by one.
+
+    read_channel reads one resource, analog or encoder, and is also what
+    qastools.engine reads its traces with.
+'''
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .fill import read_resource, stream_resources
+from .parsing import decode_adc, timestamps_ns
+
+ANALOG_SPEC = 'PIZZABOX_AN_FILE_TXT'
+
+AnalogBlock = namedtuple('AnalogBlock', ['time_ns', 'values', 'channels'])
+AnalogBlock.__doc__ = ''' Channels on a shared time axis.
+
+    time_ns : (n_samples,) int64 nanoseconds since the epoch
+    values : (n_samples, n_channels) float array
+    channels : the channel (stream) names, in column order
+'''
+
+
+def read_analog(db, hdr, streams=None, how='inner', volts=True,
+                processes=1, max_workers=None):
+    ''' Read the analog channels of a run joined on their timestamps.
+
+        Parameters
+        ----------
+        db : Broker
+            the Broker of the run, with the PizzaBox handlers registered
+        hdr : Header
+            the run
+        streams : sequence of str, optional
+            the analog streams to read, in column order. All of them, in
+            stream order, by default
+        how : {'inner', 'outer'}, optional
+            see join_on_time
+        volts : bool, optional
+            the values in volts, else in ADC counts
+        processes : int, optional
+            parse each channel with this many processes, see read_chunks
+        max_workers : int, optional
+            the number of channels read at once, all of them by default
+
+        Returns
+        -------
+        block : AnalogBlock
+    '''
+    found = {stream_name: resource for stream_name, _, resource
+             in stream_resources(db, hdr, {ANALOG_SPEC})}
+    if streams is None:
+        streams = list(found)
+    missing = [name for name in streams if name not in found]
+    if missing:
+        raise ValueError("no analog stream {} in the run, it has "
+                         "{}".format(missing, sorted(found)))
+    if not streams:
+        raise ValueError("the run has no analog streams")
+
+    def read(name):
+        return read_channel(db, found[name], volts, processes)
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(streams)) as pool:
+        channels = list(pool.map(read, streams))
+    time_ns, values = join_on_time([times for times, _ in channels],
+                                   [values for _, values in channels],
+                                   how=how)
+    return AnalogBlock(time_ns, values, tuple(streams))
+
+
+def join_on_time(times, values, how='inner'):
+    ''' Join channels onto one time axis.
+
+        Parameters
+        ----------
+        times : list of arrays of int
+            the timestamps of each channel, int64 nanoseconds
+        values : list of arrays
+            the values of each channel, as long as its timestamps
+        how : {'inner', 'outer'}, optional
+            'inner' keeps the timestamps all the channels have, the usual
+            case of channels sampled together. 'outer' keeps the timestamps
+            any channel has, NaN where a channel has no sample.
+
+        Returns
+        -------
+        time_ns : np.ndarray
+            the shared, increasing timestamps
+        values : np.ndarray
+            (n_samples, n_channels) float array
+
+        Out of order rows are sorted, and of rows with the same timestamp
+        in a channel only the first is kept.
+    '''
+    if how not in ('inner', 'outer'):
+        raise ValueError("how must be 'inner' or 'outer', "
+                         "got {!r}".format(how))
+    channels = [_sorted_unique(np.asarray(t, dtype=np.int64), np.asarray(v))
+                for t, v in zip(times, values)]
+    if how == 'inner':
+        shared = channels[0][0]
+        for t, _ in channels[1:]:
+            shared = shared[_matches(t, shared)[1]]
+    else:
+        shared = np.unique(np.concatenate([t for t, _ in channels]))
+
+    out = np.full((len(shared), len(channels)), np.nan)
+    for col, (t, v) in enumerate(channels):
+        pos, found = _matches(t, shared)
+        out[found, col] = v[pos[found]]
+    return shared, out
+
+
+def _matches(t, wanted):
+    ''' Where the wanted timestamps are in sorted t, and which are there.'''
+    if not len(t):
+        return (np.zeros(len(wanted), dtype=np.intp),
+                np.zeros(len(wanted), dtype=bool))
+    pos = np.minimum(np.searchsorted(t, wanted), len(t) - 1)
+    return pos, t[pos] == wanted
+
+
+def _sorted_unique(t, v):
+    if (np.diff(t) < 0).any():
+        order = np.argsort(t, kind='stable')
+        t, v = t[order], v[order]
+    keep = np.ones(len(t), dtype=bool)
+    keep[1:] = t[1:] != t[:-1]
+    if not keep.all():
+        t, v = t[keep], v[keep]
+    return t, v
+
+
+def read_channel(db, resource, volts=True, processes=1):
+    ''' The timestamps and values of one PizzaBox resource, from one bulk
+        read (see read_resource).
+
+        Parameters
+        ----------
+        db : Broker
+            the Broker of the run, with the PizzaBox handlers registered
+        resource : dict
+            the resource document, analog or encoder
+        volts : bool, optional
+            analog values in volts, else in ADC counts
+        processes : int, optional
+            see the handlers' read_chunks
+
+        Returns
+        -------
+        time_ns : np.ndarray
+            int64 nanoseconds since the epoch
+        values : np.ndarray
+            the ADC values of an analog resource, the encoder counts of
+            an encoder one
+    '''
+    datums = list(db.reg.datum_gen_given_resource(resource['uid']))
+    handler = db.reg.get_spec_handler(resource['uid'])
+    rows = read_resource(handler, datums, processes=processes)
+    # np.asarray takes record array fields and arrow columns alike
+    times = timestamps_ns(np.asarray(rows['ts_s']), np.asarray(rows['ts_ns']))
+    if resource['spec'] != ANALOG_SPEC:
+        return times, np.asarray(rows['encoder'])
+    values = decode_adc(np.asarray(rows['adc']), bits=handler.adc_bits,
+                        shift=handler.adc_shift,
+                        volts_per_count=handler.volts_per_count if volts
+                        else None)
+    return times, values
@@ -0,0 +1,56 @@
+''' Arrow output of the PizzaBox handlers.
+
+    With ``output='arrow'`` the text handlers return pyarrow RecordBatches
+    (chunks) and Tables (read_chunks) instead of record arrays. The text is
+    parsed into contiguous int64 columns (parse_pizzabox_columns) and the
+    Arrow arrays are made on top of those buffers, with no copy, so
+    pandas, polars or DuckDB get the data as parsed.
+
+    Needs pyarrow.
+'''
+import numpy as np
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("the arrow output of the PizzaBox handlers needs "
+                          "pyarrow")
+
+
+def schema(fields):
+    ''' The schema of PizzaBox rows with these fields, all int64.'''
+    _require_pyarrow()
+    return pa.schema([(name, pa.int64()) for name in fields])
+
+
+def record_batch(columns):
+    ''' A RecordBatch over a {field: contiguous array} dict, no copy.'''
+    _require_pyarrow()
+    return pa.RecordBatch.from_arrays([pa.array(values)
+                                       for values in columns.values()],
+                                      names=list(columns))
+
+
+def to_record_batch(data):
+    ''' A RecordBatch of a record array. The fields of a record array are
+        interleaved, this copies each of them into a column.'''
+    return record_batch({name: np.ascontiguousarray(data[name])
+                         for name in data.dtype.names})
+
+
+def to_table(batches, fields):
+    ''' A Table of RecordBatches (or Tables) with these fields.'''
+    _require_pyarrow()
+    tables = [pa.Table.from_batches([part])
+              if isinstance(part, pa.RecordBatch) else part
+              for part in batches]
+    if not tables:
+        return schema(fields).empty_table()
+    # the metadata of the parts (their integrity statistics) is not that
+    # of the whole
+    return pa.concat_tables(tables).replace_schema_metadata(None)
@@ -0,0 +1,188 @@
+''' Interpolate many scans at once, in a pool of processes.
+
+    Each scan goes through interpolate_and_save in a worker process, as it
+    would on its own, so the files written are those of the serial path.
+    A scan that fails is reported, with its traceback, and the others go
+    on.
+
+    From the command line::
+
+        qastools-interpolate --db qas --db-analysis qas-analysis \\
+            --processes 32 09645d0a-cdb1-444e-96d1-3ec7e9f0795b ...
+        qastools-interpolate --db qas --db-analysis qas-analysis \\
+            --query '{"scan_id": {"$gte": 4100, "$lt": 4400}}'
+'''
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import os
+import sys
+import time
+import traceback
+
+from .cache import InterpolatedCache
+
+
+def interpolate_uid(db_name, db_analysis_name, uid, cache_dir=None,
+                    **kwargs):
+    ''' Interpolate one scan, catching what goes wrong.
+
+        Parameters
+        ----------
+        db_name, db_analysis_name, uid :
+            as for interpolate_and_save
+        cache_dir : str, optional
+            the directory of an InterpolatedCache to use
+        kwargs :
+            passed on to interpolate_and_save
+
+        Returns
+        -------
+        outcome : dict
+            'uid', 'ok', 'seconds', and the 'scan_id',
+            'interp_df_filename' and 'bin_df_filename' of the scan, or the
+            'error' and its 'traceback' when it failed
+    '''
+    t0 = time.perf_counter()
+    outcome = dict(uid=uid, ok=False)
+    try:
+        # here so that a worker can import it, a pool may spawn processes
+        from .interpolation import interpolate_and_save
+        cache = None
+        if cache_dir is not None:
+            cache = InterpolatedCache(cache_dir)
+        result = interpolate_and_save(db_name, db_analysis_name, uid,
+                                      cache=cache, **kwargs)
+        outcome.update(ok=True, scan_id=result['scan_id'],
+                       interp_df_filename=result['interp_df_filename'],
+                       bin_df_filename=result['bin_df_filename'])
+    except Exception as error:
+        outcome.update(error='{}: {}'.format(type(error).__name__, error),
+                       traceback=traceback.format_exc())
+    outcome['seconds'] = time.perf_counter() - t0
+    return outcome
+
+
+def interpolate_batch(db_name, db_analysis_name, uids, processes=None,
+                      cache_dir=None, progress=None, **kwargs):
+    ''' Interpolate scans in a pool of processes.
+
+        Parameters
+        ----------
+        db_name, db_analysis_name :
+            as for interpolate_and_save
+        uids : list of str
+            the scans, a uid given twice is done once
+        processes : int, optional
+            the size of the pool, defaults to the number of cores. 1 runs
+            the scans one after the other in this process.
+        cache_dir : str, optional
+            see interpolate_uid
+        progress : callable, optional
+            called as progress(ndone, ntotal, outcome) as each scan ends
+        kwargs :
+            passed on to interpolate_and_save, e.g. mono_name
+
+        Returns
+        -------
+        outcomes : list of dict
+            one per uid, in the order of uids, see interpolate_uid
+    '''
+    uids = list(dict.fromkeys(uids))
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(uids)))
+    outcomes = {}
+
+    def done(outcome):
+        outcomes[outcome['uid']] = outcome
+        if progress is not None:
+            progress(len(outcomes), len(uids), outcome)
+
+    if processes == 1:
+        for uid in uids:
+            done(interpolate_uid(db_name, db_analysis_name, uid,
+                                 cache_dir=cache_dir, **kwargs))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            tasks = {pool.submit(interpolate_uid, db_name, db_analysis_name,
+                                 uid, cache_dir=cache_dir, **kwargs): uid
+                     for uid in uids}
+            for task in as_completed(tasks):
+                try:
+                    outcome = task.result()
+                except Exception as error:
+                    # the worker itself died, e.g. out of memory
+                    outcome = dict(uid=tasks[task], ok=False, seconds=None,
+                                   error='{}: {}'.format(
+                                       type(error).__name__, error),
+                                   traceback=traceback.format_exc())
+                done(outcome)
+    return [outcomes[uid] for uid in uids]
+
+
+def query_uids(db, query):
+    ''' The uids of the scans matching a databroker query (a dict).'''
+    return [hdr.start['uid'] for hdr in db(**query)]
+
+
+def print_progress(ndone, ntotal, outcome, file=sys.stderr):
+    ''' The progress reporting of the command line.'''
+    if outcome['ok']:
+        status = 'ok in {:.1f} s'.format(outcome['seconds'])
+    else:
+        status = 'FAILED: ' + outcome['error']
+    print('[{}/{}] {} {}'.format(ndone, ntotal, outcome['uid'], status),
+          file=file, flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Interpolate and bin QAS scans in a pool of processes.")
+    parser.add_argument('uids', nargs='*', help="the scans")
+    parser.add_argument('--db', required=True, help="Broker name")
+    parser.add_argument('--db-analysis', required=True,
+                        help="Broker name of the analysis store")
+    parser.add_argument('--query',
+                        help="also the scans matching this databroker "
+                             "query, a JSON object")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="size of the pool, one per core by default")
+    parser.add_argument('--cache', help="InterpolatedCache directory")
+    parser.add_argument('--mono-name', default='mono1_enc')
+    parser.add_argument('--pulses-per-degree', type=float, default=None)
+    parser.add_argument('--engine', choices=('isstools', 'native'),
+                        default='isstools')
+    parser.add_argument('--binning', choices=('isstools', 'native'),
+                        default='isstools')
+    args = parser.parse_args(argv)
+
+    uids = list(args.uids)
+    if args.query is not None:
+        from databroker import Broker
+        uids += query_uids(Broker.named(args.db), json.loads(args.query))
+    if not uids:
+        parser.error("no scans, give uids or --query")
+
+    outcomes = interpolate_batch(args.db, args.db_analysis, uids,
+                                 processes=args.processes,
+                                 cache_dir=args.cache,
+                                 progress=print_progress,
+                                 mono_name=args.mono_name,
+                                 pulses_per_degree=args.pulses_per_degree,
+                                 engine=args.engine,
+                                 binning=args.binning)
+    failed = [outcome for outcome in outcomes if not outcome['ok']]
+    print("{} scans, {} failed".format(len(outcomes), len(failed)),
+          file=sys.stderr)
+    for outcome in failed:
+        print('\n{}\n{}'.format(outcome['uid'], outcome['traceback']),
+              file=sys.stderr)
+    for outcome in outcomes:
+        if outcome['ok']:
+            print(outcome['bin_df_filename'])
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,409 @@
+''' Binning of interpolated XAS scans onto an energy grid.
+
+    The grid is made of a pre-edge part with a coarse energy step, a XANES
+    part with a fine step, and an EXAFS part with a constant step in k.
+    Each grid point gets a gaussian window over the measured energies, as
+    wide as the spacing of the grid around it, after the xas binning of
+    isstools. The grid and the window widths at its ends are not those of
+    gen_parser.bin, and the results have not been compared with it. The
+    windows are cut at TRUNCATE sigma and kept as a scipy.sparse matrix of
+    weights, so all the channels of a scan are binned with one sparse
+    product::
+
+        grid = energy_grid(e0, e0 - 30, e0 + 30, 4, 0.2, 0.04,
+                           energy.min(), energy.max())
+        weights = BinMatrix(grid, energy)
+        binned = weights.apply(values)      # (n_points, n_channels)
+
+    The grids and matrices are memoized by a BinningCache, in memory and
+    optionally on disk (see BinningCache.persist), so binning again at the
+    same edge skips building them, see bin_dataframe.
+
+    Needs scipy.
+'''
+import hashlib
+import os
+
+import numpy as np
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+try:
+    from scipy import sparse
+except ImportError:
+    sparse = None
+
+from .cache import MemoryCache, evict_lru, write_atomic
+
+# the gaussian windows are cut this many sigmas from their center
+TRUNCATE = 5
+# fwhm of a gaussian over its sigma
+_FWHM_PER_SIGMA = 2 * np.sqrt(np.log(4))
+# the default binning of bin_data: edge_start and edge_end relative to e0,
+# pre-edge and XANES steps in eV, EXAFS step in inverse angstroms
+EDGE_START = -30
+EDGE_END = 30
+PREEDGE_SPACING = 4
+XANES_SPACING = 0.2
+EXAFS_K_SPACING = 0.04
+
+
+def _require_scipy():
+    if sparse is None:
+        raise ImportError("the binning matrices need scipy")
+
+
+def _require_pandas():
+    if pd is None:
+        raise ImportError("bin_dataframe needs pandas")
+
+
+def e2k(energy, e0):
+    ''' The photoelectron wavenumber (1/angstrom) of energy (eV) above e0.'''
+    return 16.2009 * np.sqrt((np.asarray(energy) - e0) / 1000)
+
+
+def k2e(k, e0):
+    ''' The energy (eV) of photoelectron wavenumber k above e0.'''
+    return 1000 / 16.2009**2 * np.asarray(k)**2 + e0
+
+
+def energy_grid(e0, edge_start, edge_end, preedge_spacing, xanes_spacing,
+                exafs_k_spacing, emin, emax):
+    ''' The energies to bin onto.
+
+        Parameters
+        ----------
+        e0 : float
+            the edge energy
+        edge_start, edge_end : float
+            the XANES range, absolute energies
+        preedge_spacing, xanes_spacing : float
+            the steps below edge_start and up to edge_end, in eV
+        exafs_k_spacing : float
+            the step above edge_end, in k
+        emin, emax : float
+            the measured energy range, the grid stays within it
+
+        Returns
+        -------
+        grid : np.ndarray
+            increasing energies
+
+        The pre-edge points step down from edge_start, so that the grid
+        of an edge does not depend on where the scan starts.
+    '''
+    npre = int(np.floor((edge_start - emin) / preedge_spacing))
+    preedge = edge_start - preedge_spacing * np.arange(max(npre, 0), 0, -1)
+    edge = np.arange(edge_start, edge_end, xanes_spacing)
+    # k of edge_end is measured from e0
+    k_end = e2k(edge_end, e0) if edge_end > e0 else 0
+    k_max = e2k(max(emax, edge_end), e0)
+    nexafs = int(np.floor((k_max - k_end) / exafs_k_spacing))
+    exafs = k2e(k_end + exafs_k_spacing * np.arange(1, nexafs + 1), e0)
+    grid = np.concatenate((preedge, edge, exafs))
+    return grid[(grid >= emin) & (grid <= emax)]
+
+
+def window_width(points):
+    ''' The width of the interval each point stands for, half way to its
+        neighbours (the ends as wide as their neighbour).'''
+    points = np.asarray(points, dtype=float)
+    if len(points) < 3:
+        return np.full(len(points), np.ptp(points) if len(points) else 0.)
+    d = np.diff(points)
+    width = (d[1:] + d[:-1]) / 2
+    return np.concatenate((width[:1], width, width[-1:]))
+
+
+class BinMatrix:
+    ''' The gaussian binning weights of measured energies onto a grid.
+
+        Row i weighs the measured points within TRUNCATE sigma of grid[i],
+        for a gaussian with the fwhm of window_width(grid)[i], each point
+        also weighed by its own window width. The rows sum to one.
+
+        Parameters
+        ----------
+        grid : array
+            the increasing energies to bin onto
+        energy : array
+            the measured energies, in any order
+        truncate : float, optional
+            where the windows are cut, in sigmas
+
+        Attributes
+        ----------
+        matrix : scipy.sparse.csr_matrix
+            (len(grid), len(energy)) weights
+        empty : np.ndarray
+            the grid points with no measured point in their window, NaN
+            once binned
+    '''
+    def __init__(self, grid, energy, truncate=TRUNCATE):
+        _require_scipy()
+        self.grid = np.asarray(grid, dtype=float)
+        energy = np.asarray(energy, dtype=float)
+        order = np.argsort(energy, kind='stable')
+        sorted_energy = energy[order]
+
+        sigma = window_width(self.grid) / _FWHM_PER_SIGMA
+        first = np.searchsorted(sorted_energy, self.grid - truncate * sigma,
+                                side='left')
+        last = np.searchsorted(sorted_energy, self.grid + truncate * sigma,
+                               side='right')
+        counts = last - first
+        # the (row, sorted position) of every weight, row by row
+        rows = np.repeat(np.arange(len(self.grid)), counts)
+        row_starts = np.cumsum(counts) - counts
+        pos = np.arange(counts.sum()) - np.repeat(row_starts - first, counts)
+
+        z = (sorted_energy[pos] - self.grid[rows]) / sigma[rows]
+        weights = np.exp(-0.5 * z**2) / sigma[rows]
+        weights *= window_width(sorted_energy)[pos]
+        totals = np.bincount(rows, weights=weights, minlength=len(self.grid))
+        self.empty = totals == 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weights /= totals[rows]
+        self.matrix = sparse.csr_matrix(
+            (weights, order[pos], np.concatenate(([0], np.cumsum(counts)))),
+            shape=(len(self.grid), len(energy)))
+
+    @property
+    def nbytes(self):
+        return (self.grid.nbytes + self.empty.nbytes + self.matrix.data.nbytes
+                + self.matrix.indices.nbytes + self.matrix.indptr.nbytes)
+
+    def save(self, f):
+        ''' Write the weights to f, a path or a binary file.'''
+        np.savez(f, grid=self.grid, empty=self.empty, data=self.matrix.data,
+                 indices=self.matrix.indices, indptr=self.matrix.indptr,
+                 shape=self.matrix.shape)
+
+    @classmethod
+    def load(cls, path):
+        ''' The weights saved to path.'''
+        _require_scipy()
+        with np.load(path) as saved:
+            weights = cls.__new__(cls)
+            weights.grid = saved['grid']
+            weights.empty = saved['empty']
+            weights.matrix = sparse.csr_matrix(
+                (saved['data'], saved['indices'], saved['indptr']),
+                shape=tuple(saved['shape']))
+        return weights
+
+    def apply(self, values):
+        ''' Bin values measured at the energies.
+
+            Parameters
+            ----------
+            values : array
+                (len(energy),) or (len(energy), n_channels)
+
+            Returns
+            -------
+            binned : np.ndarray
+                (len(grid),) or (len(grid), n_channels)
+        '''
+        binned = self.matrix @ np.asarray(values, dtype=float)
+        binned[self.empty] = np.nan
+        return binned
+
+
+class _GridEntry:
+    ''' A grid built for energies emin to emax, see BinningCache.grid.'''
+    def __init__(self, grid, emin, emax):
+        self.grid = grid
+        self.emin = emin
+        self.emax = emax
+
+    @property
+    def nbytes(self):
+        return self.grid.nbytes
+
+    def cut(self, emin, emax):
+        first = np.searchsorted(self.grid, emin, side='left')
+        last = np.searchsorted(self.grid, emax, side='right')
+        return self.grid[first:last]
+
+    def save(self, f):
+        np.savez(f, grid=self.grid, emin=self.emin, emax=self.emax)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            return cls(saved['grid'], float(saved['emin']),
+                       float(saved['emax']))
+
+
+class BinningCache:
+    ''' Memoized binning grids and matrices.
+
+        The grid of an edge only depends on e0 and the binning parameters
+        (see energy_grid). It is built once, over the widest energy range
+        asked for, and cut to the range of each scan. The BinMatrix of a
+        scan is kept too, keyed on a digest of its energies, so binning the
+        same scan again costs only the product.
+
+        Entries live in an in process LRU. With a directory they are also
+        written there, and read back by later processes, e.g. the workers
+        of a restarted pool.
+
+        Parameters
+        ----------
+        max_bytes : int, optional
+            the size budget in memory, defaults to 256 MiB
+        directory : str, optional
+            where to keep the entries on disk, created if needed
+        max_disk_bytes : int, optional
+            the size budget of the directory, defaults to 1 GiB
+    '''
+    suffix = '.npz'
+
+    def __init__(self, max_bytes=2**28, directory=None,
+                 max_disk_bytes=2**30):
+        self.memory = MemoryCache(max_bytes)
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        # lookups found in memory or on disk, and built
+        self.hits = 0
+        self.misses = 0
+        if directory is not None:
+            self.persist(directory)
+
+    def persist(self, directory):
+        ''' Keep the entries in directory from now on, e.g. for the cache
+            shared by the process::
+
+                binning_cache.persist('/tmp/qastools-binning')
+        '''
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def grid(self, params, emin, emax):
+        ''' energy_grid(*params, emin, emax).
+
+            Parameters
+            ----------
+            params : tuple
+                (e0, edge_start, edge_end, preedge_spacing, xanes_spacing,
+                exafs_k_spacing), see energy_grid
+            emin, emax : float
+                the measured energy range
+        '''
+        key = ('grid',) + _params_key(params)
+        entry = self._get(key, _GridEntry)
+        if entry is None or emin < entry.emin or emax > entry.emax:
+            lo, hi = emin, emax
+            if entry is not None:
+                # a wider range than before, the grid only grows
+                lo, hi = min(lo, entry.emin), max(hi, entry.emax)
+            entry = _GridEntry(energy_grid(*params, lo, hi), lo, hi)
+            self._put(key, entry)
+        return entry.cut(emin, emax)
+
+    def matrix(self, params, energy, truncate=TRUNCATE):
+        ''' The BinMatrix of energy onto the grid of params.'''
+        energy = np.ascontiguousarray(energy, dtype=float)
+        digest = hashlib.sha1(energy.tobytes()).hexdigest()
+        key = (('matrix',) + _params_key(params) +
+               (float(truncate), len(energy), digest))
+        weights = self._get(key, BinMatrix)
+        if weights is None:
+            grid = self.grid(params, np.nanmin(energy), np.nanmax(energy))
+            weights = BinMatrix(grid, energy, truncate)
+            self._put(key, weights)
+        return weights
+
+    def clear(self):
+        ''' Empty the memory, the directory is left as is.'''
+        self.memory.clear()
+
+    def _path(self, key):
+        name = hashlib.sha1(repr(key).encode()).hexdigest() + self.suffix
+        return os.path.join(self.directory, name)
+
+    def _get(self, key, cls):
+        value = self.memory.get(key)
+        if value is None and self.directory is not None:
+            path = self._path(key)
+            try:
+                value = cls.load(path)
+            except FileNotFoundError:
+                pass
+            else:
+                # the modification time of the entry marks its last use
+                os.utime(path)
+                self.memory.put(key, value)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def _put(self, key, value):
+        self.memory.put(key, value)
+        if self.directory is None:
+            return
+        write_atomic(self._path(key), value.save)
+        evict_lru(self.directory, self.suffix, self.max_disk_bytes)
+
+
+def _params_key(params):
+    if len(params) != 6:
+        raise ValueError("params are (e0, edge_start, edge_end, "
+                         "preedge_spacing, xanes_spacing, exafs_k_spacing), "
+                         "got {!r}".format(params))
+    return tuple(float(value) for value in params)
+
+
+# shared by the binning of this process
+binning_cache = BinningCache()
+
+
+def bin_dataframe(interp_df, e0, edge_start=None, edge_end=None,
+                  preedge_spacing=PREEDGE_SPACING, xanes_spacing=XANES_SPACING,
+                  exafs_k_spacing=EXAFS_K_SPACING, cache=binning_cache):
+    ''' Bin an interp_df, all the channels in one go.
+
+        Parameters
+        ----------
+        interp_df : pandas.DataFrame
+            with an 'energy' column, see qastools.engine
+        e0 : float
+            the edge energy
+        edge_start, edge_end : float, optional
+            the XANES range, e0 + EDGE_START and e0 + EDGE_END by default
+        preedge_spacing, xanes_spacing, exafs_k_spacing : float, optional
+            see energy_grid
+        cache : BinningCache, optional
+            where the grid and matrix are memoized, the one shared by the
+            process by default. None to build them every time.
+
+        Returns
+        -------
+        bin_df : pandas.DataFrame
+            'energy' then the other columns but 'timestamp', binned
+    '''
+    _require_pandas()
+    if edge_start is None:
+        edge_start = e0 + EDGE_START
+    if edge_end is None:
+        edge_end = e0 + EDGE_END
+    energy = interp_df['energy'].values
+    params = (e0, edge_start, edge_end, preedge_spacing, xanes_spacing,
+              exafs_k_spacing)
+    if cache is None:
+        weights = BinMatrix(energy_grid(*params, np.nanmin(energy),
+                                        np.nanmax(energy)), energy)
+    else:
+        weights = cache.matrix(params, energy)
+    columns = [name for name in interp_df.columns
+               if name not in ('energy', 'timestamp')]
+    binned = weights.apply(interp_df[columns].values)
+    bin_df = pd.DataFrame(binned, columns=columns)
+    bin_df.insert(0, 'energy', weights.grid)
+    return bin_df
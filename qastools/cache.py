@@ -0,0 +1,332 @@
+''' Caches of parsed PizzaBox data.
+
+    ParsedFileCache keeps the parsed columns of whole files as .npy files in
+    a local directory, so that later handlers can memory map them instead
+    of parsing the text again.
+
+    MemoryCache is an in process LRU, the handlers share their line indexes
+    and parsed chunks through `memory_cache` so that a new handler on the
+    same file (databroker makes one per resource) starts warm.
+
+    InterpolatedCache keeps interpolated scans, so that a scan can be
+    binned again without reading and interpolating it again (see
+    qastools.interpolation.rebin).
+'''
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+from .engine import ENGINE_VERSION
+from .fileindex import resolve_path
+from .parsing import row_dtype
+
+
+class ParsedFileCache:
+    ''' On disk cache of parsed PizzaBox files.
+
+        Entries are keyed on the path, size and modification time of the
+        text file (and on the columns parsed out of it), so a file that is
+        rewritten is parsed again. The least recently used entries are
+        removed once the cache holds more than max_bytes.
+
+        The cache is opt-in, hand it to the handlers when registering them::
+
+            cache = ParsedFileCache('/tmp/qastools-cache')
+            db.reg.register_handler(
+                'PIZZABOX_ENC_FILE_TXT',
+                functools.partial(PizzaBoxEncHandlerTxt, cache=cache))
+
+        Parameters
+        ----------
+        directory : str
+            where the .npy files are kept, created if needed
+        max_bytes : int, optional
+            the size budget of the cache directory, defaults to 10 GiB
+    '''
+    suffix = '.npy'
+
+    def __init__(self, directory, max_bytes=10 * 2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, fpath, columns, bases=None):
+        ''' The cache file of the current version of fpath.'''
+        stat = os.stat(resolve_path(fpath))
+        key = '\0'.join([os.path.abspath(fpath), str(stat.st_size),
+                         str(stat.st_mtime_ns), repr(tuple(columns)),
+                         repr(bases)])
+        name = hashlib.sha1(key.encode()).hexdigest() + self.suffix
+        return os.path.join(self.directory, name)
+
+    def load(self, fpath, columns, bases=None):
+        ''' The cached rows of fpath, memory mapped, or None on a miss.'''
+        path = self.path(fpath, columns, bases)
+        try:
+            data = np.load(path, mmap_mode='r')
+        except FileNotFoundError:
+            return None
+        # the modification time of the entry marks its last use
+        os.utime(path)
+        return data.view(np.recarray)
+
+    def store(self, fpath, columns, bases, nrows, fill):
+        ''' Create the entry of fpath and return it, memory mapped.
+
+            Parameters
+            ----------
+            fpath : str
+                the text file
+            columns, bases :
+                as for parse_pizzabox
+            nrows : int
+                the number of rows in the file
+            fill : callable
+                called with the (nrows,) record array to fill in, returns
+                the number of rows it wrote
+
+            Returns None, keeping nothing, when fill comes short of nrows
+            (lines of the file left out as malformed): the handlers read
+            chunks by line number, which the rows would no longer match.
+        '''
+        path = self.path(fpath, columns, bases)
+
+        def write(tmp_path):
+            out = np.lib.format.open_memmap(tmp_path, mode='w+',
+                                            dtype=row_dtype(columns),
+                                            shape=(nrows,))
+            rows = fill(out.view(np.recarray))
+            out.flush()
+            del out
+            return rows is None or rows >= nrows
+
+        if not write_atomic(path, write, open_file=False):
+            return None
+        data = np.load(path, mmap_mode='r').view(np.recarray)
+        self.evict()
+        return data
+
+    def evict(self):
+        ''' Remove the least recently used entries until within budget.'''
+        evict_lru(self.directory, self.suffix, self.max_bytes)
+
+
+class InterpolatedCache:
+    ''' On disk cache of interpolated scans.
+
+        An entry holds the interp_df of a scan as a .npy record array of
+        float64 columns, memory mapped when loaded, with a .json file of
+        metadata next to it (e0, scan_id, ...). Entries are keyed on what
+        the interpolation depends on: the uid of the scan, the pulses per
+        degree and stream of the mono encoder, the engine that
+        interpolated it ('native' or 'isstools') and, for the native one,
+        ENGINE_VERSION, so a change of the engine does not serve stale
+        numbers.
+
+        Parameters
+        ----------
+        directory : str
+            where the entries are kept, created if needed
+        max_bytes : int, optional
+            the size budget of the directory, defaults to 10 GiB
+    '''
+    suffix = '.npy'
+
+    def __init__(self, directory, max_bytes=10 * 2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, uid, pulses_per_degree, mono_name, engine='native'):
+        ''' The .npy file of the entry, the .json one is next to it.'''
+        version = ENGINE_VERSION if engine == 'native' else None
+        key = repr((uid, float(pulses_per_degree), mono_name, engine,
+                    version))
+        name = hashlib.sha1(key.encode()).hexdigest() + self.suffix
+        return os.path.join(self.directory, name)
+
+    def load(self, uid, pulses_per_degree, mono_name, engine='native'):
+        ''' The cached scan, or None on a miss.
+
+            Returns
+            -------
+            data : np.recarray
+                the columns of the interp_df, memory mapped
+            md : dict
+                the metadata stored with it
+        '''
+        path = self.path(uid, pulses_per_degree, mono_name, engine)
+        try:
+            data = np.load(path, mmap_mode='r')
+            with open(_md_path(path)) as f:
+                md = json.load(f)
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return data.view(np.recarray), md
+
+    def store(self, uid, pulses_per_degree, mono_name, interp_df,
+              engine='native', **md):
+        ''' Keep interp_df (a DataFrame, or anything with columns and
+            column values) made by engine and the metadata md, json
+            serializable, of the scan.
+
+            Returns
+            -------
+            path : str
+                the .npy file written
+        '''
+        path = self.path(uid, pulses_per_degree, mono_name, engine)
+        columns = [str(name) for name in interp_df.columns]
+        data = np.empty(len(interp_df),
+                        dtype=[(name, np.float64) for name in columns])
+        for name, column in zip(columns, interp_df.columns):
+            data[name] = interp_df[column]
+        md = dict(md, uid=uid, pulses_per_degree=float(pulses_per_degree),
+                  mono_name=mono_name, engine=engine,
+                  engine_version=ENGINE_VERSION)
+        # an entry is complete, and loaded, once its metadata is there
+        write_atomic(path, lambda f: np.save(f, data))
+        write_atomic(_md_path(path),
+                     lambda f: f.write(json.dumps(md).encode()))
+        self.evict()
+        return path
+
+    def evict(self):
+        ''' Remove the least recently used entries until within budget.'''
+        evict_lru(self.directory, self.suffix, self.max_bytes)
+        # metadata left behind by the entries removed
+        for entry in os.scandir(self.directory):
+            if (entry.name.endswith('.json') and not
+                    os.path.exists(entry.path[:-len('.json')] + self.suffix)):
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+
+def _md_path(path):
+    return os.path.splitext(path)[0] + '.json'
+
+
+def write_atomic(path, write, open_file=True):
+    ''' Write path so that readers in other processes never see a partial
+        file: it is written next to the final name and moved in place once
+        complete.
+
+        Parameters
+        ----------
+        path : str
+            the file to write, replaced if it exists
+        write : callable
+            called with the temporary file, open for binary writing, or
+            with its path when open_file is False (for writers that open
+            the file themselves). Returning False gives up, path is left
+            as it is.
+        open_file : bool, optional
+            see write
+
+        Returns
+        -------
+        written : bool
+            False if write gave up
+    '''
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp',
+                                    dir=os.path.dirname(path) or '.')
+    try:
+        if open_file:
+            with os.fdopen(fd, 'wb') as f:
+                written = write(f) is not False
+        else:
+            os.close(fd)
+            written = write(tmp_path) is not False
+        if written:
+            os.replace(tmp_path, path)
+        else:
+            os.remove(tmp_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return written
+
+
+def evict_lru(directory, suffix, max_bytes):
+    ''' Remove the least recently modified files ending in suffix from
+        directory until they hold max_bytes or less.'''
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.name.endswith(suffix):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # another process got there first
+            pass
+        total -= size
+
+
+class MemoryCache:
+    ''' In process LRU cache, bounded by the bytes its values hold.
+
+        Values are numpy arrays or anything with an ``nbytes`` attribute.
+        Values bigger than the whole budget are not kept. Safe to use from
+        several threads.
+
+        Parameters
+        ----------
+        max_bytes : int, optional
+            the size budget, defaults to 1 GiB. 0 keeps nothing.
+    '''
+    def __init__(self, max_bytes=2**30):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        ''' The value of key, or None.'''
+        with self._lock:
+            try:
+                value, _ = self._entries[key]
+            except KeyError:
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        ''' Add value under key, then drop the least recently used values
+            until within budget.'''
+        nbytes = value.nbytes
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, old_nbytes) = self._entries.popitem(last=False)
+                self.nbytes -= old_nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+# shared by all the handlers of this process
+memory_cache = MemoryCache()
@@ -0,0 +1,150 @@
+''' Columnar HDF5 copies of the PizzaBox text files.
+
+    A converted file holds one int64 dataset per column, chunked along the
+    rows like the resource it comes from, so a chunk of one column is one
+    HDF5 chunk read. The size and mtime of the text file are kept as
+    attributes: a copy whose source changed since is ignored.
+
+    Needs h5py.
+'''
+import os
+
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+from .cache import write_atomic
+from .fileindex import resolve_path
+from .parsing import TIME_FIELD, row_dtype, timestamps_ns
+
+# distinct from any other .h5 file that may sit next to the text file
+SUFFIX = '.pbx.h5'
+# bound on the HDF5 chunk size, in rows
+MAX_H5_CHUNK = 2**20
+
+
+def converted_path(fpath):
+    ''' Where the columnar copy of text file fpath goes, next to it.'''
+    return os.path.splitext(fpath)[0] + SUFFIX
+
+
+def _require_h5py():
+    if h5py is None:
+        raise ImportError("the columnar PizzaBox files need h5py")
+
+
+def write_columnar(path, index, parse, columns, spec, compression='lzf'):
+    ''' Write the rows of a text file as an HDF5 file of columns.
+
+        Parameters
+        ----------
+        path : str
+            the HDF5 file to write, replaced if it exists
+        index : LineIndex
+            the index of the text file
+        parse : callable
+            parses a block of text into a record array with `columns`
+        columns : sequence of str
+            the columns to keep
+        spec : str
+            the spec of the text resource, kept as an attribute
+        compression : str, optional
+            HDF5 compression filter, None for none
+
+        Raises ValueError, writing nothing, when the text has blank lines:
+        the handlers read chunks by line number, which the rows would no
+        longer match.
+    '''
+    _require_h5py()
+    stat = os.stat(index.path)
+    nrows = index.nlines
+    h5_chunk = max(1, min(index.chunk_size, MAX_H5_CHUNK, nrows))
+
+    def write(tmp_path):
+        with h5py.File(tmp_path, 'w') as f:
+            f.attrs['spec'] = spec
+            f.attrs['columns'] = list(columns)
+            f.attrs['chunk_size'] = index.chunk_size
+            f.attrs['source_size'] = stat.st_size
+            f.attrs['source_mtime_ns'] = stat.st_mtime_ns
+            chunks = (h5_chunk,) if nrows else None
+            datasets = [f.create_dataset(name, shape=(nrows,),
+                                         dtype=np.int64, chunks=chunks,
+                                         compression=compression)
+                        for name in columns]
+            row = 0
+            for block in index.blocks():
+                data = parse(block)
+                for name, dataset in zip(columns, datasets):
+                    dataset[row:row + len(data)] = data[name]
+                row += len(data)
+        if row != nrows:
+            raise ValueError("{} has {} lines but {} rows, not "
+                             "converted".format(index.path, nrows, row))
+
+    write_atomic(path, write, open_file=False)
+
+
+class ColumnarFile:
+    ''' Rows of a columnar file, read as record arrays by slicing.
+
+        ``f[start:stop]`` reads just those rows of the selected columns.
+
+        Parameters
+        ----------
+        path : str
+            the HDF5 file
+        columns : sequence of str, optional
+            the columns to read, all of them by default
+        time_ns : bool, optional
+            add the 'time_ns' field, see parse_pizzabox
+    '''
+    def __init__(self, path, columns=None, time_ns=False):
+        _require_h5py()
+        self.path = path
+        with h5py.File(path, 'r') as f:
+            self.attrs = dict(f.attrs)
+            if 'columns' not in self.attrs:
+                raise ValueError("{} is not a columnar PizzaBox "
+                                 "file".format(path))
+            all_columns = tuple(str(name) for name in self.attrs['columns'])
+            missing = [name for name in all_columns if name not in f]
+            if missing:
+                raise ValueError("{} has no dataset {}".format(path,
+                                                               missing))
+            self.nrows = f[all_columns[0]].shape[0] if all_columns else 0
+        self.columns = all_columns if columns is None else tuple(columns)
+        missing = set(self.columns) - set(all_columns)
+        if missing:
+            raise ValueError("{} has no column {}".format(path,
+                                                          sorted(missing)))
+        self.time_ns = time_ns
+
+    def is_fresh(self, fpath):
+        ''' True if the text file fpath (or its compressed copy) did not
+            change since conversion.'''
+        stat = os.stat(resolve_path(fpath))
+        return (self.attrs['source_size'] == stat.st_size
+                and self.attrs['source_mtime_ns'] == stat.st_mtime_ns)
+
+    def __len__(self):
+        return self.nrows
+
+    def __getitem__(self, rows):
+        if not isinstance(rows, slice):
+            raise TypeError("columnar files are read by slices of rows")
+        start, stop, step = rows.indices(self.nrows)
+        if step != 1:
+            raise ValueError("only contiguous slices of rows are supported")
+        stop = max(start, stop)
+        data = np.empty(stop - start,
+                        dtype=row_dtype(self.columns, self.time_ns))
+        with h5py.File(self.path, 'r') as f:
+            for name in self.columns:
+                data[name] = f[name][start:stop]
+        if self.time_ns:
+            data[TIME_FIELD] = timestamps_ns(data['ts_s'], data['ts_ns'])
+        return data.view(np.recarray)
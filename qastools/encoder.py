@@ -0,0 +1,104 @@
+''' Conditioning of the PizzaBox encoder counts.
+
+    The encoder column is a hardware counter: it wraps around at 2**bits,
+    and now and then a single sample is garbage and the next one is back
+    on track. condition_encoder unwraps the counter and repairs (or only
+    finds) these spikes, working on the steps between samples so the
+    whole column is done with one diff and one cumsum.
+'''
+import numpy as np
+
+# the PizzaBox encoder counter
+COUNTER_BITS = 32
+# a step bigger than this, undone by the next step, is a glitch
+MAX_STEP = 2**14
+
+
+def condition_encoder(counts, bits=COUNTER_BITS, max_step=MAX_STEP,
+                      repair=True):
+    ''' Unwrap a counter and repair single sample glitches.
+
+        Parameters
+        ----------
+        counts : array of int
+            the raw encoder column, e.g. PizzaBoxEncHandlerTxt rows.encoder
+        bits : int, optional
+            the width of the counter. Values are taken as two's complement,
+            so the first sample of a counter written unsigned comes out
+            negative when its top bit is set.
+        max_step : int, optional
+            a sample moving more than this from the one before, and back
+            within max_step of it on the next sample, is a glitch
+        repair : bool, optional
+            replace glitches by the midpoint of their neighbours, else only
+            report them
+
+        Returns
+        -------
+        encoder : np.ndarray
+            int64 continuous counts
+        stats : dict
+            'nrows', 'rollovers' (the number of wraps undone, not counting
+            glitches), 'glitches' (their indices), 'min' and 'max' of the
+            returned counts
+    '''
+    counts = np.asarray(counts, dtype=np.int64)
+    half = 1 << (bits - 1)
+    full = 1 << bits
+    out = np.empty(len(counts), dtype=np.int64)
+    stats = dict(nrows=len(counts), rollovers=0,
+                 glitches=np.empty(0, dtype=np.intp), min=None, max=None)
+    if not len(counts):
+        return out, stats
+
+    raw_steps = steps = np.diff(counts)
+    # a step of more than half the counter range is a wrap around
+    wraps = (steps >= half) | (steps < -half)
+    if wraps.any():
+        steps = (steps + half) % full - half
+
+    glitches = find_glitches(steps, max_step)
+    stats['glitches'] = glitches
+    # a glitch can look like a wrap there and back, that does not count,
+    # but a wrap of the counter next to it does
+    around = (steps[glitches - 1] + steps[glitches]
+              - raw_steps[glitches - 1] - raw_steps[glitches])
+    wraps[glitches - 1] = False
+    wraps[glitches] = False
+    stats['rollovers'] = int(np.count_nonzero(wraps)
+                             + (np.abs(around) // full).sum())
+    if repair and len(glitches):
+        # sample i sits between steps i-1 and i, spread their sum evenly
+        total = steps[glitches - 1] + steps[glitches]
+        steps[glitches - 1] = total // 2
+        steps[glitches] = total - total // 2
+
+    out[0] = (counts[0] + half) % full - half
+    np.cumsum(steps, out=out[1:])
+    out[1:] += out[0]
+    stats['min'] = int(out.min())
+    stats['max'] = int(out.max())
+    return out, stats
+
+
+def find_glitches(steps, max_step=MAX_STEP):
+    ''' The samples that jump away and straight back.
+
+        Parameters
+        ----------
+        steps : array of int
+            the differences between consecutive samples
+        max_step : int, optional
+            see condition_encoder
+
+        Returns
+        -------
+        glitches : np.ndarray
+            the indices of the bad samples, in sample numbers
+    '''
+    steps = np.asarray(steps)
+    big = np.abs(steps) > max_step
+    # sample i is reached by step i-1 and left by step i
+    candidates = np.flatnonzero(big[:-1] & big[1:]) + 1
+    back = np.abs(steps[candidates - 1] + steps[candidates]) <= max_step
+    return candidates[back]
@@ -0,0 +1,311 @@
+''' The interpolation of QAS fly scans, done in qastools.
+
+    This does what isstools' XASdataGeneric.load and .interpolate do for
+    interpolate_and_save, on the arrays the PizzaBox handlers read: the
+    mono encoder is turned into energy, and every other trace is
+    interpolated onto the timestamps of the energy. The ADC channels of a
+    PizzaBox share their timestamps, they are interpolated together as one
+    (n_samples, n_channels) block rather than one by one, and the traces
+    sampled much faster than the encoder are averaged down with one
+    reduceat instead of a mean per piece.
+
+    The result is the interp_df of isstools, same columns in the same
+    order::
+
+        interp_df = interpolate_run(db, hdr, pulses_per_degree)
+
+    Timestamps are kept as int64 nanoseconds throughout, and interpolated
+    as float offsets from the first timestamp, so no precision is lost to
+    float seconds since the epoch until the 'timestamp' column is made.
+
+    Runs with digital input (trigger) streams are refused: isstools
+    interpolates those too, so their interp_df would have other columns
+    and another time range, use the isstools engine for them.
+'''
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+from .analog import ANALOG_SPEC, read_channel
+from .fill import stream_resources
+
+# bumped whenever the numbers coming out change, see qastools.interpolation
+ENGINE_VERSION = 2
+ENC_SPEC = 'PIZZABOX_ENC_FILE_TXT'
+AN_SPEC = ANALOG_SPEC
+DI_SPEC = 'PIZZABOX_DI_FILE_TXT'
+# a trace with more than this many times the samples of the energy is
+# averaged down to as many samples before interpolating
+DOWNSAMPLE_FACTOR = 5
+# traces this short don't limit the time range
+MIN_SAMPLES = 5
+
+TraceBlock = namedtuple('TraceBlock', ['names', 'time', 'values'])
+TraceBlock.__doc__ = ''' Traces on a shared time axis.
+
+    names : the trace names, in column order
+    time : (n_samples,) int64 nanoseconds since the epoch
+    values : (n_samples, n_traces) float array
+'''
+
+
+def _require_pandas():
+    if pd is None:
+        raise ImportError("interp_df is a pandas DataFrame, this needs "
+                          "pandas")
+
+
+def encoder2energy(encoder, pulses_per_deg, offset=0):
+    ''' The energy (eV) of mono encoder counts, for the Si(111) crystal.
+
+        Parameters
+        ----------
+        encoder : array
+            the encoder counts
+        pulses_per_deg : float
+            encoder counts per degree of the mono
+        offset : float, optional
+            subtracted from the angle, in degrees
+    '''
+    angle = np.deg2rad(np.asarray(encoder) / pulses_per_deg - float(offset))
+    return -12400 / (2 * 3.1356 * np.sin(angle))
+
+
+def interpolate_run(db, hdr, pulses_per_degree, mono_name='mono1_enc',
+                    processes=1):
+    ''' The interp_df of a run.
+
+        Parameters
+        ----------
+        db : Broker
+            the Broker of the run, with the PizzaBox handlers registered
+        hdr : Header
+            the run
+        pulses_per_degree : float
+            see encoder2energy
+        mono_name : str, optional
+            the stream of the mono encoder
+        processes : int, optional
+            see the handlers' read_chunks
+
+        Returns
+        -------
+        interp_df : pandas.DataFrame
+            the 'timestamp' column then one column per trace
+    '''
+    blocks = load_traces(db, hdr, pulses_per_degree, mono_name=mono_name,
+                         processes=processes)
+    return to_dataframe(interpolate(blocks))
+
+
+def load_traces(db, hdr, pulses_per_degree, mono_name='mono1_enc',
+                processes=1, max_workers=None):
+    ''' Read the encoder and ADC traces of a run.
+
+        The mono encoder becomes the 'energy' trace, less the
+        'angle_offset' of the start document. An ADC channel is named
+        after its devname (the stream name if it has none), in volts less
+        the '<stream> offset' of the start document.
+
+        Returns
+        -------
+        blocks : list of TraceBlock
+            in stream order, the ADC channels sharing their timestamps
+            together in one block
+
+        Raises ValueError for a run with digital input streams, which
+        are not read.
+    '''
+    start = hdr.start
+    devnames = _devnames(hdr)
+    streams = [(stream_name, resource) for stream_name, _, resource
+               in stream_resources(db, hdr, {ENC_SPEC, AN_SPEC, DI_SPEC})]
+    di_streams = [stream_name for stream_name, resource in streams
+                  if resource['spec'] == DI_SPEC]
+    if di_streams:
+        raise ValueError("the run has digital input streams {}, which "
+                         "isstools interpolates and this engine does not, "
+                         "use the isstools engine".format(di_streams))
+    if not any(stream_name == mono_name for stream_name, _ in streams):
+        raise ValueError("no encoder stream {} in the run".format(mono_name))
+
+    # each channel keeps its own timestamps, as in isstools: the join of
+    # read_analog would drop the samples of channels not sampled together.
+    # group_traces puts back together those that are
+    def read(stream):
+        stream_name, resource = stream
+        time, values = read_channel(db, resource, processes=processes)
+        if resource['spec'] == AN_SPEC:
+            offset = start.get(stream_name + ' offset')
+            if offset is not None:
+                values = values - float(offset)
+            return devnames.get(stream_name, stream_name), time, values
+        if stream_name == mono_name:
+            values = encoder2energy(values, pulses_per_degree,
+                                    -float(start.get('angle_offset', 0)))
+            return 'energy', time, values
+        return stream_name, time, values
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(streams)) as pool:
+        traces = list(pool.map(read, streams))
+    return group_traces(traces)
+
+
+def group_traces(traces):
+    ''' Put consecutive traces with the same timestamps in one block.
+
+        Parameters
+        ----------
+        traces : list of (name, time, values)
+            time in int64 nanoseconds since the epoch
+
+        Returns
+        -------
+        blocks : list of TraceBlock
+    '''
+    blocks = []
+    names, time, columns = None, None, []
+    for name, trace_time, values in traces:
+        if names is not None and np.array_equal(trace_time, time):
+            names.append(name)
+            columns.append(values)
+            continue
+        if names is not None:
+            blocks.append(TraceBlock(tuple(names), time,
+                                     np.column_stack(columns)))
+        names = [name]
+        time = np.asarray(trace_time, dtype=np.int64)
+        columns = [values]
+    if names is not None:
+        blocks.append(TraceBlock(tuple(names), time,
+                                 np.column_stack(columns)))
+    return blocks
+
+
+def interpolate(blocks, base='energy'):
+    ''' Interpolate traces onto the timestamps of one of them.
+
+        The timestamps of the base trace are cut to the time range all
+        traces cover (leaving out those under MIN_SAMPLES samples for the
+        end of the range). A trace with more than DOWNSAMPLE_FACTOR times
+        as many samples is first averaged down to as many samples, in
+        consecutive pieces, see split_means. The traces of a block are
+        interpolated together, see interp_block.
+
+        Parameters
+        ----------
+        blocks : list of TraceBlock
+        base : str, optional
+            the trace giving the timestamps. The first trace if there is
+            none of that name.
+
+        Returns
+        -------
+        block : TraceBlock
+            all the traces, in order, on the base timestamps
+    '''
+    timestamps = blocks[0].time
+    for block in blocks:
+        if base in block.names:
+            timestamps = block.time
+            break
+    first = max(block.time[0] for block in blocks)
+    last = min(block.time[-1] for block in blocks
+               if len(block.time) > MIN_SAMPLES)
+    # as isstools does it, with the timestamps taken to be sorted
+    timestamps = timestamps[np.count_nonzero(timestamps < first):]
+    timestamps = timestamps[:len(timestamps) -
+                            np.count_nonzero(timestamps > last)]
+
+    # float nanoseconds from here are exact for over 100 days
+    origin = timestamps[0] if len(timestamps) else 0
+    x = (timestamps - origin).astype(float)
+    names, columns = [], []
+    for block in blocks:
+        time = (block.time - origin).astype(float)
+        values = np.asarray(block.values, dtype=float)
+        if (len(timestamps)
+                and len(time) > DOWNSAMPLE_FACTOR * len(timestamps)):
+            time = split_means(time, len(timestamps))
+            values = split_means(values, len(timestamps))
+        names.extend(block.names)
+        columns.append(interp_block(x, time, values))
+    return TraceBlock(tuple(names), timestamps, np.hstack(columns))
+
+
+def interp_block(x, xp, fp):
+    ''' np.interp of several columns at once.
+
+        Parameters
+        ----------
+        x : array
+            where to interpolate
+        xp : array
+            the increasing sample positions
+        fp : array
+            (len(xp), n_columns) samples
+
+        Returns
+        -------
+        values : np.ndarray
+            (len(x), n_columns), as np.interp(x, xp, fp[:, k]) for every
+            column k
+    '''
+    x = np.asarray(x, dtype=float)
+    xp = np.asarray(xp, dtype=float)
+    fp = np.asarray(fp, dtype=float)
+    if len(xp) < 2:
+        return np.repeat(fp[:1], len(x), axis=0)
+    # the sample at or before each x, found once for all the columns
+    j = np.clip(np.searchsorted(xp, x, side='right') - 1, 0, len(xp) - 2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (fp[j + 1] - fp[j]) / (xp[j + 1] - xp[j])[:, None]
+    out = slope * (x - xp[j])[:, None] + fp[j]
+    out[x < xp[0]] = fp[0]
+    out[x >= xp[-1]] = fp[-1]
+    return out
+
+
+def split_means(values, nparts):
+    ''' The means of np.array_split(values, nparts), along the first axis,
+        in one pass.'''
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    # array_split makes the first n % nparts pieces one longer
+    sizes = np.full(nparts, n // nparts)
+    sizes[:n % nparts] += 1
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    sums = np.add.reduceat(values, starts, axis=0)
+    return sums / sizes.reshape((-1,) + (1,) * (values.ndim - 1))
+
+
+def to_dataframe(block):
+    ''' The interp_df of an interpolated TraceBlock, its 'timestamp' in
+        float seconds since the epoch as isstools has it.'''
+    _require_pandas()
+    df = pd.DataFrame(block.values, columns=list(block.names))
+    df.insert(0, 'timestamp', ns_to_seconds(block.time))
+    return df
+
+
+def ns_to_seconds(time_ns):
+    ''' int64 nanoseconds as float seconds, rounded once.'''
+    time_ns = np.asarray(time_ns, dtype=np.int64)
+    return (time_ns // 10**9) + (time_ns % 10**9) * 1e-9
+
+
+def _devnames(hdr):
+    ''' {stream name: devname} of the streams that have one.'''
+    devnames = {}
+    for descriptor in hdr.descriptors:
+        stream_name = descriptor.get('name')
+        data_key = descriptor['data_keys'].get(stream_name, {})
+        if 'devname' in data_key:
+            devnames[stream_name] = data_key['devname']
+    return devnames
@@ -0,0 +1,332 @@
+''' Byte offset indexes into the PizzaBox text files.
+
+    Rather than holding a whole file in memory as a list of lines, the
+    handlers keep the byte offset where each chunk starts (one int64 per
+    chunk) and read just the bytes of the chunk they are asked for.
+
+    The text files may also be compressed with gzip or zstd (a '.gz' or
+    '.zst' file, possibly standing in for a missing '.txt'). Offsets are
+    then into the decompressed text, and while indexing the decompressor
+    state is saved every CHECKPOINT_SPACING bytes of text, so a chunk is
+    read by resuming from the checkpoint before it rather than from the
+    start of the file. zstd states cannot be saved, there the checkpoints
+    are the starts of the frames of the file (a file written as many
+    frames, e.g. by pzstd, seeks as well as gzip).
+'''
+from bisect import bisect_right
+import os
+import threading
+import zlib
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_NEWLINE = ord('\n')
+
+# how much of the file is looked at at once while indexing
+BLOCK_SIZE = 16 * 2**20
+# text bytes between saved decompressor states
+CHECKPOINT_SPACING = 2 * 2**20
+# compressed bytes fed to a decompressor at once
+_INPUT_BLOCK = 2**18
+# gzip header and trailer, 32K window
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+# rough size of a saved zlib state, mostly its window
+_STATE_NBYTES = 2**16
+
+
+def _read_at(f, offset, nbytes):
+    ''' Read nbytes of file f from offset, all raw reads go through here.'''
+    return os.pread(f.fileno(), nbytes, offset)
+
+
+class LineIndex:
+    ''' Byte offsets of every chunk_size-th line of a text file.
+
+        Parameters
+        ----------
+        fpath : str
+            the text file, see resolve_path for compressed ones
+        chunk_size : int
+            the number of lines in a chunk
+
+        Attributes
+        ----------
+        path : str
+            the file actually read
+        offsets : np.ndarray
+            int64 offset of the start of each chunk, followed by the file
+            size. Chunk k is the bytes ``offsets[k]:offsets[k+1]``.
+        nlines : int
+            the number of lines in the file
+    '''
+    def __init__(self, fpath, chunk_size):
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be positive, "
+                             "got {}".format(chunk_size))
+        self._fpath = fpath
+        self._source = open_source(fpath)
+        self.path = self._source.path
+        self.chunk_size = chunk_size
+        self.offsets, self.nlines = _scan_offsets(self._source, chunk_size)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def compressed(self):
+        return self._source.compressed
+
+    @property
+    def nbytes(self):
+        return self.offsets.nbytes + self._source.nbytes
+
+    def read(self, chunk_num):
+        ''' The raw bytes of chunk chunk_num, empty past the end.'''
+        if not 0 <= chunk_num < len(self):
+            return b''
+        start, stop = self.offsets[chunk_num:chunk_num + 2]
+        return self._source.read(int(start), int(stop))
+
+    def read_bytes(self, start, stop):
+        ''' The raw bytes start:stop of the (decompressed) text.'''
+        return self._source.read(int(start), int(stop))
+
+    def chunk_range(self, start=0, stop=None):
+        ''' Clip the chunk range start:stop to the chunks of the file.'''
+        if stop is None or stop > len(self):
+            stop = len(self)
+        start = min(max(start, 0), stop)
+        return start, stop
+
+    def count_rows(self, start=0, stop=None):
+        ''' The number of lines in chunks start:stop.'''
+        start, stop = self.chunk_range(start, stop)
+        cs = self.chunk_size
+        return min(stop * cs, self.nlines) - start * cs
+
+    def blocks(self, start=0, stop=None, nbytes=BLOCK_SIZE):
+        ''' Iterate over chunks start:stop (the whole file by default), a
+            few chunks of about nbytes at a time, so they can be parsed
+            without holding all of them.'''
+        start, stop = self.chunk_range(start, stop)
+        offsets = self.offsets
+        chunk = start
+        while chunk < stop:
+            end = np.searchsorted(offsets, offsets[chunk] + nbytes,
+                                  side='right') - 1
+            end = min(max(end, chunk + 1), stop)
+            yield self.read_bytes(offsets[chunk], offsets[end])
+            chunk = end
+
+
+def resolve_path(fpath):
+    ''' The file to read for fpath.
+
+        fpath itself if it exists, else its compressed copy fpath + '.gz'
+        or fpath + '.zst' if there is one.
+    '''
+    if os.path.exists(fpath):
+        return fpath
+    for suffix in _DECOMPRESSORS:
+        if os.path.exists(fpath + suffix):
+            return fpath + suffix
+    return fpath
+
+
+def open_source(fpath):
+    ''' The reader of the (decompressed) bytes of fpath.'''
+    path = resolve_path(fpath)
+    suffix = os.path.splitext(path)[1]
+    if suffix in _DECOMPRESSORS:
+        return _CompressedSource(path, *_DECOMPRESSORS[suffix])
+    return _PlainSource(path)
+
+
+class _PlainSource:
+    compressed = False
+    nbytes = 0
+
+    def __init__(self, path):
+        self.path = path
+
+    def iter_blocks(self, block_size=BLOCK_SIZE):
+        ''' The whole file in order.'''
+        pos = 0
+        with open(self.path, 'rb') as f:
+            while True:
+                block = _read_at(f, pos, block_size)
+                if not block:
+                    return
+                pos += len(block)
+                yield block
+
+    def read(self, start, stop):
+        with open(self.path, 'rb') as f:
+            return _read_at(f, start, stop - start)
+
+
+def _new_gzip():
+    return zlib.decompressobj(_GZIP_WBITS)
+
+
+def _new_zstd():
+    if zstandard is None:
+        raise ImportError("reading .zst files needs the zstandard package")
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+# suffix: (new decompressor, whether its state can be saved)
+_DECOMPRESSORS = {'.gz': (_new_gzip, True),
+                  '.zst': (_new_zstd, False)}
+
+
+class _CompressedSource:
+    ''' The decompressed bytes of a compressed file, with seek points.
+
+        Multi member gzip files and multi frame zstd files are read through,
+        a fresh decompressor for each member or frame.
+
+        Reads from several threads are safe: each decompresses with its own
+        copy of a checkpoint, and only one of them at a time carries on
+        from the cursor left by the previous read.
+    '''
+    compressed = True
+
+    def __init__(self, path, new_decompressor, can_save,
+                 spacing=CHECKPOINT_SPACING):
+        self.path = path
+        self._new = new_decompressor
+        self._can_save = can_save
+        self._spacing = spacing
+        # (compressed offset, text offset, saved state or None for a fresh
+        # decompressor), filled by iter_blocks
+        self._checkpoints = []
+        self._positions = []
+        # where the last read stopped, to carry on from for the next one.
+        # Taken by the read using it, put back when done
+        self._cursor = None
+        self._lock = threading.Lock()
+        self.size = None
+
+    @property
+    def nbytes(self):
+        return _STATE_NBYTES * sum(state is not None
+                                   for _, _, state in self._checkpoints)
+
+    def iter_blocks(self):
+        ''' Decompress the whole file in order, saving checkpoints.'''
+        checkpoints = [(0, 0, None)]
+        decompressor = self._new()
+        comp_pos = out_pos = 0
+        with open(self.path, 'rb') as f:
+            while True:
+                data = _read_at(f, comp_pos, _INPUT_BLOCK)
+                if not data:
+                    break
+                decompressor, out = self._inflate(decompressor, data,
+                                                  comp_pos, out_pos,
+                                                  checkpoints)
+                comp_pos += len(data)
+                out_pos += len(out)
+                if (self._can_save and not decompressor.eof
+                        and out_pos - checkpoints[-1][1] >= self._spacing):
+                    checkpoints.append((comp_pos, out_pos,
+                                        decompressor.copy()))
+                if out:
+                    yield out
+        self._checkpoints = checkpoints
+        self._positions = [out for _, out, _ in checkpoints]
+        self.size = out_pos
+
+    def _inflate(self, decompressor, data, comp_pos, out_pos,
+                 checkpoints=None):
+        ''' Feed data, found at comp_pos in the file, moving on to a new
+            decompressor at the end of each member or frame.'''
+        pieces = []
+        while data:
+            if decompressor.eof:
+                decompressor = self._new()
+                if checkpoints is not None:
+                    checkpoints.append((comp_pos, out_pos, None))
+            piece = decompressor.decompress(data)
+            pieces.append(piece)
+            out_pos += len(piece)
+            if decompressor.eof:
+                rest = decompressor.unused_data
+                comp_pos += len(data) - len(rest)
+                data = rest
+            else:
+                data = b''
+        return decompressor, b''.join(pieces)
+
+    def read(self, start, stop):
+        with self._lock:
+            if self.size is None:
+                for _ in self.iter_blocks():
+                    pass
+            stop = min(stop, self.size)
+            if start >= stop:
+                return b''
+            cursor = self._cursor
+            if cursor is not None and 0 <= start - cursor[1] < self._spacing:
+                self._cursor = None
+            else:
+                cursor = None
+
+        if cursor is not None:
+            comp_pos, base, decompressor, rest = cursor
+            produced = bytearray(rest)
+        else:
+            i = bisect_right(self._positions, start) - 1
+            comp_pos, base, state = self._checkpoints[i]
+            decompressor = self._new() if state is None else state.copy()
+            produced = bytearray()
+
+        with open(self.path, 'rb') as f:
+            while base + len(produced) < stop:
+                if base + len(produced) <= start:
+                    # nothing wanted yet, don't keep it
+                    base += len(produced)
+                    produced.clear()
+                data = _read_at(f, comp_pos, _INPUT_BLOCK)
+                if not data:
+                    break
+                decompressor, out = self._inflate(decompressor, data,
+                                                  comp_pos,
+                                                  base + len(produced))
+                comp_pos += len(data)
+                produced += out
+        with self._lock:
+            self._cursor = (comp_pos, stop, decompressor,
+                            bytes(produced[stop - base:]))
+        return bytes(produced[start - base:stop - base])
+
+
+def _scan_offsets(source, chunk_size):
+    ''' Walk the file a block at a time, keeping every chunk boundary.'''
+    boundaries = [np.zeros(1, dtype=np.int64)]
+    nlines = 0
+    pos = 0
+    last = _NEWLINE
+    for buf in source.iter_blocks():
+        block = np.frombuffer(buf, dtype=np.uint8)
+        newlines = np.flatnonzero(block == _NEWLINE)
+        # line numbers (1 based) ended by these newlines
+        line_nums = np.arange(nlines + 1, nlines + 1 + newlines.size)
+        ends_chunk = line_nums % chunk_size == 0
+        boundaries.append(newlines[ends_chunk] + pos + 1)
+        nlines += newlines.size
+        pos += block.size
+        last = block[-1]
+    offsets = np.concatenate(boundaries)
+    # a last line with no newline still counts
+    if last != _NEWLINE:
+        nlines += 1
+    if offsets[-1] != pos:
+        offsets = np.append(offsets, pos)
+    return offsets, nlines
@@ -0,0 +1,147 @@
+''' Filling whole PizzaBox streams at once.
+
+    Filling a run event by event (``hdr.table(fill=True)``) resolves every
+    datum on its own and calls the handler once per chunk. A PizzaBox
+    stream is one resource, so here all its datums are fetched in one
+    registry query and the chunks are read from the file in one go.
+'''
+import numpy as np
+
+from .arrow import to_table
+from .integrity import integrity_of
+
+
+def read_stream(db, hdr, stream_name, field=None, processes=1,
+                by_datum=False):
+    ''' All the rows of a PizzaBox stream of a run.
+
+        Parameters
+        ----------
+        db : Broker
+            the Broker of the run, with the PizzaBox handlers registered
+        hdr : Header
+            the run
+        stream_name : str
+            the stream, e.g. 'pb1_enc1'
+        field : str, optional
+            the data key of the stream holding the datums, defaults to
+            stream_name
+        processes : int, optional
+            see the handlers' read_chunks
+        by_datum : bool, optional
+            see read_resource
+
+        Returns
+        -------
+        data : np.recarray or dict
+            as for read_resource
+    '''
+    if field is None:
+        field = stream_name
+    # one datum is enough to find the resource
+    event = next(iter(hdr.events(stream_name=stream_name, fill=False)), None)
+    if event is None:
+        raise ValueError("the run has no events in stream "
+                         "{}".format(stream_name))
+    resource = db.reg.resource_given_datum_id(event['data'][field])
+    datums = list(db.reg.datum_gen_given_resource(resource['uid']))
+    handler = db.reg.get_spec_handler(resource['uid'])
+    return read_resource(handler, datums, processes=processes,
+                         by_datum=by_datum)
+
+
+def stream_resources(db, hdr, specs=None):
+    ''' The resources behind the streams of a run.
+
+        Parameters
+        ----------
+        db : Broker
+            the Broker of the run
+        hdr : Header
+            the run
+        specs : collection of str, optional
+            only the resources with these specs, all of them by default
+
+        Yields
+        ------
+        stream_name, field, resource :
+            the stream, its data key holding the datums, and the resource
+            document of the first event of the stream
+    '''
+    for stream_name in hdr.stream_names:
+        event = next(iter(hdr.events(stream_name=stream_name, fill=False)),
+                     None)
+        if event is None:
+            continue
+        for descriptor in hdr.descriptors:
+            if descriptor.get('name') != stream_name:
+                continue
+            for key, data_key in descriptor['data_keys'].items():
+                if not data_key.get('external') or key not in event['data']:
+                    continue
+                resource = db.reg.resource_given_datum_id(event['data'][key])
+                if specs is None or resource['spec'] in specs:
+                    yield stream_name, key, resource
+
+
+def read_resource(handler, datums, processes=1, by_datum=False):
+    ''' The rows of all the datums of a resource, from one handler read.
+
+        Parameters
+        ----------
+        handler : PizzaBox handler
+            the handler of the resource. Other handlers work too, called
+            once per datum.
+        datums : list of dict
+            the datum documents, in order
+        processes : int, optional
+            see the handlers' read_chunks
+        by_datum : bool, optional
+            return a {datum_id: rows} dict instead, views into the one
+            array the chunks were read into
+
+        Returns
+        -------
+        data : np.recarray
+            the rows of the datums, in the order of the datums (a Table for
+            handlers with arrow output)
+    '''
+    if not datums:
+        raise ValueError("no datums to read")
+    if not hasattr(handler, 'read_chunks'):
+        parts = [handler(**datum['datum_kwargs']) for datum in datums]
+        if by_datum:
+            return {datum['datum_id']: part
+                    for datum, part in zip(datums, parts)}
+        return np.concatenate(parts)
+
+    chunk_nums = np.array([datum['datum_kwargs']['chunk_num']
+                           for datum in datums])
+    first = int(chunk_nums.min())
+    rows = handler.read_chunks(first, int(chunk_nums.max()) + 1,
+                               processes=processes)
+    consecutive = (np.diff(chunk_nums) == 1).all()
+    integrity = integrity_of(rows)
+    if (integrity and (integrity['malformed'] or integrity['blank'])
+            and (by_datum or not consecutive)):
+        # lines made no rows (blank ones, or malformed with
+        # errors='skip'), the chunks can't be cut out of rows by position,
+        # read them one by one instead
+        parts = [handler(**datum['datum_kwargs']) for datum in datums]
+        if by_datum:
+            return {datum['datum_id']: part
+                    for datum, part in zip(datums, parts)}
+        if not isinstance(rows, np.ndarray):
+            return to_table(parts, rows.column_names)
+        return np.concatenate(parts).view(np.recarray)
+    cs = handler.chunk_size
+    views = [rows[(k - first) * cs:(k - first + 1) * cs] for k in chunk_nums]
+    if by_datum:
+        return {datum['datum_id']: view for datum, view in zip(datums, views)}
+    # the usual case, datums for consecutive chunks in order
+    if consecutive:
+        return rows
+    if not isinstance(rows, np.ndarray):
+        # an arrow Table, from output='arrow'
+        return to_table(views, rows.column_names)
+    return np.concatenate(views).view(np.recarray)
@@ -0,0 +1,135 @@
+''' Trigger edges and gating from the PizzaBox digital inputs.
+
+    The DI files (PizzaBoxDIHandlerTxt) log the state of the digital inputs
+    with a timestamp per change. gate_windows turns the transitions of one
+    input into (start, stop) time windows, and window_means averages any
+    other stream (encoder, ADC channels, a 2-D block from read_analog) over
+    each window, with no python loop over the rows::
+
+        di = PizzaBoxDIHandlerTxt(fpath, chunk_size).read_all()
+        start, stop = gate_windows(timestamps_ns(di.ts_s, di.ts_ns), di.di)
+        means, counts = window_means(block.time_ns, block.values,
+                                     start, stop)
+'''
+import numpy as np
+
+
+def di_state(di, bit=None):
+    ''' The boolean state of a digital input.
+
+        Parameters
+        ----------
+        di : array of int
+            the di column
+        bit : int, optional
+            the input, a bit of the di word. By default the input is on
+            whenever the word is not 0.
+    '''
+    di = np.asarray(di)
+    if bit is None:
+        return di != 0
+    return (di >> bit) & 1 == 1
+
+
+def find_edges(state):
+    ''' The rows where a boolean state switches.
+
+        Returns
+        -------
+        rising, falling : np.ndarray
+            the indices of the rows where the state turns on, and off
+    '''
+    state = np.asarray(state, dtype=bool)
+    change = np.flatnonzero(state[1:] != state[:-1]) + 1
+    on = state[change]
+    return change[on], change[~on]
+
+
+def gate_windows(time_ns, di, bit=None, active_high=True):
+    ''' The time windows where a digital input is active.
+
+        A window runs from a row where the input turns active to the next
+        row where it turns inactive. Windows still open at the start or end
+        of the data are left out.
+
+        Parameters
+        ----------
+        time_ns : array of int
+            the timestamps of the DI rows, int64 nanoseconds
+        di : array of int
+            the di column
+        bit : int, optional
+            see di_state
+        active_high : bool, optional
+            the gate is active while the input is on, else while it is off
+
+        Returns
+        -------
+        start, stop : np.ndarray
+            int64 nanoseconds, one entry per window
+    '''
+    time_ns = np.asarray(time_ns, dtype=np.int64)
+    state = di_state(di, bit)
+    if not active_high:
+        state = ~state
+    rising, falling = find_edges(state)
+    # drop a falling edge closing a window that opened before the data
+    if len(falling) and len(rising) and falling[0] < rising[0]:
+        falling = falling[1:]
+    elif len(falling) and not len(rising):
+        falling = falling[:0]
+    nwindows = min(len(rising), len(falling))
+    return time_ns[rising[:nwindows]], time_ns[falling[:nwindows]]
+
+
+def window_rows(time_ns, start, stop):
+    ''' The rows of a stream with sorted timestamps inside each window.
+
+        Returns
+        -------
+        first, last : np.ndarray
+            window k holds rows first[k]:last[k], start <= time < stop
+    '''
+    time_ns = np.asarray(time_ns)
+    return (np.searchsorted(time_ns, start, side='left'),
+            np.searchsorted(time_ns, stop, side='left'))
+
+
+def window_means(time_ns, values, start, stop):
+    ''' Average a stream over time windows.
+
+        Parameters
+        ----------
+        time_ns : array of int
+            the sorted timestamps of the stream, int64 nanoseconds
+        values : array
+            (n,) or (n, n_channels) values of the stream
+        start, stop : arrays of int
+            the windows, e.g. from gate_windows
+
+        Returns
+        -------
+        means : np.ndarray
+            (n_windows,) or (n_windows, n_channels), NaN for empty windows
+        counts : np.ndarray
+            the number of rows in each window
+    '''
+    values = np.asarray(values, dtype=float)
+    first, last = window_rows(time_ns, start, stop)
+    counts = last - first
+    if not len(counts):
+        return np.empty((0,) + values.shape[1:]), counts
+    # reduceat sums between consecutive indices: interleave the window
+    # bounds and keep every other sum. Bounds must be below the number of
+    # rows, a window reaching the end needs a row of zeros after it
+    if last.max() >= len(values):
+        values = np.concatenate([values, np.zeros((1,) + values.shape[1:])])
+    bounds = np.empty(2 * len(first), dtype=np.intp)
+    bounds[0::2] = first
+    bounds[1::2] = last
+    sums = np.add.reduceat(values, bounds, axis=0)[0::2]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts.reshape((-1,) + (1,) * (values.ndim - 1))
+    # reduceat gives the row at the bound for an empty window
+    means[counts == 0] = np.nan
+    return means, counts
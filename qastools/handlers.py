@@ -1,60 +1,467 @@
+import os
+
+import numpy as np
 from databroker.assets.handlers_base import HandlerBase
-from collections import namedtuple
+
+from . import cache as _cache
+from .arrow import record_batch, schema, to_record_batch, to_table
+from .columnar import ColumnarFile, converted_path
+from .encoder import COUNTER_BITS, MAX_STEP, condition_encoder
+from .fileindex import LineIndex, resolve_path
+from .integrity import (IntegrityCounter, integrity_of, integrity_stats,
+                        rows_integrity, rows_time_ns, with_integrity)
+from .parallel import parse_parallel
+from .parsing import (TIME_FIELD, decode_adc, parse_pizzabox,
+                      parse_pizzabox_columns, row_dtype, seconds_to_ns,
+                      skip_malformed, timestamps_ns)
+from .prefetch import ChunkPrefetcher
+from .streaming import PizzaBoxFollower
+from .timeindex import TimeIndex, time_index_path
 
 
-class PizzaBoxEncHandlerTxt(HandlerBase):
-    encoder_row = namedtuple('encoder_row',
-                             ['ts_s', 'ts_ns', 'encoder', 'index', 'state'])
+class _PizzaBoxHandlerTxt(HandlerBase):
     "Read PizzaBox text files using info from filestore."
-    def __init__(self, fpath, chunk_size):
-        self._fpath = fpath
-        self.chunk_size = chunk_size
-        with open(fpath, 'r') as f:
-            self.lines = list(f)
+    spec = None
+    columns = ()
+    # base of each column, all decimal unless overridden
+    bases = None
+    # line indexes and parsed chunks are shared between the handlers of a
+    # process through this, set to None to turn it off
+    memory_cache = _cache.memory_cache
+    # read the columnar copy of the file instead, when there is an up to
+    # date one (see qastools.transcode)
+    use_converted = True
+    outputs = ('records', 'arrow')
+    errors_modes = ('raise', 'skip')
 
-    def __call__(self, chunk_num):
-        cs = self.chunk_size
-        return [self.encoder_row(*(int(v) for v in ln.split()))
-                for ln in self.lines[chunk_num*cs:(chunk_num+1)*cs]]
+    def __init__(self, fpath, chunk_size, cache=None, time_ns=False,
+                 prefetch=0, prefetch_workers=1, output='records',
+                 errors='raise', time_index_dir=None):
+        ''' With prefetch, the next prefetch chunks are read in the
+            background while the caller works through the chunks in order,
+            see ChunkPrefetcher.
 
-    def get_file_list(self, chunk_num):
-        return [self._fpath]
+            The time index of the file (see time_index) is kept in
+            time_index_dir when given, for later handlers on the file to
+            load. Without it, it only lives in the memory cache.
 
+            output is 'records' for numpy record arrays, or 'arrow' for
+            pyarrow RecordBatches (chunks) and Tables (bulk reads), see
+            qastools.arrow.
 
-class PizzaBoxDIHandlerTxt(HandlerBase):
-    di_row = namedtuple('di_row', ['ts_s', 'ts_ns', 'encoder', 'index', 'di'])
-    "Read PizzaBox text files using info from filestore."
-    def __init__(self, fpath, chunk_size):
+            errors is 'raise' to fail on a malformed line, or 'skip' to
+            leave such lines out (see skip_malformed). Either way the rows
+            returned carry the integrity statistics of the lines they were
+            read from, see integrity_of.
+        '''
+        if output not in self.outputs:
+            raise ValueError("output must be one of {}, got "
+                             "{!r}".format(self.outputs, output))
+        if errors not in self.errors_modes:
+            raise ValueError("errors must be one of {}, got "
+                             "{!r}".format(self.errors_modes, errors))
         self._fpath = fpath
         self.chunk_size = chunk_size
-        with open(fpath, 'r') as f:
-            self.lines = list(f)
+        self.time_ns = time_ns
+        self.output = output
+        self.errors = errors
+        self.time_index_dir = time_index_dir
+        if output == 'arrow':
+            # fails now rather than on the first read without pyarrow
+            schema(self.fields)
+        self._prefetcher = None
+        # rows of the whole file from a converted copy, or memory mapped
+        # from a ParsedFileCache, if any
+        self._data = None
+        if self.use_converted:
+            self._data = self._open_converted()
+        if self._data is None and cache is not None:
+            self._data = cache.load(fpath, self.fields, self.bases)
+        if self._data is not None:
+            self._start_prefetch(prefetch, prefetch_workers)
+            return
+        # only the chunk boundaries are kept, chunks are read on demand.
+        # The size and mtime are part of the key, a rewritten file is
+        # indexed again. A missing text file may have a compressed copy
+        stat = os.stat(resolve_path(fpath))
+        self._key = (self.spec, fpath, chunk_size,
+                     stat.st_size, stat.st_mtime_ns)
+        self._index = self._cached(self._key)
+        if self._index is None:
+            self._index = LineIndex(fpath, chunk_size)
+            self._store(self._key, self._index)
+        if cache is not None:
+            self._data = cache.store(fpath, self.fields, self.bases,
+                                     self._index.nlines, self._parse_all)
+        self._start_prefetch(prefetch, prefetch_workers)
+
+    @property
+    def fields(self):
+        ''' The fields of the returned rows: the columns, plus 'time_ns'
+            (int64 nanoseconds) if asked for.'''
+        if self.time_ns:
+            return self.columns + (TIME_FIELD,)
+        return self.columns
 
     def __call__(self, chunk_num):
-        cs = self.chunk_size
-        return [self.di_row(*(int(v) for v in ln.split()))
-                for ln in self.lines[chunk_num*cs:(chunk_num+1)*cs]]
+        ''' The rows of chunk chunk_num as a record array (or RecordBatch).
+
+            Chunks may be shared with other handlers, they are read-only.
+            The handler may be called from several threads at once.
+        '''
+        if self._data is not None:
+            return self._fetch(chunk_num)
+        key = self._key + (self.time_ns, self.output, self.errors,
+                           chunk_num)
+        data = self._cached(key)
+        if data is None:
+            data = self._fetch(chunk_num)
+            if self.output == 'records':
+                data.flags.writeable = False
+            self._store(key, data)
+        return data
+
+    def close(self):
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+            self._prefetcher = None
+
+    @classmethod
+    def follow(cls, fpath, offset=0, time_ns=False):
+        ''' Read fpath as the PizzaBox appends to it, see PizzaBoxFollower.'''
+        return PizzaBoxFollower(fpath, cls.columns, cls.bases, offset=offset,
+                                time_ns=time_ns)
+
+    def read_chunks(self, start=0, stop=None, processes=1):
+        ''' The rows of chunks start:stop as one contiguous record array
+            (or Table).
+
+            Parameters
+            ----------
+            start, stop : int, optional
+                the range of chunks, the whole file by default
+            processes : int, optional
+                parse newline aligned byte ranges of the file in a pool of
+                this many processes, None for one per core
+
+            The statistics of the rows (see integrity_stats) are attached
+            to them, see integrity_of. With errors='skip' lines that did
+            not parse are left out, so chunks may be short of chunk_size
+            rows.
+        '''
+        if self._data is not None:
+            cs = self.chunk_size
+            stop = len(self._data) if stop is None else stop * cs
+            rows = self._data[start * cs:stop]
+            # no parsing here, the statistics take a pass over the rows
+            return self._as_table(rows, rows_integrity(rows))
+        if processes != 1:
+            rows = parse_parallel(self._index, self.columns, self.bases,
+                                  processes=processes, time_ns=self.time_ns,
+                                  start=start, stop=stop, errors=self.errors)
+            return self._as_table(rows, integrity_of(rows))
+        counter = IntegrityCounter()
+        if self.output == 'arrow':
+            rows = to_table([self._parse_chunk(block, counter) for block
+                             in self._index.blocks(start, stop)],
+                            self.fields)
+            return with_integrity(rows, counter.stats())
+        out = np.empty(self._index.count_rows(start, stop),
+                       dtype=row_dtype(self.columns, self.time_ns))
+        out = out.view(np.recarray)
+        out = out[:self._parse_all(out, start, stop, counter)]
+        return with_integrity(out, counter.stats())
+
+    def read_all(self, processes=1):
+        ''' All the rows of the file, see read_chunks.'''
+        return self.read_chunks(processes=processes)
+
+    def read_time_range(self, t0, t1):
+        ''' The rows with timestamps from t0 up to (not including) t1.
+
+            Only the chunks around the window are read, found by binary
+            search of the time index of the file (see time_index). The rows
+            are taken to be in time order, see check_timestamps.
+
+            Parameters
+            ----------
+            t0, t1 : float
+                seconds since the epoch
+        '''
+        t0, t1 = seconds_to_ns(t0), seconds_to_ns(t1)
+        if self._data is not None:
+            first, last = self._bisect_rows(t0), self._bisect_rows(t1)
+            data = self._data[first:max(first, last)]
+            return self._as_table(data, rows_integrity(data))
+        start, stop, _ = self.time_index().byte_range(t0, t1)
+        buf = self._index.read_bytes(start, stop)
+        data, malformed = self._parse(buf)
+        times = rows_time_ns(data)
+        first, last = np.searchsorted(times, [t0, t1])
+        last = max(first, last)
+        # the malformed and blank lines are those of the chunks read, a
+        # few of them may lie just outside the window
+        stats = integrity_stats(times[first:last], len(malformed),
+                                blank=_blank_lines(buf, len(data),
+                                                   len(malformed)))
+        return self._as_table(data[first:last], stats)
+
+    def time_index(self):
+        ''' The TimeIndex of the text file, one sample per chunk.
+
+            With a time_index_dir, loaded from there when there is an up to
+            date one, else built and saved there.
+
+            Only handlers reading the text have one: those reading a
+            converted copy or a ParsedFileCache have all the rows at hand,
+            read_time_range searches them directly.
+        '''
+        if self._data is not None:
+            raise ValueError("{} is read from a converted copy or a parsed "
+                             "file cache, there is no time index of its "
+                             "text".format(self._fpath))
+        key = self._key + ('time_index',)
+        index = self._cached(key)
+        if index is not None:
+            return index
+        path = None
+        if self.time_index_dir is not None:
+            path = time_index_path(self._fpath, self.time_index_dir)
+            index = TimeIndex.load(path, self._fpath, self.chunk_size)
+        if index is None:
+            index = TimeIndex.build(self._index, self.columns, self.bases)
+            if path is not None:
+                try:
+                    os.makedirs(self.time_index_dir, exist_ok=True)
+                    index.save(path, self._fpath)
+                except OSError:
+                    # e.g. a read-only directory, keep it in memory
+                    pass
+        self._store(key, index)
+        return index
+
+    def _open_converted(self):
+        ''' The columnar copy of the file, or None if there is no fresh
+            one of this spec that can be read.'''
+        path = converted_path(self._fpath)
+        if not os.path.exists(path):
+            return None
+        try:
+            converted = ColumnarFile(path, self.columns, self.time_ns)
+            if (converted.attrs.get('spec') != self.spec
+                    or not converted.is_fresh(self._fpath)):
+                return None
+        except (ImportError, OSError, KeyError, ValueError):
+            # not a copy of ours, or a damaged one: read the text
+            return None
+        return converted
+
+    def _bisect_rows(self, t):
+        ''' The first row of _data at or after time t, by binary search.'''
+        first, last = 0, len(self._data)
+        while first < last:
+            mid = (first + last) // 2
+            row = self._data[mid:mid + 1]
+            if timestamps_ns(row.ts_s, row.ts_ns)[0] < t:
+                first = mid + 1
+            else:
+                last = mid
+        return first
+
+    def _start_prefetch(self, depth, workers):
+        if depth:
+            nchunks = (len(self._data) if self._data is not None
+                       else self._index.nlines)
+            nchunks = -(-nchunks // self.chunk_size)
+            self._prefetcher = ChunkPrefetcher(self._load, nchunks, depth,
+                                               workers=workers)
+
+    def _fetch(self, chunk_num):
+        if self._prefetcher is not None:
+            return self._prefetcher.get(chunk_num)
+        return self._load(chunk_num)
+
+    def _load(self, chunk_num):
+        ''' Read chunk chunk_num, bypassing the memory cache.'''
+        if self._data is not None:
+            cs = self.chunk_size
+            data = self._data[chunk_num*cs:(chunk_num+1)*cs]
+            stats = rows_integrity(data)
+            if self.output == 'arrow':
+                return with_integrity(to_record_batch(data), stats)
+            return with_integrity(data, stats)
+        counter = IntegrityCounter()
+        data = self._parse_chunk(self._index.read(chunk_num), counter)
+        return with_integrity(data, counter.stats())
+
+    def _parse(self, buf, parse=parse_pizzabox, counter=None):
+        ''' Parse buf, with the numbers of the lines left out. The rows,
+            malformed and blank lines are added to counter, if given.'''
+        if self.errors == 'skip':
+            data, malformed = skip_malformed(parse, buf, self.columns,
+                                             self.bases,
+                                             time_ns=self.time_ns)
+        else:
+            data = parse(buf, self.columns, self.bases, self.time_ns)
+            malformed = np.empty(0, dtype=int)
+        if counter is not None:
+            times = rows_time_ns(data)
+            counter.add(times, len(malformed),
+                        _blank_lines(buf, len(times), len(malformed)))
+        return data, malformed
+
+    def _parse_chunk(self, buf, counter=None):
+        ''' Parse buf into the output format of the handler.'''
+        if self.output == 'arrow':
+            columns, _ = self._parse(buf, parse_pizzabox_columns, counter)
+            return record_batch(columns)
+        return self._parse(buf, counter=counter)[0]
+
+    def _as_table(self, data, stats):
+        ''' Record array data as returned by the bulk reads, carrying
+            stats.'''
+        if self.output == 'arrow':
+            data = to_table([to_record_batch(data)], self.fields)
+        return with_integrity(data, stats)
+
+    def _parse_all(self, out, start=0, stop=None, counter=None):
+        ''' Parse chunks start:stop (the whole file by default) into out,
+            a block at a time. Returns the number of rows written.'''
+        row = 0
+        for block in self._index.blocks(start, stop):
+            data, _ = self._parse(block, counter=counter)
+            out[row:row + len(data)] = data
+            row += len(data)
+        return row
+
+    def _cached(self, key):
+        if self.memory_cache is None:
+            return None
+        return self.memory_cache.get(key)
+
+    def _store(self, key, value):
+        if self.memory_cache is not None:
+            self.memory_cache.put(key, value)
 
     def get_file_list(self, chunk_num):
-        return [self._fpath]
+        return [resolve_path(self._fpath)]
+
+
+class _PizzaBoxEncoderHandlerTxt(_PizzaBoxHandlerTxt):
+    "The text handlers with an encoder column."
+    # see condition_encoder
+    encoder_bits = COUNTER_BITS
+    encoder_max_step = MAX_STEP
 
+    def read_encoder(self, start=0, stop=None, repair=True, processes=1):
+        ''' The encoder column of chunks start:stop, unwrapped and with
+            glitches repaired, see condition_encoder.
 
-class PizzaBoxAnHandlerTxt(HandlerBase):
-    encoder_row = namedtuple('encoder_row', ['ts_s', 'ts_ns', 'index', 'adc'])
+            Returns
+            -------
+            encoder : np.ndarray
+                int64 counts
+            stats : dict
+                the rollovers and glitches found, see condition_encoder
+        '''
+        rows = self.read_chunks(start, stop, processes=processes)
+        return condition_encoder(np.asarray(rows['encoder']),
+                                 bits=self.encoder_bits,
+                                 max_step=self.encoder_max_step,
+                                 repair=repair)
+
+
+class PizzaBoxEncHandlerTxt(_PizzaBoxEncoderHandlerTxt):
     "Read PizzaBox text files using info from filestore."
+    spec = 'PIZZABOX_ENC_FILE_TXT'
+    specs = {spec} | HandlerBase.specs
+    columns = ('ts_s', 'ts_ns', 'encoder', 'index', 'state')
 
+
+class PizzaBoxDIHandlerTxt(_PizzaBoxEncoderHandlerTxt):
+    "Read PizzaBox text files using info from filestore."
+    spec = 'PIZZABOX_DI_FILE_TXT'
+    specs = {spec} | HandlerBase.specs
+    columns = ('ts_s', 'ts_ns', 'encoder', 'index', 'di')
+
+
+class PizzaBoxAnHandlerTxt(_PizzaBoxHandlerTxt):
+    "Read PizzaBox text files using info from filestore."
+    spec = 'PIZZABOX_AN_FILE_TXT'
+    specs = {spec} | HandlerBase.specs
+    columns = ('ts_s', 'ts_ns', 'index', 'adc')
     bases = (10, 10, 10, 16)
-    def __init__(self, fpath, chunk_size):
+    # layout of the adc word: an 18 bit two's complement value over 8
+    # status bits, +-10 V full scale
+    adc_bits = 18
+    adc_shift = 8
+    volts_per_count = 10 / 2**17
+
+    def volts(self, chunk_num):
+        ''' The adc column of chunk chunk_num in volts.'''
+        return decode_adc(self._adc(chunk_num), bits=self.adc_bits,
+                          shift=self.adc_shift,
+                          volts_per_count=self.volts_per_count)
+
+    def counts(self, chunk_num):
+        ''' The adc column of chunk chunk_num as signed int32 counts.'''
+        return decode_adc(self._adc(chunk_num), bits=self.adc_bits,
+                          shift=self.adc_shift)
+
+    def _adc(self, chunk_num):
+        data = self(chunk_num)
+        if self.output == 'arrow':
+            return data.column('adc').to_numpy()
+        return data.adc
+
+
+class PizzaBoxHandlerHDF5(HandlerBase):
+    "Read the columnar HDF5 copies of PizzaBox text files."
+    spec = 'PIZZABOX_FILE_HDF5'
+    specs = {spec} | HandlerBase.specs
+
+    def __init__(self, fpath, chunk_size=None, columns=None, time_ns=False):
+        ''' Only the given columns are read, all of them by default. The
+            chunk size defaults to the one of the converted resource.'''
         self._fpath = fpath
+        self._file = ColumnarFile(fpath, columns, time_ns)
+        if chunk_size is None:
+            chunk_size = int(self._file.attrs['chunk_size'])
         self.chunk_size = chunk_size
-        with open(fpath, 'r') as f:
-            self.lines = list(f)
 
     def __call__(self, chunk_num):
+        cs = self.chunk_size
+        return self._file[chunk_num*cs:(chunk_num+1)*cs]
 
+    def read_chunks(self, start=0, stop=None, processes=1):
+        ''' The rows of chunks start:stop, as for the text handlers.
+            processes is ignored, there is no parsing to spread.'''
         cs = self.chunk_size
-        return [self.encoder_row(*(int(v, base=b) for v, b in zip(ln.split(), self.bases)))
-                for ln in self.lines[chunk_num*cs:(chunk_num+1)*cs]]
+        return self._file[start * cs:None if stop is None else stop * cs]
 
     def get_file_list(self, chunk_num):
         return [self._fpath]
+
+
+def _blank_lines(buf, nrows, malformed):
+    ''' The number of blank lines of buf, that made nrows rows with
+        malformed lines left out.'''
+    nlines = buf.count(b'\n') + (len(buf) > 0 and buf[-1:] != b'\n')
+    return nlines - nrows - malformed
+
+
+HANDLERS = (PizzaBoxEncHandlerTxt, PizzaBoxDIHandlerTxt,
+            PizzaBoxAnHandlerTxt, PizzaBoxHandlerHDF5)
+
+
+def register_handlers(db, overwrite=True, missing_only=False):
+    ''' Register all the PizzaBox handlers with a Broker.
+
+        With missing_only, the specs that already have a handler keep it,
+        e.g. one the caller registered with a cache.
+    '''
+    for handler_class in HANDLERS:
+        if missing_only and handler_class.spec in db.reg.handler_reg:
+            continue
+        db.reg.register_handler(handler_class.spec, handler_class,
+                                overwrite=overwrite)
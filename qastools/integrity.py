@@ -0,0 +1,170 @@
+''' Integrity statistics of parsed PizzaBox data.
+
+    Gathered by the handlers while they parse (see IntegrityCounter) and
+    attached to the rows they return, so a bad run can be told apart
+    without going over the file again::
+
+        rows = handler.read_all()
+        integrity_of(rows)['gaps']
+'''
+import json
+
+import numpy as np
+
+from .parsing import timestamps_ns
+
+# a step this many times the usual one is a gap
+GAP_FACTOR = 2.5
+# where the statistics go in the schema metadata of arrow rows
+METADATA_KEY = b'qastools.integrity'
+
+
+class IntegrityCounter:
+    ''' Integrity statistics of a stream, added to a block of rows at a
+        time as they are parsed, in file order.
+
+        Only the forward steps between timestamps are kept until the end,
+        for their median.
+
+        Parameters
+        ----------
+        gap_factor : float, optional
+            see integrity_stats
+    '''
+    def __init__(self, gap_factor=GAP_FACTOR):
+        self.gap_factor = gap_factor
+        self.nrows = 0
+        self.malformed = 0
+        self.blank = 0
+        self.duplicates = 0
+        self.backwards = 0
+        self._forward = []
+        self._last = self._min = self._max = None
+
+    def add(self, time_ns, malformed=0, blank=0):
+        ''' Count the rows of a block, by their timestamps (int64
+            nanoseconds), and the malformed and blank lines left out of
+            it.'''
+        time_ns = np.asarray(time_ns, dtype=np.int64)
+        self.nrows += len(time_ns)
+        self.malformed += int(malformed)
+        self.blank += int(blank)
+        if not len(time_ns):
+            return
+        steps = np.diff(time_ns)
+        if self._last is not None:
+            steps = np.concatenate(([time_ns[0] - self._last], steps))
+        self.duplicates += int(np.count_nonzero(steps == 0))
+        self.backwards += int(np.count_nonzero(steps < 0))
+        self._forward.append(steps[steps > 0])
+        low, high = time_ns.min(), time_ns.max()
+        if self._min is None:
+            self._min, self._max = low, high
+        else:
+            self._min, self._max = min(self._min, low), max(self._max, high)
+        self._last = time_ns[-1]
+
+    def stats(self):
+        ''' The statistics of the rows added so far, see integrity_stats.'''
+        stats = dict(nrows=self.nrows, malformed=self.malformed,
+                     blank=self.blank, duplicates=self.duplicates,
+                     backwards=self.backwards, gaps=0, missing=0,
+                     period_ns=None, rate_hz=None, nominal_rate_hz=None)
+        forward = (np.concatenate(self._forward) if self._forward
+                   else np.empty(0, dtype=np.int64))
+        if len(forward):
+            period = int(np.median(forward))
+            gaps = forward[forward > self.gap_factor * period]
+            stats['gaps'] = len(gaps)
+            stats['missing'] = int(np.rint(gaps / period).sum()) - len(gaps)
+            stats['period_ns'] = period
+            stats['nominal_rate_hz'] = 1e9 / period
+        if self.nrows > 1:
+            span = int(self._max - self._min)
+            if span > 0:
+                stats['rate_hz'] = (self.nrows - 1) * 1e9 / span
+        return stats
+
+
+def integrity_stats(time_ns, malformed=0, gap_factor=GAP_FACTOR, blank=0):
+    ''' Summarize the timestamps of a stream.
+
+        Parameters
+        ----------
+        time_ns : array of int
+            the timestamps, int64 nanoseconds in file order
+        malformed : int, optional
+            the number of lines that did not parse, reported as is
+        gap_factor : float, optional
+            a step between rows longer than this many times the median
+            step is a gap
+        blank : int, optional
+            the number of blank lines, reported as is
+
+        Returns
+        -------
+        stats : dict
+            'nrows', 'malformed', 'blank', 'duplicates' and 'backwards'
+            (the number of rows with the same or an earlier timestamp than
+            the row before), 'gaps' (the number of gaps), 'missing' (an
+            estimate of the samples lost in them), 'period_ns' (the median
+            step), 'rate_hz' (rows per second over the whole stream) and
+            'nominal_rate_hz' (one over the median step)
+    '''
+    counter = IntegrityCounter(gap_factor)
+    counter.add(time_ns, malformed, blank)
+    return counter.stats()
+
+
+def rows_integrity(rows, malformed=0, gap_factor=GAP_FACTOR, blank=0):
+    ''' integrity_stats of PizzaBox rows (a record array or arrow table).'''
+    return integrity_stats(rows_time_ns(rows), malformed, gap_factor, blank)
+
+
+def rows_time_ns(rows):
+    ''' The int64 nanosecond timestamps of PizzaBox rows: a record array,
+        arrow table or {field: column} dict.'''
+    if 'time_ns' in _names(rows):
+        return np.asarray(rows['time_ns'])
+    return timestamps_ns(np.asarray(rows['ts_s']), np.asarray(rows['ts_ns']))
+
+
+class IntegrityRecArray(np.recarray):
+    ''' A record array with the integrity statistics of its rows, in
+        `integrity`. Arrays made from it (slices, copies) have none, the
+        statistics would not be theirs.'''
+    def __array_finalize__(self, obj):
+        super().__array_finalize__(obj)
+        self.integrity = None
+
+
+def with_integrity(rows, stats):
+    ''' rows, a record array or arrow RecordBatch/Table, carrying stats.
+
+        A record array becomes an IntegrityRecArray view, arrow rows get
+        the stats in their schema metadata, as JSON. No data is copied.
+    '''
+    if isinstance(rows, np.ndarray):
+        rows = rows.view(IntegrityRecArray)
+        rows.integrity = stats
+        return rows
+    metadata = dict(rows.schema.metadata or {})
+    metadata[METADATA_KEY] = json.dumps(stats)
+    return rows.replace_schema_metadata(metadata)
+
+
+def integrity_of(rows):
+    ''' The integrity statistics attached to rows by the handlers, or None
+        if there are none (see with_integrity).'''
+    if isinstance(rows, np.ndarray):
+        return getattr(rows, 'integrity', None)
+    stats = (rows.schema.metadata or {}).get(METADATA_KEY)
+    return None if stats is None else json.loads(stats)
+
+
+def _names(rows):
+    if isinstance(rows, np.ndarray):
+        return rows.dtype.names
+    if isinstance(rows, dict):
+        return tuple(rows)
+    return rows.column_names
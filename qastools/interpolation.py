@@ -1,13 +1,44 @@
-from isstools.xasdata import xasdata
 from databroker import Broker
 from uuid import uuid4
 from datetime import datetime
 import os
 from subprocess import call
 
+import numpy as np
+
+try:
+    import pandas as pd
+except ImportError:
+    # only the native engine and rebin need it
+    pd = None
+try:
+    from isstools.xasdata import xasdata
+except ImportError:
+    # rebin works without it
+    xasdata = None
+
+from .binning import bin_dataframe
+from .engine import interpolate_run
+from .handlers import register_handlers
+
+# the pulses per degree of the mono encoder at QAS
+PULSES_PER_DEGREE = 23600*400/360
+
+
+def _require_isstools():
+    if xasdata is None:
+        raise ImportError("interpolate_and_save needs isstools")
+
+
+def _require_pandas():
+    if pd is None:
+        raise ImportError("the native engine and rebin need pandas")
+
+
 def interpolate_and_save(db_name, db_analysis_name,
                          uid, mono_name='mono1_enc',
-                         pulses_per_degree=None):
+                         pulses_per_degree=None, engine='isstools',
+                         cache=None, binning='isstools'):
     ''' Interpolate measured data and save to an analysis store. 
 
         Parameters
@@ -21,22 +52,41 @@ def interpolate_and_save(db_name, db_analysis_name,
         uid : str
             The uid of the data set
         mono_name : str
-            the monochromator encoder name. Defaults to 'mono1_enc'
+            the monochromator encoder name. Defaults to 'mono1_enc'. Given
+            to XASdataGeneric as well, which always had 'mono1_enc' before
         pulses_per_degree : float
             pulses per degree of the encoder from the monochromator
             defaults to the current setup at QAS
+        engine : {'isstools', 'native'}
+            interpolate with isstools' XASdataGeneric.load/interpolate (the
+            default), or opt in to qastools.engine, which refuses runs
+            with digital input streams. The export of the interpolated
+            data still goes through isstools either way, with the native
+            engine on a parser that was never load()ed.
+        cache : InterpolatedCache, optional
+            take the interpolated data of the engine from there when it
+            has the scan, else keep it there for rebin
+        binning : {'isstools', 'native'}
+            the engine of bin_data, gen_parser.bin by default whatever
+            the interpolation engine
 
         Returns
         -------
             interp_df : the interpolated data
             bin_df : the binned data if e0 is set
     '''
+    for name, value in (('engine', engine), ('binning', binning)):
+        if value not in ('native', 'isstools'):
+            raise ValueError("{} must be 'native' or 'isstools', "
+                             "got {!r}".format(name, value))
+    _require_isstools()
+
     # the pulses per degree, hard coded for now
     # TODO : Make a signal to pb1.enc1
     # and have it passed at configuration_attrs 
     # (which results in data in descriptor)
     if pulses_per_degree is None:
-        ppd=23600*400/360
+        ppd = PULSES_PER_DEGREE
     else:
         ppd = pulses_per_degree
 
@@ -51,11 +101,30 @@ def interpolate_and_save(db_name, db_analysis_name,
 
     db_analysis = Broker.named(db_analysis_name)
 
-    # the important part of Bruno's code that does the interpolation
-    gen_parser= xasdata.XASdataGeneric(ppd, db=db, mono_name='mono1_enc')
-    gen_parser.load(uid)
-    # data saves in gen_parser.interp_df
-    gen_parser.interpolate() 
+    gen_parser= xasdata.XASdataGeneric(ppd, db=db, mono_name=mono_name)
+    cached = None
+    if cache is not None:
+        _require_pandas()
+        cached = cache.load(uid, ppd, mono_name, engine=engine)
+    if cached is not None:
+        gen_parser.uid = uid
+        gen_parser.interp_df = pd.DataFrame(cached[0])
+    elif engine == 'native':
+        _require_pandas()
+        gen_parser.uid = uid
+        # the bulk reads need the qastools handlers, those the caller
+        # registered (e.g. with a cache) are kept
+        register_handlers(db, missing_only=True)
+        gen_parser.interp_df = interpolate_run(db, hdr, ppd,
+                                               mono_name=mono_name)
+    else:
+        # the important part of Bruno's code that does the interpolation
+        gen_parser.load(uid)
+        # data saves in gen_parser.interp_df
+        gen_parser.interpolate()
+    if cache is not None and cached is None:
+        cache.store(uid, ppd, mono_name, gen_parser.interp_df,
+                    engine=engine, e0=e0, scan_id=start.get('scan_id'))
 
     # useful command for debugging, looking at energy
     # this is automatically run by gen_parser
@@ -76,7 +145,8 @@ def interpolate_and_save(db_name, db_analysis_name,
     call(['chmod', '774', fileout])
 
 
-    bin_df, bin_df_filename = bin_data(gen_parser, fileout, e0, scan_id=scan_id)
+    bin_df, bin_df_filename = bin_data(gen_parser, fileout, e0,
+                                       scan_id=scan_id, engine=binning)
 
     result = dict(bin_df=bin_df,
                   bin_df_filename=bin_df_filename,
@@ -88,18 +158,85 @@ def interpolate_and_save(db_name, db_analysis_name,
     return result
 
 
-def bin_data(gen_parser, binned_file, e0, scan_id=""):
+def rebin(uid, cache, e0=None, edge_start=None, edge_end=None,
+          preedge_spacing=4, xanes_spacing=0.2, exafs_k_spacing=0.04,
+          mono_name='mono1_enc', pulses_per_degree=None, binned_file=None,
+          engine='isstools'):
+    ''' Bin a scan again, from its interpolated data in a cache.
+
+        No Broker lookup, file reading or interpolation, only the binning
+        (see qastools.binning), so trying other binning parameters is
+        quick. The scan is put in the cache by interpolate_and_save.
+
+        This is the native binning of bin_data, not gen_parser.bin: its
+        grid and window widths differ and the two have not been compared,
+        so the result does not match the default bin_df of
+        interpolate_and_save.
+
+        Parameters
+        ----------
+            uid : the uid of the scan
+            cache : the InterpolatedCache holding it
+            e0 : the energy of the edge, that of the interpolation by
+                default
+            edge_start, edge_end, preedge_spacing, xanes_spacing,
+            exafs_k_spacing : the binning, see bin_dataframe. The XANES
+                range defaults to e0 - 30 to e0 + 30, as in bin_data
+            mono_name, pulses_per_degree, engine : as given to
+                interpolate_and_save
+            binned_file : also write the binned data there, with a .dat
+                extension
+
+        Returns
+        -------
+            bin_df : a dataframe of the binned data
+    '''
+    _require_pandas()
+    if pulses_per_degree is None:
+        pulses_per_degree = PULSES_PER_DEGREE
+    cached = cache.load(uid, pulses_per_degree, mono_name, engine=engine)
+    if cached is None:
+        raise KeyError("scan {} was not interpolated with pulses_per_degree "
+                       "{}, mono_name {!r} and engine {!r} into the cache, "
+                       "see interpolate_and_save".format(
+                           uid, pulses_per_degree, mono_name, engine))
+    data, md = cached
+    if e0 is None:
+        e0 = md['e0']
+    bin_df = bin_dataframe(pd.DataFrame(data), e0, edge_start, edge_end,
+                           preedge_spacing, xanes_spacing, exafs_k_spacing)
+    if binned_file is not None:
+        _export_binned(bin_df, binned_file, e0)
+    return bin_df
+
+
+def bin_data(gen_parser, binned_file, e0, scan_id="", engine='isstools'):
     ''' Bin the data according to iss binning algorithm.
 
         Parameters
         ----------
             e0 : the energy of the edge
             scan_id : optional scan_id for the file writing
+            engine : 'isstools' (the default) uses gen_parser.bin and its
+                exporter. 'native' is opt-in: it bins gen_parser.interp_df
+                with qastools.binning, all the channels at once, and
+                writes a plain np.savetxt .dat file next to binned_file,
+                not the export_dat format. Its grid is not that of
+                gen_parser.bin either (the pre-edge steps down from
+                edge_start, k is measured from e0 at edge_end) and the
+                two have not been compared.
 
         Returns
         -------
             bin_df : a dataframe of the binned data
     '''
+    if engine == 'native':
+        bin_df = bin_dataframe(gen_parser.interp_df, e0, e0 - 30, e0 + 30,
+                               4, 0.2, 0.04)
+        fileout = _export_binned(bin_df, binned_file, e0)
+        call(['chmod', '774', fileout])
+        return bin_df, fileout
+
     # TODO : understand this step better: get the edge and plot
     # commented out for now
     bin_df = gen_parser.bin(e0, e0 - 30, e0 + 30, 4, 0.2, 0.04)
@@ -119,3 +256,11 @@ def bin_data(gen_parser, binned_file, e0, scan_id=""):
     
 
     return bin_df, fileout
+
+
+def _export_binned(bin_df, binned_file, e0):
+    ''' Write bin_df as text, in binned_file with a .dat extension.'''
+    fileout = os.path.splitext(binned_file)[0] + '.dat'
+    header = 'e0: {}\n{}'.format(e0, ' '.join(bin_df.columns))
+    np.savetxt(fileout, bin_df.values, header=header)
+    return fileout
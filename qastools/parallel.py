@@ -0,0 +1,136 @@
+''' Parsing large PizzaBox files on several cores.
+
+    The file is cut into byte ranges along chunk boundaries of its
+    LineIndex, so the first row of every range is known before anything is
+    parsed. Each worker process parses its ranges and writes the rows
+    straight into their place in one shared memory block.
+
+    A compressed file is decompressed in this process, which holds the
+    checkpoints of the index, and the workers are sent the text.
+'''
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import os
+import sys
+
+import numpy as np
+
+from .integrity import rows_integrity, with_integrity
+from .parsing import parse_pizzabox, row_dtype, skip_malformed
+
+
+def parse_parallel(index, columns, bases=None, processes=None,
+                   tasks_per_process=4, time_ns=False, start=0, stop=None,
+                   errors='raise'):
+    ''' Parse the file of a LineIndex with a pool of processes.
+
+        Parameters
+        ----------
+        index : LineIndex
+            the index of the file
+        start, stop : int, optional
+            the range of chunks to parse, all of them by default
+        columns, bases, time_ns :
+            as for parse_pizzabox
+        processes : int, optional
+            size of the pool, defaults to the number of cores
+        tasks_per_process : int, optional
+            the file is cut in about this many ranges per process, so that
+            a slow range does not hold up the others
+        errors : {'raise', 'skip'}, optional
+            fail on a malformed line, or leave it out, see skip_malformed
+
+        Returns
+        -------
+        data : IntegrityRecArray
+            the rows of the chunks, in order, with their integrity_stats.
+            The workers only count the malformed lines, the statistics of
+            the timestamps are taken from the rows once they are all in.
+    '''
+    if processes is None:
+        processes = os.cpu_count() or 1
+    start, stop = index.chunk_range(start, stop)
+    dtype = row_dtype(columns, time_ns)
+    nrows = index.count_rows(start, stop)
+    if nrows == 0:
+        data = np.empty(0, dtype=dtype)
+        return with_integrity(data, rows_integrity(data))
+
+    ranges = _split(index, processes * tasks_per_process, start, stop)
+    shm = shared_memory.SharedMemory(create=True,
+                                     size=nrows * dtype.itemsize)
+    try:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            tasks = []
+            for first, last in ranges:
+                begin = int(index.offsets[first])
+                end = int(index.offsets[last])
+                buf = None
+                if index.compressed:
+                    buf = index.read_bytes(begin, end)
+                row = (first - start) * index.chunk_size
+                tasks.append((row, pool.submit(_parse_range, index.path,
+                                               begin, end, row, columns,
+                                               bases, time_ns, shm.name,
+                                               nrows, buf, errors)))
+            written = [(row, task.result()) for row, task in tasks]
+        shared = np.ndarray((nrows,), dtype=dtype, buffer=shm.buf)
+        if sum(n for _, (n, _) in written) == nrows:
+            data = shared.copy()
+        else:
+            # lines were left out, close the holes they left at the end
+            # of the ranges
+            data = np.concatenate([shared[row:row + n]
+                                   for row, (n, _) in written])
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
+    malformed = sum(bad for _, (_, bad) in written)
+    stats = rows_integrity(data, malformed,
+                           blank=nrows - len(data) - malformed)
+    return with_integrity(data, stats)
+
+
+def _split(index, nparts, start, stop):
+    ''' Cut chunks start:stop in up to nparts (first, last) ranges of
+        about equal bytes.'''
+    offsets = index.offsets
+    targets = np.linspace(offsets[start], offsets[stop], nparts + 1)[1:-1]
+    cuts = np.searchsorted(offsets, targets)
+    cuts = np.unique(np.concatenate(([start], cuts, [stop])))
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+def _parse_range(fpath, start, stop, row, columns, bases, time_ns,
+                 shm_name, nrows, buf=None, errors='raise'):
+    ''' Worker: parse bytes start:stop of fpath (or buf, those bytes
+        already read) into rows row:... of the shared block. Returns the
+        number of rows written and of malformed lines left out.'''
+    shm = _attach(shm_name)
+    try:
+        if buf is None:
+            with open(fpath, 'rb') as f:
+                buf = os.pread(f.fileno(), stop - start, start)
+        malformed = ()
+        if errors == 'skip':
+            data, malformed = skip_malformed(parse_pizzabox, buf, columns,
+                                             bases, time_ns=time_ns)
+        else:
+            data = parse_pizzabox(buf, columns, bases, time_ns)
+        shared = np.ndarray((nrows,), dtype=data.dtype,
+                            buffer=shm.buf)
+        shared[row:row + len(data)] = data
+        del shared
+    finally:
+        shm.close()
+    return len(data), len(malformed)
+
+
+def _attach(name):
+    ''' Open an existing shared memory block without taking ownership.'''
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    # the pool workers share the resource tracker of the parent process,
+    # registering the block again there is harmless
+    return shared_memory.SharedMemory(name=name)
@@ -0,0 +1,458 @@
+''' Vectorized parsing of the PizzaBox text files.
+
+    The PizzaBox writes one sample per line, as whitespace separated
+    integers (decimal, except for the ADC word which is hex). Instead of
+    splitting every line in python, the whole buffer is handled as a uint8
+    array: the token boundaries are found with one pass over the bytes, the
+    hex columns are decoded from a (nrows, width) block of characters and
+    the decimal columns are read by numpy's C parser.
+'''
+import math
+import warnings
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# the separators are space, tab, \r and \n. Other control bytes (e.g. the
+# NULs a truncated file may end with) are characters of a token, which are
+# then not digits
+_SPACE = ord(' ')
+_NEWLINE = ord('\n')
+_ZERO = ord('0')
+_SEPARATOR = np.zeros(256, dtype=bool)
+_SEPARATOR[list(b' \t\r\n')] = True
+
+_X = (ord('x'), ord('X'))
+_SIGNS = (ord('-'), ord('+'))
+
+# value of each character as a hex digit, 255 when it is not one. The 'x'
+# of a '0x' prefix is let through separately, see _hex_prefix
+_HEX_DIGITS = np.full(256, 255, dtype=np.uint8)
+for _value, _char in enumerate(b'0123456789abcdef'):
+    _HEX_DIGITS[_char] = _value
+for _value, _char in enumerate(b'ABCDEF'):
+    _HEX_DIGITS[_char] = _value + 10
+
+# widest hex word that may still fit an int64, those of this width fit
+# when their first digit is below 8
+_MAX_HEX_WIDTH = 16
+_INT64 = np.iinfo(np.int64)
+# room in front of the buffer so windows ending at the first tokens
+# never start at a negative index
+_PAD = _MAX_HEX_WIDTH
+
+
+# name of the optional combined timestamp field
+TIME_FIELD = 'time_ns'
+
+
+def row_dtype(columns, time_ns=False):
+    ''' The record dtype of a PizzaBox row, one int64 per column.'''
+    if time_ns:
+        columns = tuple(columns) + (TIME_FIELD,)
+    return np.dtype([(name, np.int64) for name in columns])
+
+
+def timestamps_ns(ts_s, ts_ns):
+    ''' Combine seconds and nanoseconds into int64 nanoseconds.
+
+        int64 nanoseconds reach the year 2262 and, unlike float64 seconds,
+        keep every nanosecond.
+    '''
+    return np.asarray(ts_s, dtype=np.int64) * 10**9 + ts_ns
+
+
+def seconds_to_ns(t):
+    ''' A time in seconds (e.g. float seconds since the epoch) as int
+        nanoseconds, without going through a float64 of nanoseconds.'''
+    seconds = math.floor(t)
+    return int(seconds) * 10**9 + int(round((t - seconds) * 1e9))
+
+
+def check_timestamps(time_ns):
+    ''' Find where timestamps go backwards or repeat.
+
+        Parameters
+        ----------
+        time_ns : array of int
+            the timestamps, in file order
+
+        Returns
+        -------
+        problems : dict
+            'backwards' and 'duplicates', the indices of the rows earlier
+            than, or equal to, the row before them. 'monotonic' is True when
+            there are neither.
+    '''
+    steps = np.diff(time_ns)
+    backwards = np.flatnonzero(steps < 0) + 1
+    duplicates = np.flatnonzero(steps == 0) + 1
+    return dict(backwards=backwards, duplicates=duplicates,
+                monotonic=not (backwards.size or duplicates.size))
+
+
+def parse_pizzabox(buf, columns, bases=None, time_ns=False):
+    ''' Parse PizzaBox text into a record array.
+
+        Parameters
+        ----------
+        buf : bytes-like
+            the raw text, a whole number of lines
+        columns : sequence of str
+            the column names, one per token on each line
+        bases : sequence of int, optional
+            the base of each column, 10 or 16. Defaults to all decimal.
+        time_ns : bool, optional
+            add a 'time_ns' field, ts_s and ts_ns combined into int64
+            nanoseconds
+
+        Returns
+        -------
+        data : np.recarray
+            one record per line with an int64 field per column, so both
+            ``data.encoder`` (column) and ``data[i].encoder`` (row) work.
+    '''
+    columns = tuple(columns)
+    data = _parse_table(buf, columns, bases, time_ns)
+    return data.view(row_dtype(columns, time_ns))[:, 0].view(np.recarray)
+
+
+def parse_pizzabox_columns(buf, columns, bases=None, time_ns=False):
+    ''' Parse PizzaBox text into contiguous columns.
+
+        Same as parse_pizzabox, but the values of each column are laid out
+        one after the other instead of row by row, ready to be wrapped
+        without a copy (e.g. by pyarrow, see qastools.arrow).
+
+        Returns
+        -------
+        data : dict
+            {field: int64 array}, in column order, 'time_ns' last
+    '''
+    columns = tuple(columns)
+    data = _parse_table(buf, columns, bases, time_ns, order='F')
+    fields = columns + ((TIME_FIELD,) if time_ns else ())
+    return {name: data[:, col] for col, name in enumerate(fields)}
+
+
+def _parse_table(buf, columns, bases, time_ns, order='C'):
+    ''' The (nrows, ncols) int64 array of the values of buf.'''
+    ncols = len(columns)
+    if bases is None:
+        bases = (10,) * ncols
+    if len(bases) != ncols:
+        raise ValueError("need one base per column, got {} bases for {} "
+                         "columns".format(len(bases), ncols))
+    if any(base not in (10, 16) for base in bases):
+        raise ValueError("only base 10 and 16 columns are supported, "
+                         "got {}".format(bases))
+
+    b = np.frombuffer(buf, dtype=np.uint8)
+    if b.size and b[-1] != _NEWLINE:
+        b = np.append(b, np.uint8(_NEWLINE))
+    starts, ends = _token_bounds(b, ncols)
+    nrows = starts.shape[0]
+
+    # column major when asked for, each column is then contiguous. The
+    # filling below is the same either way
+    data = np.empty((nrows, ncols + bool(time_ns)), dtype=np.int64,
+                    order=order)
+    hex_cols = [col for col, base in enumerate(bases) if base == 16]
+    dec_cols = [col for col, base in enumerate(bases) if base == 10]
+
+    # working copy with some blank space in front, the hex tokens are
+    # blanked out of it once decoded so numpy only sees the decimal ones
+    text = b
+    if hex_cols:
+        text = np.empty(b.size + _PAD, dtype=np.uint8)
+        text[:_PAD] = _SPACE
+        text[_PAD:] = b
+    for col in hex_cols:
+        data[:, col] = _decode_hex(text, starts[:, col] + _PAD,
+                                   ends[:, col] + _PAD)
+
+    if dec_cols and nrows:
+        values = _read_decimal(text)
+        if values.size != nrows * len(dec_cols):
+            raise ValueError("expected {} decimal values, "
+                             "found {}".format(nrows * len(dec_cols),
+                                               values.size))
+        values = values.reshape(nrows, len(dec_cols))
+        dec_starts, dec_ends = starts[:, dec_cols], ends[:, dec_cols]
+        # numpy takes a lone sign with the number after it
+        lone = dec_starts[dec_ends - dec_starts == 1]
+        if np.isin(b[lone], _SIGNS).any():
+            raise ValueError("malformed decimal value: a sign alone")
+        _check_saturated(b, values, dec_starts, dec_ends)
+        data[:, dec_cols] = values
+
+    if time_ns:
+        data[:, ncols] = timestamps_ns(data[:, columns.index('ts_s')],
+                                       data[:, columns.index('ts_ns')])
+    return data
+
+
+def skip_malformed(parse, buf, columns, bases=None, **kwargs):
+    ''' Parse buf, leaving out the lines that do not parse.
+
+        Parameters
+        ----------
+        parse : callable
+            parse_pizzabox or parse_pizzabox_columns
+        buf, columns, bases, kwargs :
+            passed on to parse
+
+        Returns
+        -------
+        data :
+            what parse returns for the good lines
+        malformed : np.ndarray
+            the (0 based) numbers of the lines left out
+
+        Clean text is parsed once as usual, the bad lines are only looked
+        for when that fails.
+    '''
+    try:
+        return parse(buf, columns, bases, **kwargs), np.empty(0, dtype=int)
+    except ValueError:
+        pass
+    malformed = find_malformed(buf, columns, bases)
+    return (parse(drop_lines(buf, malformed), columns, bases, **kwargs),
+            malformed)
+
+
+def find_malformed(buf, columns, bases=None):
+    ''' The (0 based) numbers of the lines of buf parse_pizzabox rejects:
+        a wrong number of columns (e.g. a line cut short at the end of a
+        truncated file), characters that are not digits of the column's
+        base, values that do not fit an int64.
+    '''
+    ncols = len(columns)
+    bases = np.asarray((10,) * ncols if bases is None else bases)
+    b = np.frombuffer(buf, dtype=np.uint8)
+    if b.size and b[-1] != _NEWLINE:
+        b = np.append(b, np.uint8(_NEWLINE))
+    newlines = np.flatnonzero(b == _NEWLINE)
+    bad = np.zeros(newlines.size, dtype=bool)
+
+    is_token = np.zeros(b.size + 2, dtype=np.int8)
+    is_token[1:-1] = ~_SEPARATOR[b]
+    edges = np.diff(is_token)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    if not starts.size:
+        return np.flatnonzero(bad)
+    line = np.searchsorted(newlines, starts)
+    counts = np.bincount(line, minlength=newlines.size)
+    bad |= (counts != 0) & (counts != ncols)
+
+    # the column of each token, tokens past the last column of a line
+    # with too many are checked as the last column
+    col = np.arange(starts.size) - np.searchsorted(line, line)
+    base = bases[np.minimum(col, ncols - 1)]
+    lengths = ends - starts
+    is_hex = base == 16
+    bad[line[is_hex & (lengths > _MAX_HEX_WIDTH)]] = True
+    # full width hex words from 8000... on overflow
+    full = np.flatnonzero(is_hex & (lengths == _MAX_HEX_WIDTH))
+    bad[line[full[_HEX_DIGITS[b[starts[full]]] >= 8]]] = True
+    # decimals of 19 digits and more may not fit, those are few
+    for token in np.flatnonzero(~is_hex & (lengths >= 19)):
+        value = bytes(b[starts[token]:ends[token]])
+        try:
+            bad[line[token]] |= not _INT64.min <= int(value) <= _INT64.max
+        except ValueError:
+            bad[line[token]] = True
+
+    # every character against the base of its token, a sign is fine at
+    # the start of a decimal, an x right after a leading 0 of a hex
+    token_of = np.repeat(np.arange(starts.size), lengths)
+    pos = np.flatnonzero(is_token[1:-1])
+    chars = b[pos]
+    at_start = pos == starts[token_of]
+    digit = (chars >= _ZERO) & (chars <= _ZERO + 9)
+    sign = np.isin(chars, _SIGNS)
+    prefix = ((pos == starts[token_of] + 1) & (lengths[token_of] > 2)
+              & np.isin(chars, _X) & (b[pos - 1] == _ZERO))
+    ok = np.where(is_hex[token_of], (_HEX_DIGITS[chars] != 255) | prefix,
+                  digit | (sign & at_start & (lengths[token_of] > 1)))
+    bad[line[token_of[~ok]]] = True
+    return np.flatnonzero(bad)
+
+
+def drop_lines(buf, lines):
+    ''' buf without the given (0 based) lines, as a uint8 array.'''
+    b = np.frombuffer(buf, dtype=np.uint8)
+    if b.size and b[-1] != _NEWLINE:
+        b = np.append(b, np.uint8(_NEWLINE))
+    ends = np.flatnonzero(b == _NEWLINE) + 1
+    keep = np.ones(ends.size, dtype=bool)
+    keep[lines] = False
+    return b[np.repeat(keep, np.diff(ends, prepend=0))]
+
+
+def decode_adc(words, bits=18, shift=8, volts_per_count=None):
+    ''' Turn raw PizzaBox ADC words into signed counts or volts.
+
+        The ADC value sits in `bits` bits of the word, above `shift` status
+        bits, as two's complement.
+
+        Parameters
+        ----------
+        words : array of int
+            the raw words, e.g. the adc column of PizzaBoxAnHandlerTxt
+        bits : int, optional
+            width of the ADC value, 18 on the PizzaBox
+        shift : int, optional
+            number of bits below the ADC value
+        volts_per_count : float, optional
+            if given, return volts instead of counts
+
+        Returns
+        -------
+        counts : np.ndarray
+            int32 counts, or float64 volts if volts_per_count is given
+    '''
+    if not 0 < bits <= 32:
+        raise ValueError("bits must be between 1 and 32, got {}".format(bits))
+    words = np.asarray(words, dtype=np.int64)
+    sign = np.int64(1) << (bits - 1)
+    values = (words >> shift) & ((np.int64(1) << bits) - 1)
+    # sign extend: flip the sign bit then take it back off
+    counts = ((values ^ sign) - sign).astype(np.int32)
+    if volts_per_count is None:
+        return counts
+    return counts * volts_per_count
+
+
+def _token_bounds(b, ncols):
+    ''' Start and (exclusive) end offset of every token in b.
+
+        b must end with a newline. Returns two (nrows, ncols) int64 arrays,
+        raises ValueError if a line does not have ncols tokens or has a
+        control character.
+    '''
+    seps = np.flatnonzero(b <= _SPACE)
+    # the bytes below ' ' that are not separators, checked on the few
+    # candidates only
+    control = seps[~_SEPARATOR[b[seps]]]
+    if control.size:
+        raise ValueError("control character {!r} on line {}".format(
+            bytes(b[control[0]:control[0] + 1]),
+            np.count_nonzero(b[:control[0]] == _NEWLINE) + 1))
+    if seps.size == 0:
+        empty = np.empty((0, ncols), dtype=np.int64)
+        return empty, empty
+
+    # fast path, what the PizzaBox writes: tokens separated by exactly one
+    # character and every line ended by a bare '\n'
+    if seps.size % ncols == 0 and seps[0] > 0:
+        is_newline = b[seps] == _NEWLINE
+        nrows = seps.size // ncols
+        if (is_newline[ncols - 1::ncols].all()
+                and np.count_nonzero(is_newline) == nrows
+                and (np.diff(seps) > 1).all()):
+            starts = np.empty_like(seps)
+            starts[0] = 0
+            starts[1:] = seps[:-1] + 1
+            return starts.reshape(nrows, ncols), seps.reshape(nrows, ncols)
+
+    # general path: runs of whitespace, '\r\n' endings, blank lines
+    is_token = np.zeros(b.size + 2, dtype=np.int8)
+    is_token[1:-1] = b > _SPACE
+    edges = np.diff(is_token)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    line = np.searchsorted(np.flatnonzero(b == _NEWLINE), starts)
+    counts = np.bincount(line)
+    bad = np.flatnonzero((counts != 0) & (counts != ncols))
+    if bad.size:
+        raise ValueError("line {} has {} columns, expected "
+                         "{}".format(bad[0] + 1, counts[bad[0]], ncols))
+    return starts.reshape(-1, ncols), ends.reshape(-1, ncols)
+
+
+def _decode_hex(text, starts, ends):
+    ''' Decode the hex tokens text[starts:ends] and blank them out of text.'''
+    lengths = ends - starts
+    if lengths.size == 0:
+        return np.empty(0, dtype=np.int64)
+    width = int(lengths.max())
+    if width > _MAX_HEX_WIDTH:
+        raise ValueError("hex value with {} digits does not fit "
+                         "in 64 bits".format(width))
+
+    # one row of `width` characters per token, right aligned: shorter
+    # tokens drag in the end of the previous token, mask it as leading 0s
+    windows = sliding_window_view(text, width, writeable=True)
+    block = windows[ends - width]
+    leading = None
+    if lengths.min() < width:
+        leading = np.arange(width) < (width - lengths)[:, None]
+    chars = block.copy()
+    if leading is not None:
+        chars[leading] = _ZERO
+    digits = _HEX_DIGITS[chars]
+    _hex_prefix(chars, digits, lengths)
+    if (digits == 255).any():
+        row = np.flatnonzero((digits == 255).any(axis=1))[0]
+        raise ValueError("invalid hex value on line {}".format(row + 1))
+    # the first of 16 digits is the sign bit of an int64
+    if width == _MAX_HEX_WIDTH and (digits[:, 0] >= 8).any():
+        row = np.flatnonzero(digits[:, 0] >= 8)[0]
+        raise ValueError("hex value on line {} does not fit in an "
+                         "int64".format(row + 1))
+
+    values = np.zeros(lengths.size, dtype=np.int64)
+    for column in digits.T:
+        values <<= 4
+        values |= column
+
+    if leading is None:
+        windows[ends - width] = _SPACE
+    else:
+        # the windows of short tokens may reach back over an earlier
+        # token, writing them back would bring that one back too
+        inside = np.zeros(text.size + 1, dtype=np.int8)
+        inside[starts] = 1
+        inside[ends] = -1
+        text[np.cumsum(inside[:-1], dtype=np.int8) > 0] = _SPACE
+    return values
+
+
+def _hex_prefix(chars, digits, lengths):
+    ''' Let the x of a '0x' prefix through as a 0 digit, in place.
+
+        chars are the right aligned tokens, one per row, and digits their
+        _HEX_DIGITS. An x anywhere else stays invalid, as for int(v, 16).
+    '''
+    width = chars.shape[1]
+    rows = np.flatnonzero(lengths > 2)
+    second = width - lengths[rows] + 1
+    rows = rows[np.isin(chars[rows, second], _X)
+                & (chars[rows, second - 1] == _ZERO)]
+    digits[rows, width - lengths[rows] + 1] = 0
+
+
+def _check_saturated(b, values, starts, ends):
+    ''' Raise ValueError for the decimal tokens numpy clipped to the int64
+        range, values being what it read of the tokens b[starts:ends].'''
+    clipped = np.flatnonzero((values == _INT64.max) |
+                             (values == _INT64.min))
+    for k in clipped:
+        token = bytes(b[starts.flat[k]:ends.flat[k]])
+        if int(token) != values.flat[k]:
+            raise ValueError("decimal value {} on line {} does not fit in "
+                             "an int64".format(token.decode(),
+                                               k // values.shape[1] + 1))
+
+
+def _read_decimal(text):
+    ''' All the whitespace separated decimal integers in text.'''
+    # older numpy warns about trailing garbage, newer numpy raises
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            return np.fromstring(text, dtype=np.int64, sep=' ')
+        except (ValueError, DeprecationWarning) as err:
+            raise ValueError("malformed decimal value: {}".format(err))
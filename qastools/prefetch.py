@@ -0,0 +1,75 @@
+''' Reading PizzaBox chunks ahead of a caller.'''
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+
+class ChunkPrefetcher:
+    ''' Read ahead of a caller walking through chunks in order.
+
+        Once the caller asks for chunks n and n+1 in a row, chunks
+        n+2..n+1+depth are read in background threads while it works on
+        n+1, so they are ready by the time it gets to them. At most depth
+        chunks are held besides the ones handed out. Read ahead chunks that
+        are skipped over are dropped. get may be called from several
+        threads, though read ahead only pays off for one caller walking in
+        order.
+
+        Parameters
+        ----------
+        load : callable
+            load(chunk_num) reads one chunk
+        nchunks : int
+            the number of chunks, nothing is read past the last
+        depth : int
+            how many chunks to read ahead
+        workers : int, optional
+            the number of reading threads
+    '''
+    def __init__(self, load, nchunks, depth, workers=1):
+        if depth < 1:
+            raise ValueError("depth must be positive, got {}".format(depth))
+        self._load = load
+        self.nchunks = nchunks
+        self.depth = depth
+        self._pool = ThreadPoolExecutor(max_workers=workers,
+                                        thread_name_prefix='qastools-prefetch')
+        # chunk_num: future, of the chunks being read ahead
+        self._pending = OrderedDict()
+        self._last = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chunk_num):
+        ''' The chunk chunk_num, as load returns it.'''
+        with self._lock:
+            future = self._pending.pop(chunk_num, None)
+            if future is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            sequential = (self._last is not None
+                          and chunk_num == self._last + 1)
+            self._last = chunk_num
+
+            ahead = range(chunk_num + 1,
+                          min(chunk_num + 1 + self.depth, self.nchunks))
+            for k in [k for k in self._pending if k not in ahead]:
+                self._pending.pop(k).cancel()
+            if sequential:
+                for k in ahead:
+                    if k not in self._pending:
+                        self._pending[k] = self._pool.submit(self._load, k)
+        if future is None:
+            # not read ahead, read by the caller itself
+            return self._load(chunk_num)
+        return future.result()
+
+    def close(self):
+        ''' Stop reading ahead and drop what was read.'''
+        with self._lock:
+            for future in self._pending.values():
+                future.cancel()
+            self._pending.clear()
+        self._pool.shutdown(wait=False)
@@ -0,0 +1,72 @@
+''' Reading PizzaBox files while they are being written.'''
+import os
+import time
+
+from .parsing import parse_pizzabox
+
+
+class PizzaBoxFollower:
+    ''' Follow a PizzaBox text file as lines are appended to it.
+
+        Each read parses only the complete lines written since the previous
+        one. A last line still being written is left for the next read.
+        Usually made by the handlers, e.g.
+        ``PizzaBoxAnHandlerTxt.follow(fpath)``. A follower keeps its place
+        in the file, it is for one thread to use.
+
+        Parameters
+        ----------
+        fpath : str
+            the text file
+        columns, bases, time_ns :
+            as for parse_pizzabox
+        offset : int, optional
+            the byte offset to start from, the start of a line
+    '''
+    def __init__(self, fpath, columns, bases=None, offset=0, time_ns=False):
+        self._fpath = fpath
+        self.columns = columns
+        self.bases = bases
+        self.time_ns = time_ns
+        self.offset = offset
+        self.nrows = 0
+
+    def read_new(self):
+        ''' The rows appended since the last call, as a record array.'''
+        with open(self._fpath, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < self.offset:
+                raise RuntimeError("{} shrank from {} to {} bytes, it was "
+                                   "rewritten".format(self._fpath,
+                                                      self.offset, size))
+            buf = os.pread(f.fileno(), size - self.offset, self.offset)
+        # only up to the last complete line
+        end = buf.rfind(b'\n') + 1
+        data = parse_pizzabox(memoryview(buf)[:end], self.columns,
+                              self.bases, self.time_ns)
+        self.offset += end
+        self.nrows += len(data)
+        return data
+
+    def follow(self, interval=0.5, idle_timeout=None):
+        ''' Yield the new rows as they come.
+
+            Parameters
+            ----------
+            interval : float, optional
+                seconds between looks at the file
+            idle_timeout : float, optional
+                stop once the file did not grow for this many seconds,
+                never stop by default
+        '''
+        last_growth = time.monotonic()
+        while True:
+            data = self.read_new()
+            if len(data):
+                last_growth = time.monotonic()
+                yield data
+            elif (idle_timeout is not None
+                    and time.monotonic() - last_growth > idle_timeout):
+                return
+            else:
+                time.sleep(interval)
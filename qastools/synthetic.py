@@ -0,0 +1,147 @@
+''' Synthetic PizzaBox files, for benchmarks and tests without beamline
+    data.
+
+    The rows look like those of a QAS fly scan: the encoder follows a
+    smooth sweep of the monochromator with a little noise, the DI input
+    toggles at a steady rate, the ADC words carry an 18 bit two's
+    complement signal over 8 status bits. Files are written in the same
+    text format as the PizzaBox, gzip or zstd compressed when the path ends
+    in .gz or .zst::
+
+        write_file('/tmp/an.txt', 'an', 10**6, rate_hz=100e3)
+        PizzaBoxAnHandlerTxt('/tmp/an.txt', 1024).read_all()
+'''
+import gzip
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .handlers import (PizzaBoxAnHandlerTxt, PizzaBoxDIHandlerTxt,
+                       PizzaBoxEncHandlerTxt)
+from .parsing import row_dtype
+
+# the handler reading each kind of file
+HANDLERS = {'enc': PizzaBoxEncHandlerTxt, 'di': PizzaBoxDIHandlerTxt,
+            'an': PizzaBoxAnHandlerTxt}
+# first timestamp, seconds since the epoch
+START = 1500000000
+# rows formatted at once when writing
+_BLOCK = 2**16
+
+
+def generate(kind, nrows, rate_hz=100e3, start=START, seed=0, jitter_ns=0,
+             counts=10**6):
+    ''' The rows of a synthetic PizzaBox file.
+
+        Parameters
+        ----------
+        kind : {'enc', 'di', 'an'}
+            the kind of file, see HANDLERS
+        nrows : int
+            the number of rows
+        rate_hz : float, optional
+            the sample rate
+        start : int, optional
+            the time of the first row, seconds since the epoch
+        seed : int, optional
+            seed of the noise
+        jitter_ns : int, optional
+            the timestamps move by up to this much from the regular grid
+            (staying in order as long as it is below half the period)
+        counts : int, optional
+            the encoder span of the sweep ('enc', 'di')
+
+        Returns
+        -------
+        data : np.recarray
+            the columns of the handler of kind, as it would parse them
+    '''
+    if kind not in HANDLERS:
+        raise ValueError("kind must be one of {}, got "
+                         "{!r}".format(sorted(HANDLERS), kind))
+    rng = np.random.default_rng(seed)
+    handler_class = HANDLERS[kind]
+    data = np.zeros(nrows, dtype=row_dtype(handler_class.columns))
+    data = data.view(np.recarray)
+
+    period_ns = 1e9 / rate_hz
+    time_ns = np.rint(np.arange(nrows) * period_ns).astype(np.int64)
+    if jitter_ns:
+        time_ns += rng.integers(-jitter_ns, jitter_ns + 1, nrows)
+        time_ns[0] = max(time_ns[0], 0)
+    data.ts_s = start + time_ns // 10**9
+    data.ts_ns = time_ns % 10**9
+    data.index = np.arange(nrows)
+
+    phase = np.linspace(0, np.pi, nrows)
+    if kind in ('enc', 'di'):
+        # there and back of the mono, the encoder counts down as the energy
+        # goes up
+        sweep = -counts * (1 - np.cos(2 * phase)) / 2
+        noise = rng.integers(-2, 3, nrows)
+        data.encoder = np.rint(sweep).astype(np.int64) + noise
+    if kind == 'enc':
+        data.state = 1
+    elif kind == 'di':
+        data.di = np.arange(nrows) % 2
+    elif kind == 'an':
+        bits = handler_class.adc_bits
+        volts = 2 + np.sin(8 * phase) + rng.normal(0, 1e-3, nrows)
+        value = np.rint(volts / handler_class.volts_per_count)
+        value = value.astype(np.int64) & ((1 << bits) - 1)
+        status = rng.integers(0, 2, nrows) << 1
+        data.adc = value << handler_class.adc_shift | status
+    return data
+
+
+def write_text(fpath, data, bases=None):
+    ''' Write rows as PizzaBox text, one line per row.
+
+        Parameters
+        ----------
+        fpath : str
+            the file, gzip or zstd compressed if it ends in .gz or .zst
+        data : np.ndarray
+            the rows, a record array of int columns
+        bases : tuple of int, optional
+            the base of each column, 10 or 16, all decimal by default
+    '''
+    names = data.dtype.names
+    if bases is None:
+        bases = (10,) * len(names)
+    line = ' '.join('%d' if base == 10 else '%x' for base in bases) + '\n'
+    columns = np.column_stack([np.asarray(data[name], dtype=np.int64)
+                               for name in names])
+    with _open(fpath) as f:
+        for begin in range(0, len(columns), _BLOCK):
+            block = columns[begin:begin + _BLOCK]
+            text = (line * len(block)) % tuple(block.ravel().tolist())
+            f.write(text.encode())
+
+
+def write_file(fpath, kind, nrows, **kwargs):
+    ''' Write a synthetic file of kind, see generate for the kwargs.
+
+        Returns
+        -------
+        data : np.recarray
+            the rows written
+    '''
+    data = generate(kind, nrows, **kwargs)
+    write_text(fpath, data, HANDLERS[kind].bases)
+    return data
+
+
+def _open(fpath):
+    if fpath.endswith('.gz'):
+        return gzip.open(fpath, 'wb', compresslevel=6)
+    if fpath.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError("writing .zst files needs the zstandard "
+                              "package")
+        return zstandard.open(fpath, 'wb')
+    return open(fpath, 'wb')
@@ -0,0 +1,132 @@
+''' Sparse time indexes of the PizzaBox text files.
+
+    A TimeIndex holds the timestamp of the first line of every chunk, with
+    the byte offset where the chunk starts. The rows of a file are in time
+    order, so a binary search of the index gives the byte range holding
+    the rows of a time window, and only that range is read and parsed.
+
+    The index can be saved to a directory of its own (see
+    time_index_path), and is used again from there as long as the text
+    file is unchanged.
+'''
+import hashlib
+import os
+
+import numpy as np
+
+from .cache import write_atomic
+from .fileindex import resolve_path
+from .parsing import (drop_lines, find_malformed, parse_pizzabox,
+                      skip_malformed, timestamps_ns)
+
+SUFFIX = '.tidx.npz'
+# bytes read at the start of each chunk, enough for its first line
+_HEAD = 256
+
+
+def time_index_path(fpath, directory):
+    ''' Where the time index of text file fpath goes, in directory.'''
+    name = hashlib.sha1(os.path.abspath(fpath).encode()).hexdigest()
+    return os.path.join(directory, name + SUFFIX)
+
+
+class TimeIndex:
+    ''' Timestamps of every stride-th line of a file, and where they are.
+
+        Parameters
+        ----------
+        times : np.ndarray
+            int64 nanoseconds of lines 0, stride, 2*stride, ...
+        offsets : np.ndarray
+            the byte offset of each of these lines, followed by the file
+            size
+        stride : int
+            the number of lines between two samples
+    '''
+    def __init__(self, times, offsets, stride):
+        self.times = np.asarray(times, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.stride = stride
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def nbytes(self):
+        return self.times.nbytes + self.offsets.nbytes
+
+    @classmethod
+    def build(cls, index, columns, bases=None):
+        ''' Index the chunk starts of a LineIndex, reading their first
+            lines only. columns and bases are as for parse_pizzabox.
+
+            A chunk starting with a malformed line is read whole and
+            indexed by its first good row. A chunk with none at all gets
+            the time of the chunk before it.
+        '''
+        offsets = index.offsets
+        heads = []
+        for start, stop in zip(offsets[:-1], offsets[1:]):
+            head = index.read_bytes(start, min(start + _HEAD, stop))
+            heads.append(head.split(b'\n', 1)[0])
+        if not heads:
+            return cls(np.empty(0, dtype=np.int64), offsets,
+                       index.chunk_size)
+        lines = b'\n'.join(heads) + b'\n'
+        # blank lines make no row either
+        bad = np.union1d(find_malformed(lines, columns, bases),
+                         [k for k, head in enumerate(heads)
+                          if not head.strip()]).astype(int)
+        good = np.ones(len(heads), dtype=bool)
+        good[bad] = False
+        data = parse_pizzabox(drop_lines(lines, bad), columns, bases)
+        times = np.empty(len(heads), dtype=np.int64)
+        times[good] = timestamps_ns(data.ts_s, data.ts_ns)
+        for k in bad:
+            chunk = index.read_bytes(offsets[k], offsets[k + 1])
+            data, _ = skip_malformed(parse_pizzabox, chunk, columns, bases)
+            if len(data):
+                times[k] = timestamps_ns(data.ts_s[:1], data.ts_ns[:1])[0]
+            else:
+                # no rows to find, any time between the neighbours will do
+                times[k] = times[k - 1] if k else np.iinfo(np.int64).min
+        return cls(times, offsets, index.chunk_size)
+
+    def byte_range(self, t0, t1):
+        ''' The bytes holding the rows with t0 <= time < t1 (int64
+            nanoseconds), plus up to a chunk of rows on either side.
+
+            Returns
+            -------
+            start, stop : int
+                the byte range, made of whole lines
+            row : int
+                the row number of the line at start
+        '''
+        first = max(np.searchsorted(self.times, t0, side='left') - 1, 0)
+        last = max(np.searchsorted(self.times, t1, side='left'), first)
+        return (int(self.offsets[first]), int(self.offsets[last]),
+                first * self.stride)
+
+    def save(self, path, fpath):
+        ''' Write the index of text file fpath to path.'''
+        stat = os.stat(resolve_path(fpath))
+        write_atomic(path, lambda f: np.savez(
+            f, times=self.times, offsets=self.offsets, stride=self.stride,
+            source_size=stat.st_size, source_mtime_ns=stat.st_mtime_ns))
+
+    @classmethod
+    def load(cls, path, fpath, stride):
+        ''' The index saved at path, or None if there is none for the
+            current version of fpath with this stride.'''
+        try:
+            saved = np.load(path)
+        except FileNotFoundError:
+            return None
+        with saved:
+            stat = os.stat(resolve_path(fpath))
+            if (saved['stride'] != stride
+                    or saved['source_size'] != stat.st_size
+                    or saved['source_mtime_ns'] != stat.st_mtime_ns):
+                return None
+            return cls(saved['times'], saved['offsets'], stride)
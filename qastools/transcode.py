@@ -0,0 +1,124 @@
+''' Convert PizzaBox text files to columnar HDF5.
+
+    The HDF5 copy is written next to the text file (see
+    columnar.converted_path). The text handlers read it instead of the text
+    as long as the text file is unchanged, so a converted run fills with no
+    parsing while its resources, and the text files, stay as they were.
+    The copies can also be read directly with PizzaBoxHandlerHDF5.
+
+    From the command line::
+
+        qastools-transcode --db qas 09645d0a-cdb1-444e-96d1-3ec7e9f0795b
+        qastools-transcode --spec PIZZABOX_AN_FILE_TXT --chunk-size 1024 \\
+            an_file.txt
+'''
+import argparse
+import functools
+import os
+
+from .columnar import converted_path, write_columnar
+from .fileindex import LineIndex
+from .fill import stream_resources
+from .handlers import (PizzaBoxAnHandlerTxt, PizzaBoxDIHandlerTxt,
+                       PizzaBoxEncHandlerTxt, register_handlers)
+from .parsing import parse_pizzabox
+
+TEXT_HANDLERS = {handler_class.spec: handler_class
+                 for handler_class in (PizzaBoxEncHandlerTxt,
+                                       PizzaBoxDIHandlerTxt,
+                                       PizzaBoxAnHandlerTxt)}
+
+
+def transcode_file(fpath, spec, chunk_size, compression='lzf'):
+    ''' Write the columnar copy of a PizzaBox text file.
+
+        Parameters
+        ----------
+        fpath : str
+            the text file
+        spec : str
+            its resource spec, e.g. 'PIZZABOX_ENC_FILE_TXT'
+        chunk_size : int
+            the chunk size of its resource
+        compression : str, optional
+            HDF5 compression filter, None for none
+
+        Returns
+        -------
+        path : str
+            the HDF5 file written
+
+        Raises ValueError for a file with blank lines, see write_columnar.
+    '''
+    try:
+        handler_class = TEXT_HANDLERS[spec]
+    except KeyError:
+        raise ValueError("don't know how to convert {} resources, only "
+                         "{}".format(spec, sorted(TEXT_HANDLERS)))
+    parse = functools.partial(parse_pizzabox, columns=handler_class.columns,
+                              bases=handler_class.bases)
+    path = converted_path(fpath)
+    write_columnar(path, LineIndex(fpath, chunk_size), parse,
+                   handler_class.columns, spec, compression=compression)
+    return path
+
+
+def run_resources(db, hdr):
+    ''' The PizzaBox text resources of a run.'''
+    resources = {resource['uid']: resource
+                 for _, _, resource in stream_resources(db, hdr,
+                                                        TEXT_HANDLERS)}
+    return list(resources.values())
+
+
+def transcode_run(db, hdr, compression='lzf'):
+    ''' Convert all the PizzaBox text files of a run.
+
+        Returns
+        -------
+        paths : list of str
+            the HDF5 files written
+    '''
+    paths = []
+    for resource in run_resources(db, hdr):
+        fpath = os.path.join(resource.get('root') or '',
+                             resource['resource_path'])
+        paths.append(transcode_file(fpath, resource['spec'],
+                                    resource['resource_kwargs']['chunk_size'],
+                                    compression=compression))
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert PizzaBox text files to columnar HDF5.")
+    parser.add_argument('targets', nargs='+',
+                        help="run uids, or text files with --spec")
+    parser.add_argument('--db', help="Broker name, to convert runs")
+    parser.add_argument('--spec', choices=sorted(TEXT_HANDLERS),
+                        help="the spec of the text files given")
+    parser.add_argument('--chunk-size', type=int, default=1024,
+                        help="the chunk size of the text files given")
+    parser.add_argument('--compression', default='lzf',
+                        help="HDF5 compression filter, 'none' for none")
+    args = parser.parse_args(argv)
+    compression = None if args.compression == 'none' else args.compression
+
+    if args.db is not None:
+        from databroker import Broker
+        db = Broker.named(args.db)
+        register_handlers(db)
+        for uid in args.targets:
+            for path in transcode_run(db, db[uid], compression=compression):
+                print(path)
+    elif args.spec is not None:
+        for fpath in args.targets:
+            print(transcode_file(fpath, args.spec, args.chunk_size,
+                                 compression=compression))
+    else:
+        parser.error("give either --db to convert runs or --spec to "
+                     "convert files")
+
+
+if __name__ == '__main__':
+    main()
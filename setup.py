@@ -23,4 +23,12 @@ setuptools.setup(
         "Programming Language :: Python :: 3.5",
     ],
     install_requires=no_git_reqs,
+    extras_require={'hdf5': ['h5py'], 'zstd': ['zstandard'],
+                    'arrow': ['pyarrow'], 'binning': ['scipy', 'pandas']},
+    entry_points={
+        'console_scripts': [
+            'qastools-transcode = qastools.transcode:main',
+            'qastools-interpolate = qastools.batch:main',
+        ],
+    },
 )
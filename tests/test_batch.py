@@ -0,0 +1,71 @@
+import multiprocessing
+import sys
+import time
+import types
+
+import pytest
+
+from qastools.batch import interpolate_batch
+
+UIDS = ['a', 'bad', 'c', 'd', 'a', 'e']
+
+
+def fake_interpolate_and_save(db_name, db_analysis_name, uid, cache=None,
+                              mono_name='mono1_enc'):
+    if uid == 'bad':
+        raise RuntimeError('no such scan')
+    # the first scans take longest, they end out of order in a pool
+    time.sleep(0.05 * (uid == 'a'))
+    return dict(scan_id=ord(uid),
+                interp_df_filename='{}/{}_{}.txt'.format(db_name, uid,
+                                                         mono_name),
+                bin_df_filename='{}/{}.dat'.format(db_analysis_name, uid))
+
+
+@pytest.fixture
+def fake_interpolation(monkeypatch):
+    ''' interpolate_and_save replaced, in this process and in the workers
+        forked from it.'''
+    module = types.ModuleType('qastools.interpolation')
+    module.interpolate_and_save = fake_interpolate_and_save
+    monkeypatch.setitem(sys.modules, 'qastools.interpolation', module)
+
+
+def run(processes):
+    progress = []
+    outcomes = interpolate_batch(
+        'db', 'analysis', UIDS, processes=processes, mono_name='mono2_enc',
+        progress=lambda *args: progress.append(args))
+    return outcomes, progress
+
+
+def without_times(outcomes):
+    return [{key: value for key, value in outcome.items()
+             if key != 'seconds'} for outcome in outcomes]
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_batch(fake_interpolation, processes):
+    if processes > 1 and multiprocessing.get_start_method() != 'fork':
+        pytest.skip("the workers need to be forked to see the fake")
+    outcomes, progress = run(processes)
+    # in the order of the uids, each once
+    assert [outcome['uid'] for outcome in outcomes] == ['a', 'bad', 'c',
+                                                        'd', 'e']
+    # the failed scan is reported and the others go on
+    assert [outcome['ok'] for outcome in outcomes] == [True, False, True,
+                                                       True, True]
+    bad = outcomes[1]
+    assert bad['error'] == 'RuntimeError: no such scan'
+    assert 'fake_interpolate_and_save' in bad['traceback']
+    assert outcomes[0]['interp_df_filename'] == 'db/a_mono2_enc.txt'
+    assert outcomes[0]['bin_df_filename'] == 'analysis/a.dat'
+    assert outcomes[0]['scan_id'] == ord('a')
+    # progress as each scan ends
+    assert [(ndone, ntotal) for ndone, ntotal, _ in progress] == [
+        (k, 5) for k in range(1, 6)]
+    assert sorted(outcome['uid'] for _, _, outcome in progress) == sorted(
+        outcome['uid'] for outcome in outcomes)
+    # the same outcomes as the serial path
+    serial, _ = run(1)
+    assert without_times(outcomes) == without_times(serial)
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+from qastools.encoder import condition_encoder, find_glitches
+
+BITS = 16
+HALF = 1 << (BITS - 1)
+FULL = 1 << BITS
+
+
+def wrap(counts, bits=BITS):
+    ''' What a signed counter of that width reads for true counts.'''
+    half, full = 1 << (bits - 1), 1 << bits
+    return (np.asarray(counts, dtype=np.int64) + half) % full - half
+
+
+@pytest.mark.parametrize('step', [1000, -1000, 30000])
+def test_unwrap_several_wraps(step):
+    counts = np.arange(500) * step
+    encoder, stats = condition_encoder(wrap(counts), bits=BITS,
+                                       max_step=FULL)
+    assert np.array_equal(encoder, counts)
+    # the number of times the true counts crossed the edge of the range
+    crossings = np.count_nonzero(np.diff((counts + HALF) // FULL))
+    assert crossings >= 3
+    assert stats['rollovers'] == crossings
+    assert stats['glitches'].size == 0
+    assert (stats['min'], stats['max']) == (counts.min(), counts.max())
+
+
+def test_unsigned_first_sample():
+    ''' A counter written unsigned starts out negative.'''
+    counts = (0xFFFF0000 + np.arange(10) * 0x4000) % 2**32
+    encoder, stats = condition_encoder(counts)
+    assert encoder[0] == -0x10000
+    assert np.array_equal(np.diff(encoder), np.full(9, 0x4000))
+    assert stats['rollovers'] == 1
+
+
+def test_single_glitch():
+    counts = np.arange(100) * 7
+    raw = counts.copy()
+    raw[40] = 123456789
+    encoder, stats = condition_encoder(raw)
+    assert stats['glitches'].tolist() == [40]
+    assert np.array_equal(encoder, counts)
+    assert stats['rollovers'] == 0
+    # only reported
+    encoder, stats = condition_encoder(raw, repair=False)
+    assert stats['glitches'].tolist() == [40]
+    assert np.array_equal(encoder, raw)
+
+
+@pytest.mark.parametrize('at', [-2, -1, 0, 1])
+def test_glitch_next_to_wrap(at):
+    ''' A glitch just before, at or just after a wrap of the counter.'''
+    counts = HALF - 50 * 7 + np.arange(100) * 7
+    edge = np.flatnonzero(counts >= HALF)[0]
+    raw = wrap(counts)
+    glitch = edge + at
+    raw[glitch] = wrap(counts[glitch] + HALF // 2)
+    encoder, stats = condition_encoder(raw, bits=BITS, max_step=1000)
+    assert stats['glitches'].tolist() == [glitch]
+    assert stats['rollovers'] == 1
+    assert np.array_equal(encoder, counts)
+
+
+def test_glitches_not_handled():
+    ''' As documented, a glitch is a single sample that comes back: one
+        on the last sample, or two in a row, are left as they are.'''
+    counts = np.arange(50) * 7
+    last = counts.copy()
+    last[-1] = 10**6
+    encoder, stats = condition_encoder(last)
+    assert stats['glitches'].size == 0
+    assert np.array_equal(encoder, last)
+
+    double = counts.copy()
+    double[20:22] = 10**6
+    encoder, stats = condition_encoder(double)
+    assert stats['glitches'].size == 0
+    assert np.array_equal(encoder, double)
+
+
+def test_find_glitches():
+    steps = np.array([1, 5000, -5000, 1, 5000, 1, -5000, 1])
+    assert find_glitches(steps, max_step=100).tolist() == [2]
+    assert find_glitches(np.empty(0, dtype=np.int64)).size == 0
+
+
+def test_empty():
+    encoder, stats = condition_encoder([])
+    assert encoder.size == 0 and stats['nrows'] == 0
@@ -0,0 +1,166 @@
+import functools
+
+import numpy as np
+import pytest
+
+from qastools.engine import (group_traces, interp_block, interpolate,
+                             load_traces, ns_to_seconds, split_means,
+                             to_dataframe)
+from qastools.handlers import HANDLERS, PizzaBoxAnHandlerTxt, register_handlers
+from qastools.parsing import decode_adc, timestamps_ns
+
+START_NS = 1500000000 * 10**9
+
+
+def test_interp_block():
+    rng = np.random.default_rng(0)
+    xp = np.cumsum(rng.uniform(0.5, 1.5, 50))
+    fp = rng.normal(size=(50, 3))
+    x = np.concatenate(([xp[0] - 1], rng.uniform(xp[0], xp[-1], 100),
+                        [xp[-1], xp[-1] + 1]))
+    out = interp_block(x, xp, fp)
+    for k in range(3):
+        assert np.allclose(out[:, k], np.interp(x, xp, fp[:, k]))
+
+
+@pytest.mark.parametrize('n, nparts', [(100, 7), (10, 10), (1000, 3)])
+def test_split_means(n, nparts):
+    values = np.arange(n * 2, dtype=float).reshape(n, 2) ** 1.5
+    expected = [piece.mean(axis=0)
+                for piece in np.array_split(values, nparts)]
+    assert np.allclose(split_means(values, nparts), expected)
+
+
+def test_interpolate_keeps_nanoseconds():
+    ''' Timestamps a few ns apart, far from the epoch, stay apart.'''
+    enc_time = START_NS + np.arange(20) * 1000 + 3
+    an_time = START_NS + np.arange(200) * 100
+    traces = [('energy', enc_time, np.arange(20.)),
+              ('i0', an_time, an_time - START_NS),
+              ('it', an_time, 2. * (an_time - START_NS))]
+    blocks = group_traces(traces)
+    # the two ADC channels share their timestamps
+    assert [block.names for block in blocks] == [('energy',), ('i0', 'it')]
+    block = interpolate(blocks)
+    assert block.time.dtype == np.int64
+    assert np.array_equal(block.time, enc_time)
+    # a straight line of the time is averaged down and interpolated back
+    # to the time itself, past the middle of the first piece averaged
+    time = block.time[1:] - START_NS
+    assert np.allclose(block.values[1:, 1], time, rtol=0, atol=1e-6)
+    assert np.allclose(block.values[1:, 2], 2 * time, rtol=0, atol=1e-6)
+    df = to_dataframe(block)
+    assert list(df.columns) == ['timestamp', 'energy', 'i0', 'it']
+    assert np.array_equal(df['timestamp'].values, ns_to_seconds(block.time))
+
+
+def test_ns_to_seconds():
+    time_ns = np.array([START_NS + 123456789, START_NS - 1])
+    assert ns_to_seconds(time_ns).tolist() == [1500000000.123456789,
+                                               1499999999.999999999]
+
+
+class FakeRegistry:
+    def __init__(self):
+        self.handler_reg = {}
+
+    def register_handler(self, key, handler, overwrite=False):
+        self.handler_reg[key] = handler
+
+
+class FakeBroker:
+    def __init__(self):
+        self.reg = FakeRegistry()
+
+
+def test_register_handlers_missing_only():
+    db = FakeBroker()
+    mine = functools.partial(PizzaBoxAnHandlerTxt, cache=None)
+    db.reg.handler_reg[PizzaBoxAnHandlerTxt.spec] = mine
+    register_handlers(db, missing_only=True)
+    assert db.reg.handler_reg[PizzaBoxAnHandlerTxt.spec] is mine
+    assert len(db.reg.handler_reg) == len(HANDLERS)
+    register_handlers(db)
+    assert db.reg.handler_reg[PizzaBoxAnHandlerTxt.spec] is not mine
+
+
+def test_interpolated_cache_engines(tmp_path):
+    pd = pytest.importorskip('pandas')
+    from qastools.cache import InterpolatedCache
+    cache = InterpolatedCache(str(tmp_path))
+    interp_df = pd.DataFrame({'timestamp': [1., 2.], 'energy': [3., 4.]})
+    cache.store('uid', 1000, 'mono1_enc', interp_df, engine='isstools',
+                e0=7112)
+    # each engine has its own entries
+    assert cache.load('uid', 1000, 'mono1_enc') is None
+    data, md = cache.load('uid', 1000, 'mono1_enc', engine='isstools')
+    assert data.energy.tolist() == [3., 4.]
+    assert md['engine'] == 'isstools' and md['e0'] == 7112
+
+
+class FakeRun:
+    ''' A run with one stream per resource spec, stream 'name' holding
+        datum 'name-datum'.'''
+    def __init__(self, specs):
+        self.specs = specs
+        self.start = {}
+        self.stream_names = list(specs)
+        self.descriptors = [
+            dict(name=name, data_keys={name: dict(external='FILESTORE:')})
+            for name in specs]
+
+    def events(self, stream_name, fill=False):
+        yield dict(data={stream_name: stream_name + '-datum'})
+
+
+class FakeRunRegistry(FakeRegistry):
+    def __init__(self, run):
+        super().__init__()
+        self.run = run
+
+    def resource_given_datum_id(self, datum_id):
+        name = datum_id[:-len('-datum')]
+        return dict(uid=name, spec=self.run.specs[name])
+
+
+def test_runs_with_digital_inputs_are_refused():
+    run = FakeRun({'mono1_enc': 'PIZZABOX_ENC_FILE_TXT',
+                   'pba1_adc1': 'PIZZABOX_AN_FILE_TXT',
+                   'di': 'PIZZABOX_DI_FILE_TXT'})
+    db = FakeBroker()
+    db.reg = FakeRunRegistry(run)
+    with pytest.raises(ValueError, match='digital input'):
+        load_traces(db, run, 1000)
+
+
+class FakeResourceRegistry:
+    ''' The datums and handler of one resource, its chunks as datums.'''
+    def __init__(self, handler):
+        self.handler = handler
+
+    def datum_gen_given_resource(self, uid):
+        for chunk_num in range(len(self.handler._index)):
+            yield dict(datum_id=str(chunk_num),
+                       datum_kwargs=dict(chunk_num=chunk_num))
+
+    def get_spec_handler(self, uid):
+        return self.handler
+
+
+@pytest.mark.parametrize('kind', ['an', 'enc'])
+def test_read_channel(tmp_path, kind):
+    from qastools.analog import read_channel
+    from qastools.synthetic import HANDLERS, write_file
+    fpath = str(tmp_path / 'data.txt')
+    data = write_file(fpath, kind, 1000)
+    handler = HANDLERS[kind](fpath, 64)
+    db = FakeBroker()
+    db.reg = FakeResourceRegistry(handler)
+    time_ns, values = read_channel(db, dict(uid='r', spec=handler.spec))
+    assert np.array_equal(time_ns, timestamps_ns(data.ts_s, data.ts_ns))
+    if kind == 'an':
+        expected = decode_adc(data.adc,
+                              volts_per_count=handler.volts_per_count)
+    else:
+        expected = data.encoder
+    assert np.array_equal(values, expected)
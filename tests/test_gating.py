@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+from qastools.gating import (di_state, find_edges, gate_windows,
+                             window_means, window_rows)
+
+
+def loop_windows(time_ns, state):
+    ''' The windows of a state, one row at a time.'''
+    windows, opened = [], None
+    for k in range(1, len(state)):
+        if state[k] and not state[k - 1]:
+            opened = time_ns[k]
+        elif not state[k] and state[k - 1] and opened is not None:
+            windows.append((opened, time_ns[k]))
+            opened = None
+    return windows
+
+
+def loop_means(time_ns, values, start, stop):
+    ''' The means over the windows, one window at a time.'''
+    means, counts = [], []
+    for t0, t1 in zip(start, stop):
+        rows = values[(time_ns >= t0) & (time_ns < t1)]
+        counts.append(len(rows))
+        means.append(rows.mean(axis=0) if len(rows)
+                     else np.full(values.shape[1:], np.nan))
+    return np.array(means).reshape((-1,) + values.shape[1:]), counts
+
+
+@pytest.mark.parametrize('state', [
+    [0, 1, 1, 0, 0, 1, 0],
+    # open at the start and at the end
+    [1, 1, 0, 1, 0, 0, 1, 1],
+    [1, 1, 1],
+    [1, 0, 0],
+    [0, 0, 1],
+    [],
+])
+def test_gate_windows(state):
+    time_ns = 10**9 + np.arange(len(state)) * 1000
+    start, stop = gate_windows(time_ns, np.array(state, dtype=np.int64))
+    assert list(zip(start, stop)) == loop_windows(time_ns, state)
+    # the gate active low is the other windows
+    start, stop = gate_windows(time_ns, np.array(state, dtype=np.int64),
+                               active_high=False)
+    inverted = [not s for s in state]
+    assert list(zip(start, stop)) == loop_windows(time_ns, inverted)
+
+
+def test_di_state_and_edges():
+    di = np.array([0, 4, 5, 1, 0, 4])
+    assert di_state(di).tolist() == [False, True, True, True, False, True]
+    assert di_state(di, bit=2).tolist() == [False, True, True, False,
+                                            False, True]
+    rising, falling = find_edges(di_state(di, bit=2))
+    assert rising.tolist() == [1, 5] and falling.tolist() == [3]
+
+
+@pytest.mark.parametrize('nchannels', [None, 3])
+def test_window_means_match_loop(nchannels):
+    rng = np.random.default_rng(0)
+    time_ns = np.sort(rng.integers(0, 10**6, 2000))
+    shape = (len(time_ns),) if nchannels is None else (len(time_ns),
+                                                       nchannels)
+    values = rng.normal(size=shape)
+    start = np.sort(rng.integers(-10**5, 11 * 10**5, 50))
+    stop = start + rng.integers(0, 5 * 10**4, 50)
+    # empty windows: zero length, between two rows, and past the end
+    start[:3] = stop[:3] = time_ns[100]
+    start[3], stop[3] = time_ns[200] + 1, time_ns[200] + 1
+    start[4], stop[4] = time_ns[-1] + 10, time_ns[-1] + 100
+    # ending at the last row, and taking it in, which pads the rows
+    start[5], stop[5] = time_ns[1990], time_ns[-1]
+    start[6], stop[6] = time_ns[1990], time_ns[-1] + 1
+    means, counts = window_means(time_ns, values, start, stop)
+    expected, expected_counts = loop_means(time_ns, values, start, stop)
+    assert counts.tolist() == expected_counts
+    assert np.allclose(means, expected, equal_nan=True)
+    assert np.isnan(means[:5]).all()
+    assert counts[6] == counts[5] + 1 and np.isfinite(means[6]).all()
+
+
+def test_window_rows():
+    time_ns = np.array([0, 10, 20, 30])
+    first, last = window_rows(time_ns, [0, 5, 20, 40], [10, 25, 21, 50])
+    assert first.tolist() == [0, 1, 2, 4]
+    assert last.tolist() == [1, 3, 3, 4]
+
+
+def test_no_windows():
+    means, counts = window_means(np.arange(5), np.ones((5, 2)), [], [])
+    assert means.shape == (0, 2) and counts.size == 0
@@ -0,0 +1,295 @@
+import os
+
+import numpy as np
+import pytest
+
+from qastools import fileindex
+from qastools.cache import MemoryCache, ParsedFileCache, write_atomic
+from qastools.fileindex import LineIndex, _CompressedSource, _new_gzip
+from qastools.handlers import PizzaBoxAnHandlerTxt, PizzaBoxEncHandlerTxt
+from qastools.integrity import integrity_of
+from qastools.parsing import seconds_to_ns, timestamps_ns
+from qastools.synthetic import write_file
+
+NROWS = 1000
+# does not divide NROWS, the last chunk is short
+CHUNK_SIZE = 64
+
+
+@pytest.fixture
+def an_file(tmp_path):
+    fpath = str(tmp_path / 'an.txt')
+    data = write_file(fpath, 'an', NROWS, rate_hz=1e3, jitter_ns=1000)
+    return fpath, data
+
+
+def test_chunks(an_file):
+    fpath, data = an_file
+    handler = PizzaBoxAnHandlerTxt(fpath, CHUNK_SIZE)
+    nchunks = -(-NROWS // CHUNK_SIZE)
+    for chunk_num in range(nchunks):
+        chunk = handler(chunk_num)
+        expected = data[chunk_num * CHUNK_SIZE:(chunk_num + 1) * CHUNK_SIZE]
+        assert chunk.tolist() == expected.tolist()
+    assert len(handler(nchunks - 1)) == NROWS % CHUNK_SIZE
+    assert len(handler(nchunks)) == 0
+    assert handler.read_all().tolist() == data.tolist()
+    assert handler.read_chunks(3, 7).tolist() == data[3 * 64:7 * 64].tolist()
+
+
+def test_chunk_boundaries_with_blank_lines_and_crlf(tmp_path):
+    fpath = str(tmp_path / 'enc.txt')
+    with open(fpath, 'wb') as f:
+        f.write(b'1 0 5 0 1\r\n1 1 6 1 1\r\n\r\n1 2 7 2 1\n1 3 8 3 1')
+    handler = PizzaBoxEncHandlerTxt(fpath, 2)
+    # chunks are made of lines, a blank line makes no row
+    assert handler(0).encoder.tolist() == [5, 6]
+    assert handler(1).encoder.tolist() == [7]
+    assert handler(2).encoder.tolist() == [8]
+    assert handler.read_all().encoder.tolist() == [5, 6, 7, 8]
+
+
+def test_skip_mode(tmp_path):
+    fpath = str(tmp_path / 'enc.txt')
+    with open(fpath, 'wb') as f:
+        f.write(b'1 0 5 0 1\n1 1 oops 1 1\n1 2 7 2 1\n1 3 8')
+    with pytest.raises(ValueError):
+        PizzaBoxEncHandlerTxt(fpath, 2)(0)
+    handler = PizzaBoxEncHandlerTxt(fpath, 2, errors='skip')
+    assert handler(0).encoder.tolist() == [5]
+    assert handler(1).encoder.tolist() == [7]
+    assert handler.read_all().encoder.tolist() == [5, 7]
+
+
+def test_nul_tail(tmp_path):
+    ''' The NULs a truncated file may end with are a malformed line.'''
+    fpath = str(tmp_path / 'enc.txt')
+    with open(fpath, 'wb') as f:
+        f.write(b'1 0 5 0 1\n1 1 6 1 1\n1 2 7 2 1\n\0\0\0\0\0\0')
+    with pytest.raises(ValueError):
+        PizzaBoxEncHandlerTxt(fpath, 2).read_all()
+    handler = PizzaBoxEncHandlerTxt(fpath, 2, errors='skip')
+    assert handler(1).encoder.tolist() == [7]
+    assert handler.read_all().encoder.tolist() == [5, 6, 7]
+    assert integrity_of(handler.read_all())['malformed'] == 1
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_read_all_processes(an_file, processes):
+    fpath, data = an_file
+    handler = PizzaBoxAnHandlerTxt(fpath, CHUNK_SIZE)
+    assert handler.read_all(processes=processes).tolist() == data.tolist()
+
+
+def test_gzip(tmp_path, an_file):
+    fpath, data = an_file
+    # only the compressed copy of the text file is there
+    gz_path = str(tmp_path / 'gz' / 'an.txt')
+    os.makedirs(os.path.dirname(gz_path))
+    write_file(gz_path + '.gz', 'an', NROWS, rate_hz=1e3, jitter_ns=1000)
+    plain, compressed = LineIndex(fpath, 100), LineIndex(gz_path, 100)
+    assert compressed.compressed
+    assert np.array_equal(plain.offsets, compressed.offsets)
+    assert plain.nlines == compressed.nlines == NROWS
+    for chunk_num in (7, 0, 9, 3, 3, 10):
+        assert plain.read(chunk_num) == compressed.read(chunk_num)
+    handler = PizzaBoxAnHandlerTxt(gz_path, CHUNK_SIZE)
+    assert handler(5).tolist() == data[5 * 64:6 * 64].tolist()
+    assert handler.read_all().tolist() == data.tolist()
+
+
+def test_gzip_checkpoints(tmp_path, an_file, monkeypatch):
+    ''' Reads resume from the decompressor states saved while indexing.'''
+    fpath, _ = an_file
+    # a state can only be saved between two blocks of input
+    monkeypatch.setattr(fileindex, '_INPUT_BLOCK', 1024)
+    write_file(str(tmp_path / 'an.txt.gz'), 'an', NROWS, rate_hz=1e3,
+               jitter_ns=1000)
+    source = _CompressedSource(str(tmp_path / 'an.txt.gz'), _new_gzip, True,
+                               spacing=2048)
+    text = b''.join(source.iter_blocks())
+    with open(fpath, 'rb') as f:
+        assert text == f.read()
+    assert len(source._checkpoints) > 5
+    rng = np.random.default_rng(0)
+    for start in rng.integers(0, len(text), 20):
+        stop = start + int(rng.integers(0, 5000))
+        assert source.read(start, stop) == text[start:stop]
+
+
+def test_read_time_range(an_file):
+    fpath, data = an_file
+    handler = PizzaBoxAnHandlerTxt(fpath, CHUNK_SIZE)
+    times = timestamps_ns(data.ts_s, data.ts_ns)
+    for t0, t1 in [(times[0], times[-1] + 1), (times[100], times[101]),
+                   (times[130] - 1, times[500]), (times[5], times[5]),
+                   (times[-1] + 1, times[-1] + 10**9),
+                   (times[0] - 10**9, times[3])]:
+        t0, t1 = t0 / 1e9, t1 / 1e9
+        rows = handler.read_time_range(t0, t1)
+        expected = data[(times >= seconds_to_ns(t0)) &
+                        (times < seconds_to_ns(t1))]
+        assert rows.tolist() == expected.tolist()
+
+
+def test_memory_cache():
+    cache = MemoryCache(max_bytes=3 * 800)
+    arrays = [np.full(100, k, dtype=np.int64) for k in range(4)]
+    for k in range(3):
+        cache.put(k, arrays[k])
+    assert cache.get(0) is arrays[0]
+    # 1 is now the least recently used
+    cache.put(3, arrays[3])
+    assert cache.get(1) is None
+    assert [cache.get(k) is arrays[k] for k in (0, 2, 3)] == [True] * 3
+    assert cache.nbytes == 3 * 800
+    cache.put('big', np.zeros(1000))
+    assert cache.get('big') is None and len(cache) == 3
+
+
+def test_write_atomic(tmp_path):
+    path = str(tmp_path / 'entry')
+    assert write_atomic(path, lambda f: f.write(b'one'))
+    assert not write_atomic(path, lambda f: False)
+
+    def fail(tmp_path):
+        raise RuntimeError
+    with pytest.raises(RuntimeError):
+        write_atomic(path, fail, open_file=False)
+    # the temporary files are gone, the entry is what was written first
+    assert os.listdir(str(tmp_path)) == ['entry']
+    with open(path, 'rb') as f:
+        assert f.read() == b'one'
+
+
+def test_parsed_file_cache(tmp_path, an_file):
+    fpath, data = an_file
+    cache = ParsedFileCache(str(tmp_path / 'cache'))
+    columns, bases = PizzaBoxAnHandlerTxt.columns, PizzaBoxAnHandlerTxt.bases
+    assert cache.load(fpath, columns, bases) is None
+    handler = PizzaBoxAnHandlerTxt(fpath, CHUNK_SIZE, cache=cache)
+    assert handler(2).tolist() == data[128:192].tolist()
+    cached = cache.load(fpath, columns, bases)
+    assert isinstance(cached.base, np.memmap)
+    assert cached.tolist() == data.tolist()
+    handler = PizzaBoxAnHandlerTxt(fpath, CHUNK_SIZE, cache=cache)
+    assert handler.read_all().tolist() == data.tolist()
+
+    # a rewritten file is parsed again
+    data = write_file(fpath, 'an', NROWS // 2, seed=1)
+    os.utime(fpath, ns=(0, 0))
+    assert cache.load(fpath, columns, bases) is None
+    handler = PizzaBoxAnHandlerTxt(fpath, CHUNK_SIZE, cache=cache)
+    assert handler.read_all().tolist() == data.tolist()
+
+
+def test_parsed_file_cache_eviction(tmp_path, an_file):
+    fpath, _ = an_file
+    entry = NROWS * 8 * len(PizzaBoxAnHandlerTxt.columns)
+    cache = ParsedFileCache(str(tmp_path / 'cache'), max_bytes=entry * 1.5)
+    other = str(tmp_path / 'other.txt')
+    write_file(other, 'an', NROWS, seed=2)
+    PizzaBoxAnHandlerTxt(fpath, CHUNK_SIZE, cache=cache)
+    PizzaBoxAnHandlerTxt(other, CHUNK_SIZE, cache=cache)
+    columns, bases = PizzaBoxAnHandlerTxt.columns, PizzaBoxAnHandlerTxt.bases
+    assert cache.load(fpath, columns, bases) is None
+    assert cache.load(other, columns, bases) is not None
+
+
+def test_converted_copy(tmp_path, an_file):
+    h5py = pytest.importorskip('h5py')
+    from qastools.columnar import converted_path
+    from qastools.transcode import transcode_file
+    fpath, data = an_file
+    # an unrelated HDF5 file next to the text file is left alone
+    with h5py.File(str(tmp_path / 'an.h5'), 'w') as f:
+        f['x'] = np.arange(3)
+    path = transcode_file(fpath, PizzaBoxAnHandlerTxt.spec, CHUNK_SIZE)
+    assert path == converted_path(fpath) != str(tmp_path / 'an.h5')
+    handler = PizzaBoxAnHandlerTxt(fpath, CHUNK_SIZE)
+    assert handler._data is not None
+    assert handler(3).tolist() == data[3 * 64:4 * 64].tolist()
+    assert handler.read_all().tolist() == data.tolist()
+
+
+def test_no_converted_copy_with_blank_lines(tmp_path):
+    ''' Rows would not match the chunks of lines, the text is read.'''
+    pytest.importorskip('h5py')
+    from qastools.transcode import transcode_file
+    fpath = str(tmp_path / 'enc.txt')
+    with open(fpath, 'wb') as f:
+        f.write(b'1 0 5 0 1\r\n1 1 6 1 1\r\n\r\n1 2 7 2 1\n1 3 8 3 1\n')
+    with pytest.raises(ValueError):
+        transcode_file(fpath, PizzaBoxEncHandlerTxt.spec, 2)
+    assert os.listdir(str(tmp_path)) == ['enc.txt']
+    handler = PizzaBoxEncHandlerTxt(fpath, 2)
+    assert [handler(k).encoder.tolist() for k in range(3)] == [[5, 6], [7],
+                                                               [8]]
+    assert handler.read_all().encoder.tolist() == [5, 6, 7, 8]
+
+
+@pytest.mark.parametrize('attrs', [
+    {},
+    {'columns': ['x']},
+    {'columns': ['ts_s', 'x'], 'spec': PizzaBoxAnHandlerTxt.spec},
+    {'columns': ['x'], 'spec': PizzaBoxAnHandlerTxt.spec},
+])
+def test_foreign_converted_copy(an_file, attrs):
+    ''' A file at the converted path that is not a copy of the text file
+        is ignored, the text is read.'''
+    h5py = pytest.importorskip('h5py')
+    from qastools.columnar import converted_path
+    fpath, data = an_file
+    with h5py.File(converted_path(fpath), 'w') as f:
+        f['x'] = np.arange(3)
+        f.attrs.update(attrs)
+    handler = PizzaBoxAnHandlerTxt(fpath, CHUNK_SIZE)
+    assert handler._data is None
+    assert handler.read_all().tolist() == data.tolist()
+
+
+def test_converted_copy_of_other_spec(tmp_path):
+    pytest.importorskip('h5py')
+    from qastools.transcode import transcode_file
+    fpath = str(tmp_path / 'enc.txt')
+    data = write_file(fpath, 'enc', 100)
+    # the columns of a DI file, read as an encoder one
+    transcode_file(fpath, 'PIZZABOX_DI_FILE_TXT', 10)
+    handler = PizzaBoxEncHandlerTxt(fpath, 10)
+    assert handler._data is None
+    assert handler.read_all().tolist() == data.tolist()
+
+
+def test_time_index_dir(tmp_path, an_file, monkeypatch):
+    fpath, data = an_file
+    times = timestamps_ns(data.ts_s, data.ts_ns)
+    t0, t1 = times[200] / 1e9, times[300] / 1e9
+    PizzaBoxAnHandlerTxt(fpath, CHUNK_SIZE).read_time_range(t0, t1)
+    # nothing written to the data directory
+    assert sorted(os.listdir(str(tmp_path))) == ['an.txt']
+
+    index_dir = str(tmp_path / 'tidx')
+    monkeypatch.setattr(PizzaBoxAnHandlerTxt, 'memory_cache', None)
+    handler = PizzaBoxAnHandlerTxt(fpath, CHUNK_SIZE,
+                                   time_index_dir=index_dir)
+    expected = handler.read_time_range(t0, t1)
+    assert len(os.listdir(index_dir)) == 1
+    handler = PizzaBoxAnHandlerTxt(fpath, CHUNK_SIZE,
+                                   time_index_dir=index_dir)
+    monkeypatch.setattr('qastools.timeindex.TimeIndex.build', None)
+    assert handler.read_time_range(t0, t1).tolist() == expected.tolist()
+
+
+def test_time_index_of_cached_file(tmp_path, an_file):
+    fpath, data = an_file
+    cache = ParsedFileCache(str(tmp_path / 'cache'))
+    handler = PizzaBoxAnHandlerTxt(fpath, CHUNK_SIZE, cache=cache)
+    with pytest.raises(ValueError):
+        handler.time_index()
+    times = timestamps_ns(data.ts_s, data.ts_ns)
+    t0, t1 = times[10] / 1e9, times[20] / 1e9
+    rows = handler.read_time_range(t0, t1)
+    expected = data[(times >= seconds_to_ns(t0)) &
+                    (times < seconds_to_ns(t1))]
+    assert 9 <= len(rows) <= 11
+    assert rows.tolist() == expected.tolist()
@@ -0,0 +1,129 @@
+import numpy as np
+import pytest
+
+from qastools.fill import read_resource
+from qastools.handlers import PizzaBoxAnHandlerTxt
+from qastools.integrity import (IntegrityCounter, integrity_of,
+                                integrity_stats)
+from qastools.synthetic import write_file
+
+
+def write(tmp_path, text, name='an.txt'):
+    fpath = str(tmp_path / name)
+    with open(fpath, 'wb') as f:
+        f.write(text)
+    return fpath
+
+
+def test_stats():
+    period = 10**6
+    times = np.arange(20) * period
+    times[5] = times[4]
+    times[10] = times[9] - 1
+    times = np.concatenate((times, times[-1] + period * np.arange(4, 8)))
+    stats = integrity_stats(times, malformed=2, blank=1)
+    assert stats['nrows'] == 24
+    assert stats['malformed'] == 2 and stats['blank'] == 1
+    assert stats['duplicates'] == 1 and stats['backwards'] == 1
+    assert stats['period_ns'] == period
+    assert stats['gaps'] == 1 and stats['missing'] == 3
+    assert integrity_stats([])['period_ns'] is None
+
+
+@pytest.mark.parametrize('split', [1, 3, 10, 19])
+def test_counter_blocks(split):
+    ''' Adding rows a block at a time, steps across blocks included.'''
+    rng = np.random.default_rng(0)
+    times = np.cumsum(rng.choice([0, 1000, 1000, 1000, 5000, -10], 40))
+    counter = IntegrityCounter()
+    counter.add(times[:split], malformed=1)
+    counter.add(times[split:split], blank=2)
+    counter.add(times[split:])
+    assert counter.stats() == integrity_stats(times, malformed=1, blank=2)
+
+
+def test_blank_lines_are_not_malformed(tmp_path):
+    fpath = write(tmp_path, b'1 2 3 ff\n\n1 3 4 fe\n1 4 5 1\n')
+    handler = PizzaBoxAnHandlerTxt(fpath, 2)
+    stats = integrity_of(handler.read_all())
+    assert stats['nrows'] == 3
+    assert stats['malformed'] == 0 and stats['blank'] == 1
+    assert integrity_of(handler(0))['blank'] == 1
+    assert integrity_of(handler(1))['blank'] == 0
+
+
+def test_chunk_integrity(tmp_path):
+    fpath = write(tmp_path, b'1 2 3 ff\n1 2 x fe\n1 2 3 1\n'
+                            b'1 4 5 1\n1 4 5 1\n1 5\n')
+    handler = PizzaBoxAnHandlerTxt(fpath, 3, errors='skip')
+    first, second = handler(0), handler(1)
+    assert integrity_of(first)['malformed'] == 1
+    assert integrity_of(first)['duplicates'] == 1
+    assert integrity_of(second)['malformed'] == 1
+    assert integrity_of(second)['nrows'] == 2
+    stats = integrity_of(handler.read_all())
+    assert stats['nrows'] == 4 and stats['malformed'] == 2
+    # the stats are of the rows they came with, not of slices of them
+    assert integrity_of(first[:1]) is None
+    # a handler keeps no statistics of its own
+    assert not hasattr(handler, 'integrity')
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_read_all_integrity(tmp_path, processes):
+    fpath = str(tmp_path / 'an.txt')
+    data = write_file(fpath, 'an', 2000, rate_hz=1e3)
+    with open(fpath, 'rb') as f:
+        lines = f.read().split(b'\n')
+    # a gap of 10 samples, a malformed line and a blank one
+    del lines[500:510]
+    lines[700] = b'1 2'
+    lines[900] = b''
+    fpath = write(tmp_path, b'\n'.join(lines), 'gaps.txt')
+    handler = PizzaBoxAnHandlerTxt(fpath, 64, errors='skip')
+    rows = handler.read_all(processes=processes)
+    stats = integrity_of(rows)
+    assert stats['nrows'] == len(rows) == len(data) - 12
+    assert stats['malformed'] == 1 and stats['blank'] == 1
+    assert stats['gaps'] == 1 and stats['missing'] == 10
+    assert stats['period_ns'] == 10**6
+    with pytest.raises(ValueError):
+        PizzaBoxAnHandlerTxt(fpath, 64).read_all(processes=processes)
+
+
+def test_arrow_integrity(tmp_path):
+    pytest.importorskip('pyarrow')
+    fpath = write(tmp_path, b'1 2 3 ff\n\n1 3 4 fe\n1 4 5 1\n1 5\n')
+    handler = PizzaBoxAnHandlerTxt(fpath, 2, output='arrow', errors='skip')
+    table = handler.read_all()
+    stats = integrity_of(table)
+    assert stats['nrows'] == 3
+    assert stats['blank'] == 1 and stats['malformed'] == 1
+    assert integrity_of(handler(1))['nrows'] == 2
+    rows = handler.read_time_range(1.000000002, 1.000000004)
+    assert integrity_of(rows)['nrows'] == 2
+
+
+def test_time_range_integrity(tmp_path):
+    fpath = str(tmp_path / 'an.txt')
+    write_file(fpath, 'an', 1000, rate_hz=1e3)
+    handler = PizzaBoxAnHandlerTxt(fpath, 64)
+    rows = handler.read_time_range(1500000000.1005, 1500000000.2005)
+    stats = integrity_of(rows)
+    assert stats['nrows'] == len(rows) == 100
+    assert stats['period_ns'] == 10**6
+
+
+def test_read_resource_blank_lines(tmp_path):
+    ''' Chunks that lost lines are not cut out of a bulk read by
+        position.'''
+    fpath = write(tmp_path, b'1 0 0 1\n\n1 2 2 1\n1 3 3 1\n1 4 4 1\n')
+    handler = PizzaBoxAnHandlerTxt(fpath, 2)
+    datums = [dict(datum_id=str(k), datum_kwargs=dict(chunk_num=k))
+              for k in (2, 0, 1)]
+    parts = read_resource(handler, datums, by_datum=True)
+    for datum in datums:
+        chunk = handler(**datum['datum_kwargs'])
+        assert parts[datum['datum_id']].tolist() == chunk.tolist()
+    rows = read_resource(handler, datums)
+    assert rows.index.tolist() == [4, 0, 2, 3]
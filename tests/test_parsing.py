@@ -0,0 +1,160 @@
+import numpy as np
+import pytest
+
+from qastools.parsing import (decode_adc, find_malformed, parse_pizzabox,
+                              parse_pizzabox_columns, skip_malformed,
+                              timestamps_ns)
+from qastools.synthetic import HANDLERS, generate, write_text
+
+AN_COLUMNS = ('ts_s', 'ts_ns', 'index', 'adc')
+AN_BASES = (10, 10, 10, 16)
+
+
+def legacy_parse(text, bases):
+    ''' What the handlers did before, one line at a time.'''
+    return [tuple(int(v, base=b) for v, b in zip(ln.split(), bases))
+            for ln in text.decode().splitlines(True) if ln.strip()]
+
+
+@pytest.mark.parametrize('kind', sorted(HANDLERS))
+def test_parse_matches_legacy(tmp_path, kind):
+    handler_class = HANDLERS[kind]
+    bases = handler_class.bases or (10,) * len(handler_class.columns)
+    fpath = str(tmp_path / 'data.txt')
+    write_text(fpath, generate(kind, 500, jitter_ns=100), bases)
+    with open(fpath, 'rb') as f:
+        text = f.read()
+    data = parse_pizzabox(text, handler_class.columns, bases)
+    assert data.tolist() == legacy_parse(text, bases)
+
+
+def test_crlf_blank_lines_and_runs_of_spaces():
+    text = (b'1 2 3 ff\r\n\r\n1  3\t4 0xfe\r\n   \n'
+            b'1 4 5 1\n\n1 5 6 A')
+    data = parse_pizzabox(text, AN_COLUMNS, AN_BASES)
+    assert data.tolist() == legacy_parse(text, AN_BASES)
+    assert data.tolist() == [(1, 2, 3, 255), (1, 3, 4, 254), (1, 4, 5, 1),
+                             (1, 5, 6, 10)]
+
+
+def test_short_hex_tokens_next_to_wide_ones():
+    # the window of a short hex token reaches back over the one before
+    text = b'1 2 3 7fffffffffffffff\n1 2 3 1\n1 2 3 7f\n'
+    assert parse_pizzabox(text, AN_COLUMNS, AN_BASES).tolist() == [
+        (1, 2, 3, 2**63 - 1), (1, 2, 3, 1), (1, 2, 3, 127)]
+    data = parse_pizzabox(b'1 ff 3 7f\n1 0 3 1\n', AN_COLUMNS,
+                          (10, 16, 10, 16))
+    assert data.tolist() == [(1, 255, 3, 127), (1, 0, 3, 1)]
+
+
+def test_columns_and_time_ns():
+    text = b'10 5 0 1f\n11 999999999 1 2\n'
+    data = parse_pizzabox(text, AN_COLUMNS, AN_BASES, time_ns=True)
+    columns = parse_pizzabox_columns(text, AN_COLUMNS, AN_BASES,
+                                     time_ns=True)
+    assert list(columns) == list(data.dtype.names)
+    for name in columns:
+        assert np.array_equal(columns[name], data[name])
+    assert data.time_ns.tolist() == [10 * 10**9 + 5, 12 * 10**9 - 1]
+    assert np.array_equal(timestamps_ns(data.ts_s, data.ts_ns), data.time_ns)
+
+
+@pytest.mark.parametrize('text', [
+    b'1 2 3 1x2\n',
+    b'1 2 3 x12\n',
+    b'1 2 3 0x\n',
+    b'1 2 3 00x1\n',
+    b'1 2 3 g\n',
+    b'1 2 3 8000000000000000\n',
+    b'1 2 3 10000000000000000\n',
+    b'1 2 9223372036854775808 1\n',
+    b'1 2 -9223372036854775809 1\n',
+    b'1 2 99999999999999999999 1\n',
+    b'1 2 3a 1\n',
+    b'1 2 - 1\n',
+    b'1 + 3 1\n',
+    b'1 2 3\n',
+    b'1 2 3 4 5\n',
+    b'1 2 3\x00 ff\n',
+    b'1 2\x003 4 ff\n',
+    b'1 2 3 f\x00f\n',
+    b'\x00\x00\x00\n',
+])
+def test_malformed_lines_raise_and_are_found(text):
+    ''' Everything int(v, base) rejects, or that does not fit an int64.'''
+    with pytest.raises(ValueError):
+        parse_pizzabox(text, AN_COLUMNS, AN_BASES)
+    assert find_malformed(text, AN_COLUMNS, AN_BASES).tolist() == [0]
+
+
+def test_int64_limits():
+    text = (b'1 2 9223372036854775807 7fffffffffffffff\n'
+            b'1 -9223372036854775808 +3 0X7f\n')
+    assert parse_pizzabox(text, AN_COLUMNS, AN_BASES).tolist() == [
+        (1, 2, 2**63 - 1, 2**63 - 1), (1, -2**63, 3, 127)]
+    assert find_malformed(text, AN_COLUMNS, AN_BASES).size == 0
+
+
+def test_skip_malformed():
+    text = (b'1 2 3 ff\n1 2 3 1x2\n\n1 3 4 fe\n1 4\n'
+            b'1 2 3 8000000000000000\n1 4 5 1\n')
+    with pytest.raises(ValueError):
+        parse_pizzabox(text, AN_COLUMNS, AN_BASES)
+    data, malformed = skip_malformed(parse_pizzabox, text, AN_COLUMNS,
+                                     AN_BASES)
+    # the blank line is not malformed, it just makes no row
+    assert malformed.tolist() == [1, 4, 5]
+    assert data.tolist() == [(1, 2, 3, 255), (1, 3, 4, 254), (1, 4, 5, 1)]
+    columns, malformed = skip_malformed(parse_pizzabox_columns, text,
+                                        AN_COLUMNS, AN_BASES)
+    assert columns['adc'].tolist() == [255, 254, 1]
+
+
+def test_skip_malformed_clean_text():
+    text = b'1 2 3 ff\n1 3 4 fe\n'
+    data, malformed = skip_malformed(parse_pizzabox, text, AN_COLUMNS,
+                                     AN_BASES)
+    assert malformed.size == 0
+    assert data.tolist() == legacy_parse(text, AN_BASES)
+
+
+def legacy_volts(hex_word):
+    ''' The per line conversion of isstools.'''
+    value = int(hex_word, 16) >> 8
+    value = value - 0x40000 if value > 0x1FFFF else value
+    return value * 7.62939453125e-05
+
+
+ADC_WORDS = [0, 0xff, 1 << 8, 0x1FFFF << 8, 0x20000 << 8,
+             (0x20000 << 8) | 0x3, 0x3FFFF << 8, (0x3FFFF << 8) | 0xff,
+             0x2FFFF << 8, 0x12345 << 8 | 0x2]
+
+
+def test_decode_adc_matches_legacy():
+    words = np.array(ADC_WORDS)
+    counts = decode_adc(words)
+    assert counts.dtype == np.int32
+    # full scale either way, and -1
+    assert counts[3] == 2**17 - 1
+    assert counts[4] == counts[5] == -2**17
+    assert counts[6] == counts[7] == -1
+    volts = decode_adc(words, volts_per_count=10 / 2**17)
+    assert volts.tolist() == [legacy_volts('%x' % word) for word in words]
+
+
+def test_decode_adc_parsed_words():
+    text = b''.join(b'1 2 %d %x\n' % (k, word)
+                    for k, word in enumerate(ADC_WORDS))
+    data = parse_pizzabox(text, AN_COLUMNS, AN_BASES)
+    volts = decode_adc(data.adc, volts_per_count=10 / 2**17)
+    assert volts.tolist() == [legacy_volts(line.split()[3])
+                              for line in text.decode().splitlines()]
+
+
+def test_decode_adc_layout():
+    # a 16 bit value with no status bits
+    words = np.array([0x7fff, 0x8000, 0xffff, 0x1ffff])
+    assert decode_adc(words, bits=16, shift=0).tolist() == [
+        2**15 - 1, -2**15, -1, -1]
+    with pytest.raises(ValueError):
+        decode_adc(words, bits=33)